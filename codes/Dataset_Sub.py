@@ -7,7 +7,7 @@
 # author：Peng time:2019-10-16
 
 import os, random
-from typing import List, Dict
+from typing import List, Dict, Tuple
 from itertools import chain
 from collections import defaultdict, OrderedDict
 import json
@@ -17,12 +17,12 @@ import pickle
 import torch
 import torch.utils.data as data
 
-from transformers import BertTokenizer
-tokenizer = BertTokenizer.from_pretrained("bert-base-cased", do_lower_case=True)
+# built on first use, so the collate helpers import without the tokenizer
+from Inference import get_tokenizer
 
 def get_voc_size():
-    print(tokenizer.vocab_size)
-    return tokenizer.vocab_size
+    print(get_tokenizer().vocab_size)
+    return get_tokenizer().vocab_size
 
 
 class DataPrefetcher():
@@ -46,13 +46,34 @@ class DataPrefetcher():
         self.preload()
         return data
 
+def fuse_sents(data: List[dict]) -> Tuple[List[List[int]], Dict[str, torch.Tensor]]:
+    """
+    Unique sentences of the src/nf/nb lists of the documents of a batch, keyed
+    by their token ids, and '<name>_map', the row of every src/nf/nb sentence
+    among them.
+    """
+    unique: Dict[tuple, int] = {}
+    sent_map = {}
+    for key, name in [('src', 'src_idx'), ('nf', 'neg_idx_fwd'), ('nb', 'neg_idx_bwd')]:
+        if name not in data[0]:
+            continue
+        rows = [unique.setdefault(tuple(sent), len(unique))
+                for sent in chain.from_iterable([_[name] for _ in data])]
+        sent_map[f'{key}_map'] = torch.LongTensor(rows)
+    return [list(sent) for sent in unique], sent_map
+
 class TextDataset(data.Dataset):
     def __init__(self,
                  split: str,
-                 path: str) -> None:
+                 path: str,
+                 negatives: str = 'corpus',
+                 fuse: bool = False) -> None:
         assert split in ['train', 'valid', 'test']
+        assert negatives in ['corpus', 'in_batch', 'memory_bank']
         self._data_path = os.path.join(path, split)
         self._n_data = self._count_data(self._data_path)
+        self.negatives = negatives
+        self.fuse = fuse
 
     def __len__(self) -> int:
         return self._n_data
@@ -60,6 +81,18 @@ class TextDataset(data.Dataset):
     def __getitem__(self, i: int):
         with open(os.path.join(self._data_path, f'{i}.json')) as f:
             js = json.loads(f.read())
+        if self.negatives != 'corpus':
+            # negatives come from the other documents of the batch or the memory
+            # bank, so the nf/nb sentences are neither tokenized nor collated.
+            if 'src_idx' not in js:
+                src = js['article'] if 'article' in js else js['src']
+                js['src_idx'] = list(map(self.convert2list, src[: 20]))
+                # written back like the corpus path, so every sentence is tokenized once
+                with open(os.path.join(self._data_path, f'{i}.json'), "w+") as f:
+                    json.dump(js, f)
+            js.pop('neg_idx_fwd', None)
+            js.pop('neg_idx_bwd', None)
+            return js
         if 'src_idx' in js and 'neg_idx_fwd' in js and 'neg_idx_bwd' in js:
             return js
         else:
@@ -79,6 +112,7 @@ class TextDataset(data.Dataset):
             return js
 
     def convert2list(self, s: str):
+        tokenizer = get_tokenizer()
         s_tokens = s.rstrip().split()
         if len(s.rstrip().split()) > 50:
             s = " ".join(s_tokens[:50])
@@ -97,8 +131,7 @@ class TextDataset(data.Dataset):
         #print(n_data)
         return len(names)
 
-    @staticmethod
-    def collate_fn(data):
+    def collate_fn(self, data):
         def get_idx_by_lens(lens_list: List[int]) -> List[List[int]]:
             idx_list: List[List[int]] = []
             start = 0
@@ -108,7 +141,9 @@ class TextDataset(data.Dataset):
             return idx_list
 
         def pad_mask(data, name):
-            chain_src = list(chain.from_iterable([_[name] for _ in data]))
+            return pad_sents(list(chain.from_iterable([_[name] for _ in data])))
+
+        def pad_sents(chain_src):
             src_lens = [len(_) for _ in chain_src]
             max_src_lens = max(src_lens)
             padded_src = torch.zeros(len(chain_src), max_src_lens).long()
@@ -120,24 +155,33 @@ class TextDataset(data.Dataset):
             return padded_src, mask_src, src_lens
 
         src_doc_list: List[int] = []  # count num of sentences in a doc for this batch \
-        negf_doc_list: List[int] = []
-        negb_doc_list: List[int] = []
         for i, _ in enumerate(data):
             src_doc_list += [len(_['src_idx'])]
-            negf_doc_list += [len(_['neg_idx_fwd'])]
-            negb_doc_list += [len(_['neg_idx_bwd'])]
-
-        padded_src, mask_src, src_lens = pad_mask(data, 'src_idx')
-        padded_nf, mask_nf, nf_lens = pad_mask(data,'neg_idx_fwd')
-        padded_nb, mask_nb, nb_lens = pad_mask(data, 'neg_idx_bwd')
-        Tensor_dict = {'src': padded_src,
-                       # (B x num_src) x max_seq_src_len : num_ is not sure. so (B x num_) is changing
-                       'mask_src': mask_src,  # (B x num_src) x max_seq_src_len
-                       'nf': padded_nf,
-                       'nb': padded_nb,
-                       'mnf': mask_nf,
-                       'mnb': mask_nb
-                       }
+
+        if self.fuse:
+            # One padded tensor over the unique sentences of src/nf/nb
+            unique, Tensor_dict = fuse_sents(data)
+            padded_src, mask_src, src_lens = pad_sents(unique)
+            Tensor_dict.update({'src': padded_src,  # num_unique x max_seq_len
+                                'mask_src': mask_src})
+            length_dict = {'src': src_lens}
+        else:
+            padded_src, mask_src, src_lens = pad_mask(data, 'src_idx')
+            Tensor_dict = {'src': padded_src,
+                           # (B x num_src) x max_seq_src_len : num_ is not sure. so (B x num_) is changing
+                           'mask_src': mask_src,  # (B x num_src) x max_seq_src_len
+                           }
+            length_dict = {'src': src_lens}
+        if 'neg_idx_fwd' in data[0] and not self.fuse:
+            padded_nf, mask_nf, nf_lens = pad_mask(data, 'neg_idx_fwd')
+            padded_nb, mask_nb, nb_lens = pad_mask(data, 'neg_idx_bwd')
+            Tensor_dict.update({'nf': padded_nf,
+                                'nb': padded_nb,
+                                'mnf': mask_nf,
+                                'mnb': mask_nb
+                                })
+            length_dict.update({'nf': nf_lens,
+                                'nb': nb_lens})
         #token_dict = {'src': [_['src'] for _ in data]}
 
         src_idxbylen = get_idx_by_lens(src_doc_list)
@@ -151,9 +195,6 @@ class TextDataset(data.Dataset):
                     # 'nb_idx': nb_idxbylen
                     }
         # 'neg_idx': neg_idx}
-        length_dict = {'src': src_lens,
-                       'nf': nf_lens,
-                       'nb': nb_lens}
         return Tensor_dict, idx_dict, length_dict
 
 
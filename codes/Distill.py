@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-15
+
+import time
+from typing import List, Dict, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor as T
+
+import Model
+from Inference import load_model, load_config, pad_sents
+from Embedding_Cache import EmbeddingCache
+
+
+def rank_correlation(x: np.ndarray, y: np.ndarray) -> float:
+    '''
+    Spearman correlation of two 1-d arrays (ties ranked by order)
+    '''
+    rx = np.argsort(np.argsort(x)).astype(np.float64)
+    ry = np.argsort(np.argsort(y)).astype(np.float64)
+    return float(np.corrcoef(rx, ry)[0, 1])
+
+
+def pairwise_cosine(embs: np.ndarray) -> np.ndarray:
+    '''
+    Cosine similarity of every pair i < j of rows
+    '''
+    embs = embs / np.maximum(np.linalg.norm(embs, axis=1, keepdims=True), 1e-12)
+    return (embs @ embs.T)[np.triu_indices(embs.shape[0], k=1)]
+
+
+class Distiller(nn.Module):
+    '''
+    Embedding matching against a frozen teacher PEmodel. The teacher embeddings
+    come from an EmbeddingCache, so with a cache_dir every sentence is encoded
+    by the teacher once, on the first epoch, and read back afterwards. A student
+    narrower than the teacher is matched through a linear projection, trained
+    with the student and only used by the loss; its weights are saved in the
+    checkpoint of the run under 'distiller_state_dict'.
+    '''
+    def __init__(self,
+                 init_checkpoint: str,
+                 student_dim: int,
+                 loss_type: str = 'mse',
+                 cache_dir: Optional[str] = None,
+                 device: str = 'cpu') -> None:
+        super(Distiller, self).__init__()
+        if loss_type not in ['mse', 'cosine']:
+            raise ValueError(f'Unknown distillation loss {loss_type}, choose from mse, cosine')
+        # a plain attribute: the teacher is neither trained nor saved with the student
+        self.__dict__['teacher'] = load_model(init_checkpoint, device)
+        for p in self.teacher.parameters():
+            p.requires_grad = False
+        self.cache = EmbeddingCache(self.teacher, cache_dir=cache_dir, device=device)
+        self.loss_type = loss_type
+        # from the config, encoding a probe sentence would add an entry to the cache
+        teacher_dim = load_config(init_checkpoint).d_model
+        if student_dim != teacher_dim:
+            self.projection: nn.Module = nn.Linear(student_dim, teacher_dim)
+        else:
+            self.projection = nn.Identity()
+
+    def teacher_embeddings(self, sents: List[List[int]], device: torch.device) -> T:
+        return torch.from_numpy(self.cache.encode(sents)).to(device)
+
+    def forward(self, student: T, sents: List[List[int]]) -> T:
+        '''
+        :param student: num_sent x student_dim embeddings of sents
+        :return: the distillation loss
+        '''
+        teacher = self.teacher_embeddings(sents, student.device)
+        student = self.projection(student)
+        if self.loss_type == 'cosine':
+            return torch.mean(1 - F.cosine_similarity(student, teacher, dim=-1))
+        return F.mse_loss(student, teacher)
+
+    def report(self, student: Model.PEmodel, sents: List[List[int]], batch_size: int = 64) -> Dict[str, float]:
+        '''
+        Speed and agreement of the student with the teacher on sents, both
+        encoding them without the cache: the student/teacher speed ratio and
+        the rank correlation of their pairwise cosine similarities, which does
+        not depend on the projection.
+        '''
+        embs, seconds = {}, {}
+        device = next(student.parameters()).device
+        for name, model in [('student', student), ('teacher', self.teacher)]:
+            out = []
+            start = time.perf_counter()
+            for i in range(0, len(sents), batch_size):
+                src, mask, lens = pad_sents(sents[i: i + batch_size])
+                out.append(Model.PEmodel.encode(model, src.to(device), mask.to(device), {'src': lens}).float())
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            seconds[name] = time.perf_counter() - start
+            embs[name] = torch.cat(out, dim=0).cpu().numpy()
+        student.train()
+        return {'speed_ratio': seconds['teacher'] / max(seconds['student'], 1e-9),
+                'similarity_agreement': rank_correlation(pairwise_cosine(embs['student']),
+                                                         pairwise_cosine(embs['teacher'])),
+                'teacher_cache_hit_rate': self.cache.hit_rate}
+
+
+def batch_sents(Tensor_dict: Dict[str, T], length_dict: Dict[str, List[int]]) -> List[List[int]]:
+    '''
+    Token ids of the src sentences of a collated batch, in row order
+    '''
+    return [row[:n] for row, n in zip(Tensor_dict['src'].tolist(), length_dict['src'])]
+
+
+def sample_sents(loader, size: int) -> List[List[int]]:
+    '''
+    Token ids of the first size src sentences of a data loader
+    '''
+    sents: List[List[int]] = []
+    for Tensor_dict, _, length_dict in loader:
+        sents += batch_sents(Tensor_dict, length_dict)
+        if len(sents) >= size:
+            break
+    return sents[:size]
+
+
+def distill_step(model,
+                 distiller: Distiller,
+                 optimizer,
+                 scheduler,
+                 data,
+                 args,
+                 istep) -> Dict[str, float]:
+    '''
+    PEmodel.train_step for a student: the distillation loss on the src sentences
+    of the batch, plus args.distill_weight times the Predic_Net objective when
+    it is positive (the student src embeddings are then taken from that forward
+    pass instead of encoding the batch twice).
+    '''
+    model.train()
+    optimizer.zero_grad()
+    Tensor_dict, idx_dict, length_dict = data
+    device = next(model.parameters()).device
+    sents = batch_sents(Tensor_dict, length_dict)
+    sent_map = Model.PEmodel.get_sent_map(Tensor_dict, device)
+    log: Dict[str, float] = {}
+    if args.distill_weight > 0:
+        captured: List[object] = []
+        hook = model.encoder.register_forward_hook(
+            lambda module, inputs, output: captured.append(output) if not captured else None)
+        try:
+            neg_input, neg_mask = Model.PEmodel.get_negatives(Tensor_dict, device)
+            pos_loss, neg_loss, _ = model(
+                Tensor_dict['src'].to(device),
+                Tensor_dict['mask_src'].to(device),
+                idx_dict['rep_idx'],
+                idx_dict['score_idx'],
+                neg_input,
+                neg_mask,
+                length_dict,
+                istep <= args.quick_thought_step,
+                sent_map
+            )
+        finally:
+            hook.remove()
+        if sent_map is None:
+            # one tensor per document, in rep_idx order
+            student = torch.cat(captured[0], dim=0)
+            sents = [sents[i] for idx in idx_dict['rep_idx'] for i in idx]
+        else:
+            student = captured[0]
+        objective = (pos_loss + neg_loss) / 2
+        log['objective_loss'] = objective.item()
+    else:
+        student = model.encoder(Tensor_dict['src'].to(device), Tensor_dict['mask_src'].to(device),
+                                None, length_dict['src'])
+        objective = 0.
+    distill_loss = distiller(student, sents)
+    loss = distill_loss + args.distill_weight * objective
+    loss.backward()
+    torch.nn.utils.clip_grad_norm_(list(model.parameters()) + list(distiller.parameters()), args.max_grad_norm)
+    optimizer.step()
+    scheduler.step()
+    if model.key_encoder is not None:
+        model.momentum_update()
+    log['distill_loss'] = distill_loss.item()
+    log['loss'] = loss.item()
+    return log
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-09
+
+import os
+import shutil
+import hashlib
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+import numpy as np
+import torch
+
+import Model
+from Inference import pad_sents, token_budget_batches
+
+
+def _update_digest(digest, name: str, value: object) -> None:
+    if isinstance(value, torch.Tensor):
+        tensor = value.detach().cpu()
+        if tensor.is_quantized:
+            # int8 values plus their quantization parameters
+            if tensor.qscheme() in (torch.per_tensor_affine, torch.per_tensor_symmetric):
+                digest.update(f'{name}:{tensor.q_scale()}:{tensor.q_zero_point()}'.encode())
+            else:
+                _update_digest(digest, f'{name}.scales', tensor.q_per_channel_scales())
+                _update_digest(digest, f'{name}.zero_points', tensor.q_per_channel_zero_points())
+            tensor = tensor.int_repr()
+        if tensor.dtype == torch.bfloat16:
+            # numpy has no bfloat16, hash its bytes as int16 as save_tensors stores them
+            tensor = tensor.view(torch.int16)
+        array = tensor.contiguous().numpy()
+        digest.update(f'{name}:{array.dtype}:{array.shape}'.encode())
+        digest.update(array.tobytes())
+    elif isinstance(value, (tuple, list)):
+        # e.g. the (weight, bias) _packed_params of a dynamically quantized Linear
+        for i, item in enumerate(value):
+            _update_digest(digest, f'{name}.{i}', item)
+    else:
+        digest.update(f'{name}:{value!r}'.encode())
+
+
+def state_fingerprint(model: torch.nn.Module) -> str:
+    '''
+    sha1 of the names, shapes and values of the state_dict of a model,
+    including the non tensor entries of quantized modules
+    '''
+    digest = hashlib.sha1()
+    for name, value in sorted(model.state_dict().items()):
+        _update_digest(digest, name, value)
+    return digest.hexdigest()
+
+
+class EmbeddingCache(object):
+    '''
+    Sentence embeddings of the encoder of a model, keyed by (checkpoint
+    fingerprint, token ids). An LRU tier keeps at most max_bytes of embeddings
+    in memory; with cache_dir, evicted and new entries are also stored on disk
+    under cache_dir/<fingerprint>/.
+    The fingerprint is a hash of the encoder weights. It is recomputed when any
+    of them was modified in place since (e.g. by an optimizer step),
+    which drops the memory tier; disk entries of other fingerprints are never
+    read and are removed when the cache is created.
+    '''
+    def __init__(self,
+                 model: Model.PEmodel,
+                 max_bytes: int = 2 ** 30,
+                 cache_dir: Optional[str] = None,
+                 max_tokens: int = 8192,
+                 device: str = 'cpu') -> None:
+        self.model = model
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_tokens = max_tokens
+        self.device = device
+        self.memory: 'OrderedDict[str, np.ndarray]' = OrderedDict()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0,
+                      'memory_bytes': 0, 'disk_bytes': 0}
+        self._versions = None
+        self.fingerprint = None
+        self.check_fingerprint()
+        if cache_dir is not None:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            for name in os.listdir(cache_dir):
+                if name != self.fingerprint and os.path.isdir(os.path.join(cache_dir, name)):
+                    shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+            self.stats['disk_bytes'] = sum(
+                entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.is_file())
+
+    @property
+    def disk_dir(self) -> str:
+        return os.path.join(self.cache_dir, self.fingerprint)
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        return hits / max(hits + self.stats['misses'], 1)
+
+    def check_fingerprint(self) -> None:
+        '''
+        Rehash the weights if one of them changed since the last check.
+        '''
+        # packed quantized weights are not tensors and have no version
+        versions = tuple(getattr(t, '_version', None)
+                         for t in self.model.encoder.state_dict(keep_vars=True).values())
+        if versions == self._versions:
+            return
+        self._versions = versions
+        fingerprint = state_fingerprint(self.model.encoder)
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self.memory.clear()
+            self.stats['memory_bytes'] = 0
+            if self.cache_dir is not None:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                self.stats['disk_bytes'] = 0
+
+    @staticmethod
+    def key(token_ids: List[int]) -> str:
+        return hashlib.sha1(np.asarray(token_ids, dtype=np.int64).tobytes()).hexdigest()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.stats['memory_hits'] += 1
+            return self.memory[key]
+        if self.cache_dir is not None:
+            path = os.path.join(self.disk_dir, key + '.npy')
+            if os.path.exists(path):
+                self.stats['disk_hits'] += 1
+                emb = np.load(path)
+                self.put(key, emb, to_disk=False)
+                return emb
+        return None
+
+    def put(self, key: str, emb: np.ndarray, to_disk: bool = True) -> None:
+        if to_disk and self.cache_dir is not None:
+            path = os.path.join(self.disk_dir, key + '.npy')
+            if not os.path.exists(path):
+                # written under a temporary name, so readers never see a partial file
+                tmp = f'{path}.{os.getpid()}.tmp'
+                with open(tmp, 'wb') as f:
+                    np.save(f, emb)
+                os.replace(tmp, path)
+                self.stats['disk_bytes'] += os.path.getsize(path)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = emb
+        self.stats['memory_bytes'] += emb.nbytes
+        while self.stats['memory_bytes'] > self.max_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.stats['memory_bytes'] -= evicted.nbytes
+
+    def encode(self, sents: List[List[int]]) -> np.ndarray:
+        '''
+        Embeddings of a list of token id sentences. Only the distinct sentences
+        found in neither tier are encoded, in token budget batches.
+        :return: num_sent x d_model float32
+        '''
+        self.check_fingerprint()
+        keys = [self.key(sent) for sent in sents]
+        found: Dict[str, np.ndarray] = {}
+        missing: Dict[str, List[int]] = OrderedDict()
+        for key, sent in zip(keys, sents):
+            if key in found or key in missing:
+                continue
+            emb = self.get(key)
+            if emb is None:
+                missing[key] = sent
+            else:
+                found[key] = emb
+        self.stats['misses'] += len(missing)
+
+        miss_keys: List[str] = list(missing)
+        miss_sents: List[List[int]] = list(missing.values())
+        for batch in token_budget_batches([len(_) for _ in miss_sents], self.max_tokens):
+            src, mask, lens = pad_sents([miss_sents[i] for i in batch])
+            reps = Model.PEmodel.encode(self.model, src.to(self.device), mask.to(self.device), {'src': lens})
+            reps = reps.float().cpu().numpy()
+            for i, emb in zip(batch, reps):
+                # a copy, so an entry does not keep its whole batch alive
+                emb = emb.copy()
+                found[miss_keys[i]] = emb
+                self.put(miss_keys[i], emb)
+        return np.stack([found[key] for key in keys]) if keys else np.zeros((0, 0), np.float32)
+
+    def info(self) -> Dict[str, float]:
+        return {**self.stats, 'entries': len(self.memory), 'hit_rate': self.hit_rate}
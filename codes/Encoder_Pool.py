@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-11
+
+import os
+import queue
+import multiprocessing as mp
+from typing import List, Optional, Iterator, Tuple
+
+import numpy as np
+import torch
+
+import Model
+from Inference import pad_sents, token_budget_batches
+
+
+def core_sets(num_workers: int) -> List[List[int]]:
+    '''
+    The cores this process may run on, split into num_workers disjoint
+    contiguous sets (the first ones get one more core when it does not divide).
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if num_workers > len(cores):
+        raise ValueError(f'{num_workers} workers for {len(cores)} cores')
+    size, extra = divmod(len(cores), num_workers)
+    sets, start = [], 0
+    for rank in range(num_workers):
+        end = start + size + (rank < extra)
+        sets.append(cores[start:end])
+        start = end
+    return sets
+
+
+def _worker(model, cores, tasks, results):
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, sents = task
+        try:
+            src, mask, lens = pad_sents(sents)
+            reps = Model.PEmodel.encode(model, src, mask, {'src': lens})
+            results.put((task_id, reps.float().numpy()))
+        except Exception as e:  # reported to the parent instead of hanging it
+            results.put((task_id, e))
+
+
+class EncoderPool(object):
+    '''
+    Forked CPU workers running PEmodel.encode on one copy of the weights.
+    The parent moves the parameters and buffers of the model to shared memory
+    (share_memory_()), so the forked workers map them instead of each loading
+    and holding its own copy. Every worker is pinned to its own set of cores
+    and uses as many torch threads. Batches go through a single task queue, so
+    idle workers pick up the next one.
+    Create the pool before the parent runs the model itself: forking after the
+    OpenMP thread pool was started can hang the workers.
+    '''
+    def __init__(self,
+                 model: Model.PEmodel,
+                 num_workers: int,
+                 cores: Optional[List[List[int]]] = None) -> None:
+        model.eval().share_memory()
+        ctx = mp.get_context('fork')
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.cores = cores or core_sets(num_workers)
+        self.workers = [ctx.Process(target=_worker, args=(model, cores, self.tasks, self.results), daemon=True)
+                        for cores in self.cores]
+        for p in self.workers:
+            p.start()
+
+    def __enter__(self) -> 'EncoderPool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def imap_batches(self, sents: List[List[int]], batches: List[List[int]]) -> Iterator[Tuple[List[int], np.ndarray]]:
+        '''
+        (batch, embeddings) of every batch of sentence indices, in completion order
+        '''
+        for task_id, batch in enumerate(batches):
+            self.tasks.put((task_id, [sents[i] for i in batch]))
+        for _ in batches:
+            while True:
+                try:
+                    task_id, reps = self.results.get(timeout=1.)
+                    break
+                except queue.Empty:
+                    if not all(p.is_alive() for p in self.workers):
+                        raise RuntimeError('an encoder worker died')
+            if isinstance(reps, Exception):
+                raise reps
+            yield batches[task_id], reps
+
+    def encode(self, sents: List[List[int]], max_tokens: int = 8192) -> np.ndarray:
+        '''
+        :return: num_sent x d_model embeddings of token id sentences
+        '''
+        out = None
+        for batch, reps in self.imap_batches(sents, token_budget_batches([len(_) for _ in sents], max_tokens)):
+            if out is None:
+                out = np.empty((len(sents), reps.shape[1]), dtype=np.float32)
+            out[np.asarray(batch)] = reps
+        return out
+
+    def close(self) -> None:
+        for _ in self.workers:
+            self.tasks.put(None)
+        for p in self.workers:
+            p.join()
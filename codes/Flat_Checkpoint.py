@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-14
+
+import os
+import json
+import struct
+import argparse
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch import Tensor as T
+
+import Model
+
+MAGIC = b'TTFLAT01'
+ALIGN = 64
+WEIGHTS = 'encoder.bin'
+# build_encoder arguments, the only part of config.json the encoder needs
+ENCODER_KEYS = ['encoder_type', 'word2id', 'emb_dim', 'd_model', 'nhead', 'n_layer', 'dropout',
+                'cls_only', 'pack', 'bidirectional', 'max_relative_positions', 'attn_q_chunk', 'attn_k_chunk',
+                'layer_heads']
+# numpy dtype the bytes of a tensor are stored as, bfloat16 as raw int16
+STORAGE = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.int16,
+           'int64': np.int64, 'int32': np.int32, 'bool': np.bool_}
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def save_tensors(tensors: Dict[str, T], path: str, dtype: Optional[str] = None) -> None:
+    '''
+    Flat file of named tensors:
+    MAGIC, uint64 little endian header size, JSON header
+    {"tensors": {name: {"dtype", "shape", "offset"}}}, then the tensors in
+    native little endian bytes, every one starting at a multiple of ALIGN bytes
+    (offsets count from the first one).
+    :param dtype: float32, float16 or bfloat16 to store floating point tensors in
+    '''
+    table, arrays, offset = {}, [], 0
+    for name, tensor in tensors.items():
+        tensor = tensor.detach().cpu().contiguous()
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(getattr(torch, dtype))
+        name_dtype = str(tensor.dtype).replace('torch.', '')
+        if name_dtype not in STORAGE:
+            raise ValueError(f'{name} has dtype {tensor.dtype}, which is not supported')
+        array = (tensor.view(torch.int16) if tensor.dtype == torch.bfloat16 else tensor).numpy()
+        table[name] = {'dtype': name_dtype, 'shape': list(tensor.shape), 'offset': offset}
+        arrays.append(array)
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({'tensors': table}).encode()
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        start = _align(f.tell())
+        for array, info in zip(arrays, table.values()):
+            f.write(b'\0' * (start + info['offset'] - f.tell()))
+            f.write(array.tobytes())
+
+
+def map_tensors(path: str) -> Dict[str, T]:
+    '''
+    Tensors of save_tensors backed by a copy-on-write memory map of the file:
+    nothing is read until used, and processes mapping the same file share its
+    pages in the page cache.
+    '''
+    mm = np.memmap(path, dtype=np.uint8, mode='c')
+    if bytes(mm[:len(MAGIC)]) != MAGIC:
+        raise ValueError(f'{path} is not a flat checkpoint')
+    size = struct.unpack('<Q', bytes(mm[len(MAGIC): len(MAGIC) + 8]))[0]
+    header = json.loads(bytes(mm[len(MAGIC) + 8: len(MAGIC) + 8 + size]))
+    start = _align(len(MAGIC) + 8 + size)
+    tensors = {}
+    for name, info in header['tensors'].items():
+        storage = np.dtype(STORAGE[info['dtype']])
+        nbytes = storage.itemsize * int(np.prod(info['shape'], dtype=np.int64))
+        begin = start + info['offset']
+        tensor = torch.from_numpy(mm[begin: begin + nbytes].view(storage).reshape(info['shape']))
+        tensors[name] = tensor.view(torch.bfloat16) if info['dtype'] == 'bfloat16' else tensor
+    return tensors
+
+
+def assign_tensors(module: nn.Module, tensors: Dict[str, T]) -> None:
+    '''
+    load_state_dict without the copy: the parameters and buffers of module
+    become the given tensors themselves.
+    '''
+    expected = set(module.state_dict())
+    if expected != set(tensors):
+        raise ValueError(f'missing {sorted(expected - set(tensors))}, unexpected {sorted(set(tensors) - expected)}')
+    params = dict(module.named_parameters())
+    for name, tensor in tensors.items():
+        *path, leaf = name.split('.')
+        owner = module
+        for attr in path:
+            owner = getattr(owner, attr)
+        # setattr, so that nn.LSTM refreshes its flat weight list
+        if name in params:
+            setattr(owner, leaf, nn.Parameter(tensor, requires_grad=False))
+        else:
+            setattr(owner, leaf, tensor)
+
+
+def export_encoder(init_checkpoint: str, output: str, dtype: str = 'float32') -> Dict[str, float]:
+    '''
+    Encoder-only inference checkpoint of a run.py save directory: output/WEIGHTS
+    (save_tensors) and output/config.json with the ENCODER_KEYS of its config.
+    '''
+    with open(os.path.join(init_checkpoint, 'config.json'), 'r') as fjson:
+        config = json.load(fjson)
+    if config.get('quantized'):
+        raise ValueError(f'{init_checkpoint} is quantized, export the fp32 checkpoint')
+    checkpoint = torch.load(os.path.join(init_checkpoint, 'checkpoint'), map_location='cpu')
+    tensors = {name[len('encoder.'):]: tensor for name, tensor in checkpoint['model_state_dict'].items()
+               if name.startswith('encoder.')}
+    os.makedirs(output, exist_ok=True)
+    save_tensors(tensors, os.path.join(output, WEIGHTS), dtype)
+    config = {key: config[key] for key in ENCODER_KEYS if key in config}
+    config.setdefault('word2id', 28996)
+    with open(os.path.join(output, 'config.json'), 'w') as fjson:
+        json.dump({**config, 'dtype': dtype}, fjson)
+    return {'checkpoint_mb': os.path.getsize(os.path.join(init_checkpoint, 'checkpoint')) / 2 ** 20,
+            'weights_mb': os.path.getsize(os.path.join(output, WEIGHTS)) / 2 ** 20}
+
+
+def load_encoder(path: str, device: str = 'cpu', dtype: Optional[str] = None) -> nn.Module:
+    '''
+    Encoder of an export_encoder directory in eval mode, its weights mapped from
+    the file without a copy when they stay on cpu in their stored dtype.
+    :param dtype: cast the weights (a copy), e.g. float32 for a float16 export
+    '''
+    with open(os.path.join(path, 'config.json'), 'r') as fjson:
+        config = argparse.Namespace(**json.load(fjson))
+    encoder = Model.build_encoder(config)
+    assign_tensors(encoder, map_tensors(os.path.join(path, WEIGHTS)))
+    if dtype is not None:
+        encoder = encoder.to(getattr(torch, dtype))
+    return encoder.to(device).eval()
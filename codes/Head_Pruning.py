@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-17
+
+import os
+import copy
+import json
+import time
+import itertools
+from typing import List, Dict, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+import Model
+from NNLayers.Pruned_Attention import PrunedSelfAttention
+from Inference import load_model, load_config, read_corpus, _tokenize_item, token_budget_batches, \
+    encode_batches
+
+
+def convert_heads(encoder: Model.TransformerEncoder) -> Model.TransformerEncoder:
+    '''
+    Replace the nn.MultiheadAttention of every layer by the equivalent
+    PrunedSelfAttention, in place, and record its head numbers in layer_heads.
+    '''
+    for layer in encoder.enc_layer.layers:
+        if isinstance(layer.self_attn, nn.MultiheadAttention):
+            layer.self_attn = PrunedSelfAttention.from_multihead(layer.self_attn)
+    encoder.layer_heads = [layer.self_attn.num_heads for layer in encoder.enc_layer.layers]
+    return encoder
+
+
+def embed(model: Model.PEmodel, sents: List[List[int]], batches: List[List[int]]) -> np.ndarray:
+    # the encoder alone: d_model embeddings, whatever the model was loaded from
+    out = np.empty((len(sents), model.encoder.d_model), dtype=np.float32)
+    encode_batches(model, sents, batches, out)
+    return out
+
+
+def mean_cosine(x: np.ndarray, y: np.ndarray) -> float:
+    return float(np.mean(np.sum(x * y, axis=1) / np.maximum(
+        np.linalg.norm(x, axis=1) * np.linalg.norm(y, axis=1), 1e-12)))
+
+
+def head_importance(model: Model.PEmodel,
+                    sents: List[List[int]],
+                    batches: List[List[int]]) -> List[List[float]]:
+    '''
+    Importance of every head of a convert_heads encoder by ablation: one minus
+    the mean cosine similarity of the sentence embeddings with and without the
+    head (its output masked) to the full model ones.
+    :return: num_layer lists of num_heads importances
+    '''
+    reference = embed(model, sents, batches)
+    importance: List[List[float]] = []
+    for layer in model.encoder.enc_layer.layers:
+        attn = layer.self_attn
+        scores = []
+        for head in range(attn.num_heads):
+            attn.head_mask[head] = 0
+            scores.append(1 - mean_cosine(embed(model, sents, batches), reference))
+            attn.head_mask[head] = 1
+        importance.append(scores)
+    return importance
+
+
+def prune_heads(encoder: Model.TransformerEncoder,
+                importance: List[List[float]],
+                ratio: float) -> List[int]:
+    '''
+    Remove the ratio of heads of lowest importance over all the layers of a
+    convert_heads encoder, in place, keeping at least one head per layer.
+    :return: the number of heads left in every layer
+    '''
+    ranked = sorted((score, l, h) for l, scores in enumerate(importance) for h, score in enumerate(scores))
+    left = [len(scores) for scores in importance]
+    removed = set()
+    for _, l, h in ranked:
+        if len(removed) >= int(ratio * len(ranked)):
+            break
+        if left[l] > 1:
+            removed.add((l, h))
+            left[l] -= 1
+    for l, layer in enumerate(encoder.enc_layer.layers):
+        keep = [h for h in range(len(importance[l])) if (l, h) not in removed]
+        layer.self_attn = layer.self_attn.prune(keep)
+    encoder.layer_heads = left
+    return left
+
+
+def prune_checkpoint(init_checkpoint: str,
+                     output: str,
+                     corpus: str,
+                     ratio: float = 0.5,
+                     curve_ratios: Tuple[float, ...] = (0., 0.25, 0.5, 0.75),
+                     num_sample: int = 1000,
+                     max_tokens: int = 8192) -> Dict[str, object]:
+    '''
+    Score the attention heads of a transformer save directory on the first
+    num_sample sentences of a held-out corpus, prune the ratio of least
+    important ones and save the result to output (its config.json gets the
+    layer_heads of build_encoder, so load_model loads it).
+    The throughput (sentences/sec) and quality (mean cosine similarity to the
+    unpruned embeddings) of every ratio of curve_ratios are measured on the same
+    sentences and saved to output/pruning_curve.json.
+    :return: importance, layer_heads and curve
+    '''
+    args = load_config(init_checkpoint)
+    if args.encoder_type != 'transformer':
+        raise ValueError(f'head pruning needs a transformer encoder, got {args.encoder_type}')
+    if getattr(args, 'quantized', None) or not os.path.exists(os.path.join(init_checkpoint, 'checkpoint')):
+        raise ValueError(f'{init_checkpoint} is not a fp32 run.py save directory')
+    model = load_model(init_checkpoint)
+    convert_heads(model.encoder)
+    sents = [_tokenize_item(sent) for _, sent in itertools.islice(read_corpus(corpus), num_sample)]
+    batches = token_budget_batches([len(_) for _ in sents], max_tokens)
+    reference = embed(model, sents, batches)
+    importance = head_importance(model, sents, batches)
+
+    curve = []
+    for r in sorted(set(curve_ratios) | {ratio}):
+        pruned = copy.deepcopy(model)
+        layer_heads = prune_heads(pruned.encoder, importance, r)
+        embed(pruned, sents, batches[:1])
+        start = time.perf_counter()
+        embs = embed(pruned, sents, batches)
+        elapsed = time.perf_counter() - start
+        curve.append({'ratio': r,
+                      'heads': sum(layer_heads),
+                      'sent_per_sec': len(sents) / max(elapsed, 1e-9),
+                      'cosine': mean_cosine(embs, reference)})
+        if r == ratio:
+            saved, saved_heads = pruned, layer_heads
+
+    os.makedirs(output, exist_ok=True)
+    config = vars(args)
+    config['layer_heads'] = saved_heads
+    with open(os.path.join(output, 'config.json'), 'w') as fjson:
+        json.dump(config, fjson)
+    torch.save({'model_state_dict': saved.state_dict()}, os.path.join(output, 'checkpoint'))
+    with open(os.path.join(output, 'pruning_curve.json'), 'w') as fjson:
+        json.dump({'importance': importance, 'curve': curve}, fjson, indent=1)
+    return {'importance': importance, 'layer_heads': saved_heads, 'curve': curve}
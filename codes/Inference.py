@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-08
+
+import io
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import struct
+import resource
+import argparse
+import itertools
+import threading
+import multiprocessing as mp
+from typing import List, Tuple, Dict, Iterator, Optional
+
+import numpy as np
+import torch
+from torch import Tensor as T
+
+import Model
+import Flat_Checkpoint
+
+# one tokenizer per process, built on first use
+_tokenizer = None
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        from transformers import BertTokenizer
+        _tokenizer = BertTokenizer.from_pretrained("bert-base-cased", do_lower_case=True)
+    return _tokenizer
+
+
+def tokenize(s: str) -> List[int]:
+    '''
+    Token ids of a sentence, as Dataset_Sub.TextDataset.convert2list
+    '''
+    s_tokens = s.rstrip().split()
+    if len(s_tokens) > 50:
+        s = " ".join(s_tokens[:50])
+    tokenizer = get_tokenizer()
+    return tokenizer.convert_tokens_to_ids(tokenizer.tokenize("[CLS] " + s + " [SEP]"))
+
+
+def load_config(init_checkpoint: str) -> argparse.Namespace:
+    with open(os.path.join(init_checkpoint, 'config.json'), 'r') as fjson:
+        argparse_dict = json.load(fjson)
+    argparse_dict.setdefault('word2id', 28996)
+    return argparse.Namespace(**argparse_dict)
+
+
+def quantize_encoder(encoder: torch.nn.Module) -> torch.nn.Module:
+    '''
+    Dynamic int8 quantization of the Linear and LSTM layers of an encoder (CPU):
+    weights are stored in int8, activations are quantized on the fly.
+    The attention input projections of nn.TransformerEncoderLayer are parameters
+    of the attention and stay fp32.
+    '''
+    return torch.quantization.quantize_dynamic(encoder, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+
+
+def load_model(init_checkpoint: str, device: str = 'cpu') -> Model.PEmodel:
+    '''
+    PEmodel of a run.py save directory (config.json + checkpoint), in eval mode.
+    The encoder of a quantize_checkpoint directory is quantized before loading.
+    A Flat_Checkpoint.export_encoder directory gives a PEmodel with its mapped
+    encoder only, enough for PEmodel.encode.
+    '''
+    if os.path.exists(os.path.join(init_checkpoint, Flat_Checkpoint.WEIGHTS)):
+        return Model.PEmodel(Flat_Checkpoint.load_encoder(init_checkpoint, device), None, None).eval()
+    args = load_config(init_checkpoint)
+    model = Model.build_model(args, None)
+    if getattr(args, 'quantized', None):
+        if device != 'cpu':
+            raise ValueError(f'{init_checkpoint} is a quantized checkpoint, which only runs on cpu')
+        model.encoder = quantize_encoder(model.encoder)
+    checkpoint = torch.load(os.path.join(init_checkpoint, 'checkpoint'), map_location=device)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.to(device).eval()
+
+
+def read_corpus(path: str) -> Iterator[Tuple[str, object]]:
+    '''
+    (id, sentence) pairs of a corpus, the sentence being either a string or
+    already a list of token ids.
+    A text file holds one sentence per line, its id is the line number.
+    A packed corpus is a Dataset_Sub split directory of <i>.json documents,
+    the id of a sentence is <i>:<position>; the src_idx token ids are used
+    when the document was already tokenized.
+    '''
+    if os.path.isdir(path):
+        names = sorted((name for name in os.listdir(path) if name.endswith('.json')),
+                       key=lambda name: int(name[: -len('.json')]))
+        for name in names:
+            doc = name[: -len('.json')]
+            for i, sent in enumerate(read_document(os.path.join(path, name))):
+                yield f'{doc}:{i}', sent
+    else:
+        with open(path) as f:
+            for i, line in enumerate(f):
+                yield str(i), line
+
+
+def _tokenize_item(sent):
+    return sent if isinstance(sent, list) else tokenize(sent)
+
+
+def tokenize_corpus(sents: List[object], num_workers: int) -> List[List[int]]:
+    '''
+    Token ids of every sentence, tokenized by a pool of num_workers processes
+    '''
+    if num_workers <= 1:
+        return [_tokenize_item(sent) for sent in sents]
+    with mp.get_context('spawn').Pool(num_workers) as pool:
+        return pool.map(_tokenize_item, sents, chunksize=256)
+
+
+def token_budget_batches(lens: List[int], max_tokens: int) -> List[List[int]]:
+    '''
+    Indices sorted by length and grouped so that every padded batch holds at
+    most max_tokens tokens (a longer sentence is a batch on its own).
+    '''
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    for i in sorted(range(len(lens)), key=lambda x: lens[x]):
+        if batch and lens[i] * (len(batch) + 1) > max_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def pad_sents(sents: List[List[int]]) -> Tuple[T, T, List[int]]:
+    src_lens = [len(_) for _ in sents]
+    padded_src = torch.zeros(len(sents), max(src_lens)).long()
+    mask_src = torch.zeros(len(sents), max(src_lens)).long()
+    for i, sent in enumerate(sents):
+        padded_src[i, :src_lens[i]] = torch.LongTensor(sent)
+        mask_src[i, :src_lens[i]] = 1
+    return padded_src, mask_src, src_lens
+
+
+def encode_batches(model: Model.PEmodel,
+                   token_ids: List[List[int]],
+                   batches: List[List[int]],
+                   out: np.ndarray,
+                   device: str = 'cpu') -> None:
+    '''
+    Encode the sentences of every batch and write them to their rows of out
+    '''
+    for batch in batches:
+        src, mask, lens = pad_sents([token_ids[i] for i in batch])
+        reps = Model.PEmodel.encode(model, src.to(device), mask.to(device), {'src': lens})
+        out[np.asarray(batch)] = reps.float().cpu().numpy()
+
+
+def parse_documents(model: Model.PEmodel,
+                    documents: List[List[object]],
+                    device: str = 'cpu') -> List[List[int]]:
+    '''
+    Binary discourse tree of every document, given as a list of sentences
+    (strings or token ids), encoded as one batch.
+    :return: one parent array of 2 x num_sent - 1 nodes per document: nodes
+        0 .. num_sent - 1 are the sentences, node num_sent + k is the split
+        between sentences k and k + 1, the root has parent -1
+    '''
+    sents = [_tokenize_item(sent) for doc in documents for sent in doc]
+    src, mask, lens = pad_sents(sents)
+    rep_idx, start = [], 0
+    for doc in documents:
+        rep_idx.append(list(range(start, start + len(doc))))
+        start += len(doc)
+    return Model.PEmodel.parse(model, src.to(device), mask.to(device), rep_idx, {'src': lens})
+
+
+def read_document(path: str) -> List[object]:
+    '''
+    Sentences of a dataset <i>.json document, token ids when already tokenized
+    '''
+    with open(path) as f:
+        js = json.load(f)
+    if 'src_idx' in js:
+        return js['src_idx']
+    return js['article'] if 'article' in js else js['src']
+
+
+def read_ahead(items: Iterator, size: int) -> Iterator:
+    '''
+    Iterate over items produced by a background thread, at most size of them
+    ahead of the consumer.
+    '''
+    buffer: queue.Queue = queue.Queue(maxsize=size)
+    end = object()
+
+    def produce():
+        try:
+            for item in items:
+                buffer.put(item)
+        except Exception as e:
+            buffer.put(e)
+        buffer.put(end)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is end:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+class TreeShardWriter(object):
+    '''
+    Append-only parent-pointer trees of one shard with a progress marker.
+    jsonl: one {"doc": i, "parent": [...]} line per document.
+    bin: per document a little endian int64 doc id, uint32 number of nodes
+    and as many int32 parents.
+    The marker <shard>.progress records the next document and the size of the
+    output once it is flushed to disk. On restart the output is truncated back to
+    that size, dropping trees written after the last marker, and the shard
+    resumes from that document.
+    '''
+    def __init__(self, path: str, fmt: str, first_doc: int) -> None:
+        assert fmt in ['jsonl', 'bin']
+        self.path = f'{path}.{fmt}'
+        self.progress_path = f'{path}.progress'
+        self.fmt = fmt
+        self.next_doc, size, self.done = first_doc, 0, False
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path) as f:
+                progress = json.load(f)
+            self.next_doc, size, self.done = progress['next_doc'], progress['bytes'], progress['done']
+        self.file = open(self.path, 'r+b' if os.path.exists(self.path) else 'w+b')
+        self.file.truncate(size)
+        self.file.seek(size)
+
+    def write(self, doc: int, parent: List[int]) -> None:
+        if self.fmt == 'jsonl':
+            self.file.write(json.dumps({'doc': doc, 'parent': parent}, separators=(',', ':')).encode() + b'\n')
+        else:
+            self.file.write(struct.pack('<qI', doc, len(parent)) + np.asarray(parent, dtype='<i4').tobytes())
+
+    def commit(self, next_doc: int, done: bool = False) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.next_doc, self.done = next_doc, done
+        tmp = self.progress_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'next_doc': next_doc, 'bytes': self.file.tell(), 'done': done}, f)
+        os.replace(tmp, self.progress_path)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_tree_shard(path: str) -> Iterator[Tuple[int, List[int]]]:
+    '''
+    (doc, parent) pairs of a .jsonl or .bin shard of TreeShardWriter
+    '''
+    if path.endswith('.jsonl'):
+        with open(path) as f:
+            for line in f:
+                js = json.loads(line)
+                yield js['doc'], js['parent']
+        return
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(12)
+            if len(header) < 12:
+                return
+            doc, num_nodes = struct.unpack('<qI', header)
+            yield doc, np.frombuffer(f.read(4 * num_nodes), dtype='<i4').tolist()
+
+
+def parse_shard(model: Model.PEmodel,
+                split_dir: str,
+                docs: List[int],
+                output: str,
+                fmt: str = 'jsonl',
+                batch_docs: int = 32,
+                prefetch: int = 4,
+                cores: Optional[List[int]] = None) -> int:
+    '''
+    Parse the documents docs of a split into the shard output, resuming from its
+    progress marker. Batches of documents are read and tokenized by a background
+    thread, at most prefetch batches ahead.
+    :return: number of documents parsed by this call
+    '''
+    if cores is not None:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+    writer = TreeShardWriter(output, fmt, docs[0] if docs else 0)
+    if writer.done:
+        writer.close()
+        return 0
+    todo = [doc for doc in docs if doc >= writer.next_doc]
+
+    def batches():
+        for start in range(0, len(todo), batch_docs):
+            ids = todo[start: start + batch_docs]
+            yield ids, [[_tokenize_item(sent) for sent in read_document(os.path.join(split_dir, f'{i}.json'))]
+                        for i in ids]
+
+    num_parsed = 0
+    for ids, documents in read_ahead(batches(), prefetch):
+        full = [k for k, doc in enumerate(documents) if doc]
+        trees = parse_documents(model, [documents[k] for k in full]) if full else []
+        parents: Dict[int, List[int]] = dict(zip(full, trees))
+        for k, doc in enumerate(ids):
+            writer.write(doc, parents.get(k, []))
+        num_parsed += len(ids)
+        writer.commit(ids[-1] + 1)
+    writer.commit(docs[-1] + 1 if docs else 0, done=True)
+    writer.close()
+    return num_parsed
+
+
+def parse_corpus(init_checkpoint: str,
+                 split_dir: str,
+                 output_dir: str,
+                 num_shards: int = 1,
+                 fmt: str = 'jsonl',
+                 batch_docs: int = 32,
+                 prefetch: int = 4) -> Dict[str, float]:
+    '''
+    Parse every <i>.json document of a dataset split into discourse trees.
+    Documents are split into num_shards contiguous ranges, each parsed by its
+    own process into output_dir/shard-<r>.<fmt>. The processes are forked after
+    the model is loaded in shared memory and pinned to disjoint core sets.
+    Rerunning the same command resumes unfinished shards.
+    :return: number of documents parsed by this run and documents/sec
+    '''
+    from Encoder_Pool import core_sets
+
+    os.makedirs(output_dir, exist_ok=True)
+    docs = sorted(int(name[: -len('.json')]) for name in os.listdir(split_dir) if name.endswith('.json'))
+    bounds = [len(docs) * r // num_shards for r in range(num_shards + 1)]
+    shards = [(docs[bounds[r]: bounds[r + 1]], os.path.join(output_dir, f'shard-{r:05d}'))
+              for r in range(num_shards)]
+    model = load_model(init_checkpoint)
+    start = time.perf_counter()
+    if num_shards == 1:
+        num_parsed = parse_shard(model, split_dir, shards[0][0], shards[0][1], fmt, batch_docs, prefetch)
+    else:
+        model.share_memory()
+        ctx = mp.get_context('fork')
+        counts = ctx.Queue()
+
+        def run(docs, output, cores):
+            counts.put(parse_shard(model, split_dir, docs, output, fmt, batch_docs, prefetch, cores))
+
+        procs = [ctx.Process(target=run, args=(docs, output, cores))
+                 for (docs, output), cores in zip(shards, core_sets(num_shards))]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        if any(p.exitcode != 0 for p in procs):
+            raise RuntimeError('a parsing process failed, rerun to resume')
+        num_parsed = sum(counts.get() for _ in procs)
+    elapsed = time.perf_counter() - start
+    return {'documents': num_parsed,
+            'shards': num_shards,
+            'docs_per_sec': num_parsed / max(elapsed, 1e-9),
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def state_dict_mb(module: torch.nn.Module) -> float:
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def quantize_checkpoint(init_checkpoint: str,
+                        output: str,
+                        corpus: str,
+                        num_sample: int = 1000,
+                        max_tokens: int = 8192,
+                        min_cosine: float = 0.99) -> Dict[str, float]:
+    '''
+    Save a copy of a run.py save directory to output with a dynamically int8
+    quantized encoder (load_model loads it on cpu), after comparing it with the
+    fp32 encoder on the first num_sample sentences of a held-out corpus:
+    encoder size, encoding throughput and the cosine similarity of the two
+    embeddings of every sentence.
+    :return: stats, 'passed' when the mean cosine is at least min_cosine
+    '''
+    if os.path.exists(os.path.join(init_checkpoint, Flat_Checkpoint.WEIGHTS)):
+        raise ValueError(f'{init_checkpoint} is an export-weights directory, quantize the run.py save directory')
+    d_model = load_config(init_checkpoint).d_model
+    model = load_model(init_checkpoint)
+    quantized = copy.deepcopy(model)
+    quantized.encoder = quantize_encoder(quantized.encoder)
+
+    sents = [_tokenize_item(sent) for _, sent in itertools.islice(read_corpus(corpus), num_sample)]
+    batches = token_budget_batches([len(_) for _ in sents], max_tokens)
+    stats: Dict[str, float] = {'sentences': len(sents)}
+    embs = {}
+    for name, m in [('fp32', model), ('int8', quantized)]:
+        embs[name] = np.empty((len(sents), d_model), dtype=np.float32)
+        # warm up on the first batch before timing a full pass
+        encode_batches(m, sents, batches[:1], embs[name])
+        start = time.perf_counter()
+        encode_batches(m, sents, batches, embs[name])
+        elapsed = time.perf_counter() - start
+        stats[f'{name}_sent_per_sec'] = len(sents) / max(elapsed, 1e-9)
+        stats[f'{name}_ms_per_batch'] = elapsed / len(batches) * 1000
+        stats[f'{name}_encoder_mb'] = state_dict_mb(m.encoder)
+    cosine = np.sum(embs['fp32'] * embs['int8'], axis=1) / np.maximum(
+        np.linalg.norm(embs['fp32'], axis=1) * np.linalg.norm(embs['int8'], axis=1), 1e-12)
+    stats['cosine_mean'] = float(cosine.mean())
+    stats['cosine_min'] = float(cosine.min())
+    stats['passed'] = stats['cosine_mean'] >= min_cosine
+
+    os.makedirs(output, exist_ok=True)
+    config = vars(load_config(init_checkpoint))
+    config['quantized'] = 'int8'
+    with open(os.path.join(output, 'config.json'), 'w') as fjson:
+        json.dump(config, fjson)
+    torch.save({'model_state_dict': quantized.state_dict()}, os.path.join(output, 'checkpoint'))
+    return stats
+
+
+def export_script(init_checkpoint: str, output: str) -> Dict[str, float]:
+    '''
+    Trace the encoder of a save directory (Model.ExportEncoder) into a
+    self-contained TorchScript file, with config.json embedded as an extra file.
+    It loads with load_scripted, without this code base or building the model,
+    and embeds token ids: scripted(src, mask) -> B x d_model.
+    The trace is checked on a batch of another shape than the traced one.
+    :return: largest absolute difference to the eager encoder on that batch
+    '''
+    model = load_model(init_checkpoint)
+    config = load_config(init_checkpoint)
+    export = Model.ExportEncoder(model.encoder).eval()
+    generator = torch.Generator().manual_seed(1101)
+
+    def example(lens):
+        return pad_sents([torch.randint(1, config.word2id, (n,), generator=generator).tolist() for n in lens])[:2]
+
+    traced_input, check_input = example([16, 7, 12, 3]), example([9, 25, 5])
+    with torch.no_grad():
+        scripted = torch.jit.trace(export, traced_input, check_inputs=[check_input])
+        diff = (scripted(*check_input) - export(*check_input)).abs().max().item()
+    torch.jit.save(scripted, output, _extra_files={'config.json': json.dumps(vars(config))})
+    return {'max_abs_diff': diff, 'size_mb': os.path.getsize(output) / 2 ** 20}
+
+
+def load_scripted(path: str, device: str = 'cpu') -> torch.jit.ScriptModule:
+    '''
+    Encoder of export_script, in eval mode
+    '''
+    return torch.jit.load(path, map_location=device).eval()
+
+
+def peak_rss_mb() -> float:
+    '''
+    Peak resident memory of this process and of its finished children, in MiB
+    '''
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return rss / 2 ** 20 if sys.platform == 'darwin' else rss / 2 ** 10
+
+
+def embed_corpus(init_checkpoint: str,
+                 corpus: str,
+                 output: str,
+                 max_tokens: int = 8192,
+                 num_workers: int = 4,
+                 num_procs: int = 1,
+                 device: str = 'cpu',
+                 cache_dir: Optional[str] = None) -> Dict[str, float]:
+    '''
+    Embed every sentence of corpus with the encoder of a checkpoint.
+    The embeddings go to <output>.npy (num_sent x d_model float32, preallocated
+    and filled through a memory map), the sentence ids to <output>.ids, one per
+    line in row order.
+    :param num_workers: tokenization processes
+    :param num_procs: encoding processes of an Encoder_Pool.EncoderPool, forked
+        from this one with the weights in shared memory and pinned to disjoint
+        core sets; a single process is used on GPU
+    :param cache_dir: disk tier of an Embedding_Cache.EmbeddingCache, only the
+        sentences not embedded by a previous run with the same checkpoint are
+        encoded (in a single process)
+    :return: number of sentences, sentences/sec of the encoding and peak RSS
+    '''
+    ids, sents = zip(*read_corpus(corpus))
+    start = time.perf_counter()
+    token_ids = tokenize_corpus(list(sents), num_workers)
+    tokenize_time = time.perf_counter() - start
+    batches = token_budget_batches([len(_) for _ in token_ids], max_tokens)
+
+    out_path = output if output.endswith('.npy') else output + '.npy'
+    with open(out_path[: -len('.npy')] + '.ids', 'w') as f:
+        f.writelines(f'{i}\n' for i in ids)
+    d_model = load_config(init_checkpoint).d_model
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32,
+                                    shape=(len(token_ids), d_model))
+
+    start = time.perf_counter()
+    if cache_dir is not None:
+        from Embedding_Cache import EmbeddingCache
+        cache = EmbeddingCache(load_model(init_checkpoint, device), cache_dir=cache_dir,
+                               max_tokens=max_tokens, device=device)
+        for batch in batches:
+            out[np.asarray(batch)] = cache.encode([token_ids[i] for i in batch])
+        out.flush()
+    elif num_procs <= 1 or device != 'cpu':
+        encode_batches(load_model(init_checkpoint, device), token_ids, batches, out, device)
+        out.flush()
+    else:
+        from Encoder_Pool import EncoderPool
+        # loaded once, before the fork
+        with EncoderPool(load_model(init_checkpoint), num_procs) as pool:
+            for batch, reps in pool.imap_batches(token_ids, batches):
+                out[np.asarray(batch)] = reps
+        out.flush()
+    encode_time = time.perf_counter() - start
+    stats = {'sentences': len(token_ids),
+             'tokenize_sent_per_sec': len(token_ids) / max(tokenize_time, 1e-9),
+             'encode_sent_per_sec': len(token_ids) / max(encode_time, 1e-9),
+             'peak_rss_mb': peak_rss_mb()}
+    if cache_dir is not None:
+        stats['cache_hit_rate'] = cache.hit_rate
+        stats['cache_disk_bytes'] = cache.stats['disk_bytes']
+    return stats
@@ -3,6 +3,7 @@
 # author：Peng time:2019-07-16
 from typing import List, Tuple, Optional, Dict, Union, Callable
 from collections import namedtuple
+import copy
 import random
 
 import torch
@@ -10,12 +11,16 @@ import torch.nn as nn
 from torch.nn.utils.rnn import pack_padded_sequence as pack
 from torch.nn.utils.rnn import pad_packed_sequence as unpack
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch import Tensor as T
 import numpy as np
 
-from NNLayers.Embeddings import Embedding_Net, WordEmbedding, PositionalEncoding
+from NNLayers.Embeddings import Embedding_Net, WordEmbedding, PositionalEncoding, SeqEmbedding
+from NNLayers.utils.Transformer import TransformerEncoder as ChunkedTransformer
 from NNLayers.Gate_Net import Gate_Net, Score_Net
 from NNLayers.Predict_Net import Predic_Net
+from NNLayers.Memory_Bank import MemoryBank
+from NNLayers.Pruned_Attention import PrunedSelfAttention
 
 
 class TransformerEncoder(nn.Module):
@@ -25,7 +30,11 @@ class TransformerEncoder(nn.Module):
                  d_model,
                  nhead,
                  n_layer,
-                 dropout):
+                 dropout,
+                 cls_only=False,
+                 pack=False,
+                 checkpoint_activations=False,
+                 layer_heads=None):
         super(TransformerEncoder, self).__init__()
 
         # word emb layer
@@ -39,6 +48,11 @@ class TransformerEncoder(nn.Module):
             num_layers=n_layer,
             norm=nn.LayerNorm(d_model)
         )
+        # number of attention heads kept in every layer by Head_Pruning
+        self.layer_heads = layer_heads
+        if layer_heads is not None:
+            for layer, num_heads in zip(self.enc_layer.layers, layer_heads):
+                layer.self_attn = PrunedSelfAttention(d_model, num_heads, d_model // nhead, dropout)
 
         self.ffn = nn.Sequential(
             nn.Linear(d_model, d_model),
@@ -48,6 +62,12 @@ class TransformerEncoder(nn.Module):
         )
         self.emb_dim = emb_dim
         self.d_model = d_model
+        # the last layer and the ffn head only compute the CLS position
+        self.cls_only = cls_only
+        # pack several sentences per row instead of padding each of them
+        self.pack = pack
+        # recompute the layer outputs during backward instead of storing them
+        self.checkpoint_activations = checkpoint_activations
 
         if emb_dim != d_model:
             self.prejector = nn.Sequential(
@@ -60,12 +80,181 @@ class TransformerEncoder(nn.Module):
                 mask: T,
                 idx_list: Optional[List[List[int]]] = None,
                 length: Optional[List[str]] = None) -> Union[List[T], T]:
+        if self.pack:
+            rep = self.packed_forward(src, mask)
+        else:
+            rep = self.padded_forward(src, mask)
+        if idx_list:
+            rep = [torch.index_select(rep,
+                                      dim=0,
+                                      index=torch.LongTensor(idx).to(src.device)) for idx in idx_list]
+
+        return rep
+
+    def padded_forward(self, src: T, mask: T) -> T:
         rep = self.positionemb(self.wordemb(src)).permute(1, 0, 2)
         if self.emb_dim != self.d_model:
             rep = self.prejector(rep)
-        rep = self.ffn(self.enc_layer(
-            src=rep,
-            src_key_padding_mask=mask.eq(0))).permute(1, 0, 2)[:, 0, :]
+        if self.cls_only:
+            layers = self.enc_layer.layers
+            rep = self.run_layers(rep, layers[:-1], key_padding_mask=mask.eq(0))
+            rep = self.cls_layer(layers[-1], rep, mask.eq(0))
+            if self.enc_layer.norm is not None:
+                rep = self.enc_layer.norm(rep)
+            rep = self.ffn(rep[0])
+        else:
+            rep = self.run_layers(rep, self.enc_layer.layers, key_padding_mask=mask.eq(0))
+            if self.enc_layer.norm is not None:
+                rep = self.enc_layer.norm(rep)
+            rep = self.ffn(rep).permute(1, 0, 2)[:, 0, :]
+        return rep
+
+    def run_layers(self,
+                   rep: T,
+                   layers: nn.ModuleList,
+                   mask: Optional[T] = None,
+                   key_padding_mask: Optional[T] = None) -> T:
+        """
+        Same as the layer loop of nn.TransformerEncoder (without the final norm),
+        checkpointing every layer when training with checkpoint_activations.
+        :param mask: B x seq_len x seq_len attention mask, repeated for the heads
+            of every layer (their number differs once heads are pruned)
+        """
+        for layer in layers:
+            layer_mask = mask.repeat_interleave(layer.self_attn.num_heads, dim=0) if mask is not None else None
+            if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+                rep = checkpoint(layer, rep, layer_mask, key_padding_mask, use_reentrant=False)
+            else:
+                rep = layer(rep, src_mask=layer_mask, src_key_padding_mask=key_padding_mask)
+        return rep
+
+    def packed_forward(self, src: T, mask: T) -> T:
+        """
+        Sentences are packed first-fit-decreasing into rows as long as the longest
+        sentence. Attention is block diagonal over the sentences of a row and the
+        positions restart at every sentence, so the CLS vectors equal the padded
+        ones. The final layer always runs over every position here.
+        :param src: B x max_len, padding at the end of each sentence
+        :return: B x d_model
+        """
+        lens = mask.ne(0).sum(dim=1)
+        lens_list: List[int] = lens.tolist()
+        row_len = max(lens_list)
+        row_of = [0] * len(lens_list)
+        off_of = [0] * len(lens_list)
+        row_fill: List[int] = []
+        for i in sorted(range(len(lens_list)), key=lambda x: -lens_list[x]):
+            for r, fill in enumerate(row_fill):
+                if fill + lens_list[i] <= row_len:
+                    break
+            else:
+                r = len(row_fill)
+                row_fill.append(0)
+            row_of[i], off_of[i] = r, row_fill[r]
+            row_fill[r] += lens_list[i]
+        num_row = len(row_fill)
+        row_of = torch.LongTensor(row_of).to(src.device)
+        off_of = torch.LongTensor(off_of).to(src.device)
+
+        # token t of sentence i goes to row_of[i] at column off_of[i] + t
+        tok_sent = torch.repeat_interleave(torch.arange(lens.size(0), device=src.device), lens)
+        tok_pos = torch.arange(tok_sent.size(0), device=src.device) \
+            - torch.repeat_interleave(torch.cumsum(lens, dim=0) - lens, lens)
+        flat = row_of[tok_sent] * row_len + off_of[tok_sent] + tok_pos
+        packed = src.new_zeros(num_row * row_len)
+        packed[flat] = src[mask.ne(0)]
+        position = src.new_zeros(num_row * row_len)
+        position[flat] = tok_pos
+        segment = src.new_full((num_row * row_len,), -1)
+        segment[flat] = tok_sent
+        segment = segment.view(num_row, row_len)
+
+        rep = self.positionemb(self.wordemb(packed.view(num_row, row_len)),
+                               position=position.view(num_row, row_len)).permute(1, 0, 2)
+        if self.emb_dim != self.d_model:
+            rep = self.prejector(rep)
+        # padding positions form their own segment, so no row is fully masked
+        attn_mask = torch.zeros(num_row, row_len, row_len, device=src.device).masked_fill(
+            segment[:, :, None].ne(segment[:, None, :]), float('-inf'))
+        rep = self.run_layers(rep, self.enc_layer.layers, mask=attn_mask)
+        if self.enc_layer.norm is not None:
+            rep = self.enc_layer.norm(rep)
+        return self.ffn(rep.permute(1, 0, 2)[row_of, off_of])
+
+    @staticmethod
+    def cls_layer(layer: nn.TransformerEncoderLayer,
+                  rep: T,
+                  key_padding_mask: T) -> T:
+        """
+        nn.TransformerEncoderLayer computed for the CLS query only: the attention
+        keys/values still cover every token, the feed forward only sees CLS.
+        :param rep: seq_len x B x d_model
+        :return: 1 x B x d_model, equal to layer(rep)[:1]
+        """
+        cls = rep[:1]
+        if getattr(layer, 'norm_first', False):
+            x = layer.norm1(rep)
+            cls = cls + layer.dropout1(layer.self_attn(
+                x[:1], x, x,
+                key_padding_mask=key_padding_mask,
+                need_weights=False)[0])
+            cls = cls + layer.dropout2(layer.linear2(layer.dropout(
+                layer.activation(layer.linear1(layer.norm2(cls))))))
+        else:
+            cls = layer.norm1(cls + layer.dropout1(layer.self_attn(
+                cls, rep, rep,
+                key_padding_mask=key_padding_mask,
+                need_weights=False)[0]))
+            cls = layer.norm2(cls + layer.dropout2(layer.linear2(layer.dropout(
+                layer.activation(layer.linear1(cls))))))
+        return cls
+
+
+class LongTransformerEncoder(nn.Module):
+    """
+    Encoder for long units (e.g. whole paragraphs): NNLayers/utils/Transformer
+    with query-chunked attention and optional relative positions, followed by
+    the same CLS ffn head as TransformerEncoder.
+    """
+    def __init__(self,
+                 vocab,
+                 emb_dim,
+                 d_model,
+                 nhead,
+                 n_layer,
+                 dropout,
+                 max_relative_positions=0,
+                 q_chunk=0,
+                 k_chunk=0):
+        super(LongTransformerEncoder, self).__init__()
+        self.wordemb = WordEmbedding(vocab, emb_dim)
+        self.positionemb = PositionalEncoding(dropout, emb_dim)
+        self.enc_layer = ChunkedTransformer(
+            n_layer,
+            d_model,
+            nhead,
+            2048,
+            dropout,
+            SeqEmbedding(self.wordemb, self.positionemb, d_model),
+            max_relative_positions,
+            q_chunk,
+            k_chunk
+        )
+        self.ffn = nn.Sequential(
+            nn.Linear(d_model, d_model),
+            nn.ReLU(),
+            nn.Linear(d_model, d_model),
+            nn.LayerNorm(d_model)
+        )
+
+    def forward(self,
+                src: T,
+                mask: T,
+                idx_list: Optional[List[List[int]]] = None,
+                length: Optional[List[str]] = None) -> Union[List[T], T]:
+        # padding positions hold token 0, which the encoder masks itself
+        _, out, _ = self.enc_layer(src.masked_fill(mask.eq(0), 0).t()[:, :, None])
+        rep = self.ffn(out[0])
         if idx_list:
             rep = [torch.index_select(rep,
                                       dim=0,
@@ -119,13 +308,34 @@ class LSTMEncoder(nn.Module):
 
         return h
 
+class ExportEncoder(nn.Module):
+    """
+    Word embedding, encoder and CLS head of a PEmodel as a (src, mask) -> B x d_model
+    module for torch.jit.trace: no document indexing, no packing, and the LSTM
+    lengths are taken from the mask.
+    """
+    def __init__(self, encoder: nn.Module) -> None:
+        super(ExportEncoder, self).__init__()
+        if isinstance(encoder, LongTransformerEncoder):
+            raise ValueError('long_transformer chunks its attention by the sequence length '
+                             'in python and cannot be traced')
+        self.encoder = encoder
+
+    def forward(self, src: T, mask: T) -> T:
+        if isinstance(self.encoder, LSTMEncoder):
+            return self.encoder(src, mask, None, mask.ne(0).sum(dim=1).cpu())
+        return self.encoder.padded_forward(src, mask)
+
+
 class Parser(nn.Module):
     def __init__(self,
                  d_model,
                  dropout,
                  score_type,
                  resolution,
-                 hard):
+                 hard,
+                 checkpoint_activations=False,
+                 prefix_context=False):
         super(Parser, self).__init__()
         self.score_layer = Score_Net(
             d_model,
@@ -136,7 +346,9 @@ class Parser(nn.Module):
             d_model,
             dropout,
             resolution,
-            hard
+            hard,
+            checkpoint_activations,
+            prefix_context
         )
     def forward(self,
                 rep_srcs: List[T],
@@ -146,30 +358,137 @@ class Parser(nn.Module):
         return self.gate_layer(scores, rep_srcs, rep_idx, score_idx)
 
 
+class IncrementalContext(object):
+    """
+    Forward contexts of a document whose sentences arrive one at a time.
+    The context predicting sentence c + 1 is the gated mean of sentences
+    c, c - 1, ..., 0, as Predic_Net.compute_h on the Gate_Net forward gates:
+    sentence c - r weighs prod_{t < r} gate(s[c - 1 - t] - s[c]), where s[k] is
+    the Score_Net score between sentences k and k + 1. Every weight depends on
+    the newest score s[c], so a new sentence costs one score and one O(N)
+    cumprod and weighted sum over the cached reps and scores instead of the
+    O(N^2) gate and context squares of the whole document. With a window of K,
+    only the last K sentences are weighted and a new sentence costs O(K).
+    Backward contexts depend on later sentences and are not streamed.
+    """
+    def __init__(self,
+                 parser: Parser,
+                 window: Optional[int] = None,
+                 capacity: int = 64) -> None:
+        self.score_layer = parser.score_layer
+        self.gate_layer = parser.gate_layer
+        self.window = window
+        self.capacity = max(capacity, 2 * window) if window else capacity
+        self.reps: Optional[T] = None  # capacity x dim_hid, rows [0, size)
+        self.scores: Optional[T] = None  # capacity, s[k] between rows k and k + 1
+        self.size = 0
+        self.num_sents = 0
+
+    def push(self, rep: T) -> Optional[T]:
+        """
+        :param rep: (dim_hid,) representation of the next sentence
+        :return: (dim_hid,) context of the previous sentence that predicts this
+            one, before the predictor layernorm (a row of compute_h), None for
+            the first sentence
+        """
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            if self.reps is None:
+                self.reps = rep.new_zeros(self.capacity, rep.size(0))
+                self.scores = rep.new_zeros(self.capacity)
+            if self.size == self.reps.size(0):
+                self.grow()
+            self.reps[self.size] = rep
+            self.size += 1
+            self.num_sents += 1
+            if self.size == 1:
+                return None
+            c = self.size - 2
+            self.scores[c] = self.score_layer.parsing_score(self.reps[c: c + 1], rep[None, :])[0]
+            r = c if self.window is None else min(c, self.window - 1)
+            hat = self.scores[c - r: c].flip((0,))  # s[c - 1], ..., s[c - r]
+            gate = self.gate_layer.compute_prob(hat[None, :], self.scores[c: c + 1])[0]
+            weight = torch.cat((rep.new_ones(1), torch.cumprod(gate, dim=0)))
+            context = self.reps[c - r: c + 1].flip((0,))  # sentences c, c - 1, ..., c - r
+            return torch.sum(weight[:, None] * context, dim=0) / torch.sum(weight)
+
+    def grow(self) -> None:
+        if self.window is not None:
+            # only the last window sentences are read again: move them to the front
+            keep = self.window
+            self.reps[:keep] = self.reps[self.size - keep: self.size].clone()
+            self.scores[:keep - 1] = self.scores[self.size - keep: self.size - 1].clone()
+            self.size = keep
+            return
+        self.reps = torch.cat((self.reps, torch.zeros_like(self.reps)), dim=0)
+        self.scores = torch.cat((self.scores, torch.zeros_like(self.scores)), dim=0)
+
+
 class PEmodel(nn.Module):
     def __init__(self,
                  encoder,
                  parser,
                  predictor,
-                 loss_func=None):
+                 loss_func=None,
+                 bank=None,
+                 momentum=0.):
         super(PEmodel, self).__init__()
         self.encoder = encoder
         self.parser = parser
         self.predictor = predictor
         if loss_func:
             self.loss_func = loss_func
+        # negatives served from a queue of previous batches, encoded by a
+        # momentum copy of the encoder when momentum > 0.
+        self.bank = bank
+        self.momentum = momentum
+        if bank is not None and momentum > 0:
+            self.key_encoder = copy.deepcopy(encoder)
+            for p in self.key_encoder.parameters():
+                p.requires_grad = False
+        else:
+            self.key_encoder = None
     def forward(self,
                 input: T,
                 mask: T,
                 rep_idx: List[List[int]],
                 score_idx: List[List[int]],
-                neg_input: Tuple[T, T],
-                neg_mask: Tuple[T, T],
+                neg_input: Optional[Tuple[T, T]],
+                neg_mask: Optional[Tuple[T, T]],
                 length_dict: Dict[str, List[int]],
-                flag_quick: bool) -> Tuple[T, T, List[Tuple[T, T]]]:
-        reps: List[T] = self.encoder(input, mask, rep_idx, length_dict['src'])
-        neg_fwd: T = self.encoder(neg_input[0], neg_mask[0], None, length_dict['nf'])
-        neg_bwd: T = self.encoder(neg_input[1], neg_mask[1], None, length_dict['nb'])
+                flag_quick: bool,
+                sent_map: Optional[Dict[str, T]] = None) -> Tuple[T, T, List[Tuple[T, T]]]:
+        """
+        :param sent_map: set when the batch was collated with fuse=True: input/mask
+            then hold the unique sentences of the batch and sent_map['src'/'nf'/'nb']
+            the row of every src/nf/nb sentence among them.
+        """
+        neg_idx: Optional[Tuple[T, T]] = None
+        if sent_map is not None:
+            rep_all: T = self.encoder(input, mask, None, length_dict['src'])
+            rep_src = rep_all.index_select(0, sent_map['src'])
+            reps: List[T] = [torch.index_select(rep_src,
+                                                dim=0,
+                                                index=torch.LongTensor(idx).to(rep_src.device)) for idx in rep_idx]
+        else:
+            reps: List[T] = self.encoder(input, mask, rep_idx, length_dict['src'])
+        if sent_map is not None and 'nf' in sent_map:
+            neg_fwd: T = rep_all.index_select(0, sent_map['nf'])
+            neg_bwd: T = rep_all.index_select(0, sent_map['nb'])
+        elif self.bank is not None and len(self.bank) > 0:
+            neg_fwd, neg_bwd, neg_idx = self.bank_negatives(sum(rep.size(0) - 1 for rep in reps))
+        elif neg_input is None:
+            neg_fwd, neg_bwd, neg_idx = self.in_batch_negatives(reps)
+        else:
+            neg_fwd: T = self.encoder(neg_input[0], neg_mask[0], None, length_dict['nf'])
+            neg_bwd: T = self.encoder(neg_input[1], neg_mask[1], None, length_dict['nb'])
+        if self.bank is not None and self.training:
+            # enqueued after the negatives are drawn, so a batch never meets itself
+            if self.key_encoder is not None:
+                with torch.no_grad():
+                    keys = self.key_encoder(input, mask, None, length_dict['src'])
+            else:
+                keys = rep_all if sent_map is not None else torch.cat(reps, dim=0)
+            self.bank.enqueue(keys)
         gate_list: List[Tuple[T, T]] = self.parser(reps, rep_idx, score_idx)
 
         if self.predictor.score_type in ['denselinear', 'linear']:
@@ -178,7 +497,8 @@ class PEmodel(nn.Module):
                 gate_list,
                 neg_fwd,
                 neg_bwd,
-                flag_quick
+                flag_quick,
+                neg_idx
             )
             fwd_pos_label = torch.ones(
                 lld['fwd_pos'].size(0),
@@ -203,13 +523,29 @@ class PEmodel(nn.Module):
                 loss_pos = (loss_pos + self.loss_func(lld['bwd_pos'].squeeze(1), bwd_pos_label)) / 2
                 loss_neg = (loss_neg + self.loss_func(lld['bwd_neg'].squeeze(1), bwd_neg_label)) / 2
 
+        elif self.predictor.num_negatives > 0:
+            lld, mask = self.predictor(
+                reps,
+                gate_list,
+                neg_fwd,
+                neg_bwd,
+                flag_quick,
+                neg_idx
+            )
+            loss_pos, loss_neg = self.info_nce(lld['fwd_pos'], lld['fwd_neg'])
+            if self.predictor.bidirectional:
+                bwd_loss_pos, bwd_loss_neg = self.info_nce(lld['bwd_pos'], lld['bwd_neg'])
+                loss_pos = (loss_pos + bwd_loss_pos) / 2
+                loss_neg = (loss_neg + bwd_loss_neg) / 2
+
         else:
             lld, mask = self.predictor(
                 reps,
                 gate_list,
                 neg_fwd,
                 neg_bwd,
-                flag_quick
+                flag_quick,
+                neg_idx
             )
             loss_pos = -torch.mean(lld['fwd_pos'])
             loss_neg = -torch.mean(lld['fwd_neg'])
@@ -218,15 +554,134 @@ class PEmodel(nn.Module):
                 loss_neg = (loss_neg - torch.mean(lld['bwd_neg'])) / 2
         return (loss_pos, loss_neg, mask)
 
+    def in_batch_negatives(self, reps: List[T]) -> Tuple[T, T, Optional[Tuple[T, T]]]:
+        """
+        Negatives drawn from the sentences of the other documents of the batch,
+        so nf/nb never have to be encoded. Batches are expected to hold at least
+        two documents (batch_size >= 2); a batch of a single document falls back
+        to the other sentences of that document, never the positive itself.
+        :param reps: one num_sent x dim_hid tensor per document
+        :return: (neg_fwd, neg_bwd, neg_idx). With num_negatives > 0 both negative
+            tensors are the whole batch and neg_idx picks K rows of it per anchor,
+            otherwise they hold one sampled sentence per anchor and neg_idx is None.
+        """
+        pool = torch.cat(reps, dim=0)
+        num_neg = max(self.predictor.num_negatives, 1)
+        starts: List[int] = []
+        lens: List[int] = []
+        fwd_pos: List[int] = []
+        bwd_pos: List[int] = []
+        start = 0
+        for rep in reps:
+            # every document has num_sent - 1 anchors in each direction, the
+            # forward anchor k predicts row k + 1 and the backward one row num_sent - 2 - k
+            num_sent = rep.size(0)
+            starts += [start] * (num_sent - 1)
+            lens += [num_sent] * (num_sent - 1)
+            fwd_pos += list(range(start + 1, start + num_sent))
+            bwd_pos += list(range(start + num_sent - 2, start - 1, -1))
+            start += num_sent
+        starts = torch.LongTensor(starts).to(pool.device)[:, None]
+        lens = torch.LongTensor(lens).to(pool.device)[:, None]
+        # sample among the rows outside the anchor's document (skipping lens rows
+        # from its start), or for a single document, all its rows but the
+        # positive (skipping one row from the positive).
+        single = (pool.size(0) - lens).eq(0)
+        span = torch.where(single, lens - 1, pool.size(0) - lens)
+        shift = torch.where(single, torch.ones_like(lens), lens)
+
+        def sample(pos: List[int]) -> T:
+            skip = torch.where(single, torch.LongTensor(pos).to(pool.device)[:, None], starts)
+            idx = (torch.rand(starts.size(0), num_neg, device=pool.device) * span).long()
+            return idx + (idx >= skip).long() * shift
+
+        fwd_idx, bwd_idx = sample(fwd_pos), sample(bwd_pos)
+        if self.predictor.num_negatives > 0:
+            return pool, pool, (fwd_idx, bwd_idx)
+        return pool[fwd_idx[:, 0]], pool[bwd_idx[:, 0]], None
+
+    def bank_negatives(self, num_anchor: int) -> Tuple[T, T, Optional[Tuple[T, T]]]:
+        """
+        Negatives drawn from the memory bank, same return convention as
+        in_batch_negatives.
+        """
+        pool = self.bank.keys()
+        num_neg = max(self.predictor.num_negatives, 1)
+        fwd_idx, bwd_idx = self.bank.sample(num_anchor, num_neg), self.bank.sample(num_anchor, num_neg)
+        if self.predictor.num_negatives > 0:
+            return pool, pool, (fwd_idx, bwd_idx)
+        return pool[fwd_idx[:, 0]], pool[bwd_idx[:, 0]], None
+
+    @torch.no_grad()
+    def momentum_update(self) -> None:
+        """
+        key_encoder <- momentum * key_encoder + (1 - momentum) * encoder
+        """
+        for p_k, p_q in zip(self.key_encoder.parameters(), self.encoder.parameters()):
+            p_k.mul_(self.momentum).add_(p_q.detach(), alpha=1. - self.momentum)
+
+    @staticmethod
+    def info_nce(pos_logit: T, neg_logit: T) -> Tuple[T, T]:
+        """
+        Softmax over [positive, K negatives] with the positive as target.
+        The InfoNCE loss is split as loss_pos + loss_neg, where loss_pos pulls the
+        positive logit up and loss_neg is the log-partition over all candidates.
+        :param pos_logit: (N,)
+        :param neg_logit: N x K
+        """
+        logits = torch.cat((pos_logit[:, None], neg_logit), dim=1)
+        loss_pos = -torch.mean(pos_logit)
+        loss_neg = torch.mean(torch.logsumexp(logits, dim=1))
+        return (loss_pos, loss_neg)
+
     @staticmethod
     def encode(model,
                input: T,
                mask: T,
                length_dict: Dict[str, List[int]]) -> T:
         model.eval()
-        reps: T = model.encoder(input, mask, None, length_dict['src'])
+        # no autograd graph: inference_mode (torch >= 1.9) or no_grad
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            reps: T = model.encoder(input, mask, None, length_dict['src'])
         return reps
 
+    @staticmethod
+    def parse(model,
+              input: T,
+              mask: T,
+              rep_idx: List[List[int]],
+              length_dict: Dict[str, List[int]]) -> List[List[int]]:
+        """
+        Binary tree of every document from its Score_Net split scores.
+        :return: one parent array per document, see Gate_Net.distance_to_tree
+        """
+        model.eval()
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            reps: List[T] = model.encoder(input, mask, rep_idx, length_dict['src'])
+            return model.parser.score_layer.parsing(reps)
+
+    @staticmethod
+    def get_negatives(Tensor_dict: Dict[str, T],
+                      device='cuda') -> Tuple[Optional[Tuple[T, T]], Optional[Tuple[T, T]]]:
+        """
+        nf/nb tensors of a collated batch, (None, None) when the batch was
+        collated without them for in-batch negatives.
+        """
+        if 'nf' not in Tensor_dict:
+            return (None, None)
+        return ((Tensor_dict['nf'].to(device), Tensor_dict['nb'].to(device)),
+                (Tensor_dict['mnf'].to(device), Tensor_dict['mnb'].to(device)))
+
+    @staticmethod
+    def get_sent_map(Tensor_dict: Dict[str, T], device='cuda') -> Optional[Dict[str, T]]:
+        """
+        Rows of the src/nf/nb sentences in a batch collated with fuse=True.
+        """
+        if 'src_map' not in Tensor_dict:
+            return None
+        return {key[: -len('_map')]: value.to(device)
+                for key, value in Tensor_dict.items() if key.endswith('_map')}
+
     @staticmethod
     def train_step(model,
                    optimizer,
@@ -241,21 +696,26 @@ class PEmodel(nn.Module):
         if istep > args.quick_thought_step:
             flag_quick = False
 
+        neg_input, neg_mask = PEmodel.get_negatives(Tensor_dict)
+
         pos_loss, neg_loss, gate_list = model(
             Tensor_dict['src'].cuda(),
             Tensor_dict['mask_src'].cuda(),
             idx_dict['rep_idx'],
             idx_dict['score_idx'],
-            (Tensor_dict['nf'].cuda(), Tensor_dict['nb'].cuda()),
-            (Tensor_dict['mnf'].cuda(), Tensor_dict['mnb'].cuda()),
+            neg_input,
+            neg_mask,
             length_dict,
-            flag_quick
+            flag_quick,
+            PEmodel.get_sent_map(Tensor_dict)
         )
         loss = (pos_loss + neg_loss) / 2
         loss.backward()
         torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_grad_norm)
         optimizer.step()
         scheduler.step()
+        if model.key_encoder is not None:
+            model.momentum_update()
         # if istep == 1000:
         #     for x in gate_list:
         #         print(f"gate is: \n{x[0]}")
@@ -274,15 +734,18 @@ class PEmodel(nn.Module):
                   data,
                   args):
         model.eval()
-        Tensor_dict, token_dict, idx_dict, length_dict = data
+        Tensor_dict, idx_dict, length_dict = data
+        neg_input, neg_mask = PEmodel.get_negatives(Tensor_dict)
         pos_loss, neg_loss, gate_list = model(
             Tensor_dict['src'].cuda(),
             Tensor_dict['mask_src'].cuda(),
             idx_dict['rep_idx'],
             idx_dict['score_idx'],
-            (Tensor_dict['nf'].cuda(), Tensor_dict['nb'].cuda()),
-            (Tensor_dict['mnf'].cuda(), Tensor_dict['mnb'].cuda()),
+            neg_input,
+            neg_mask,
             length_dict,
+            False,
+            PEmodel.get_sent_map(Tensor_dict)
             #idx_dict['neg_idx']
         )
         loss = (pos_loss + neg_loss) / 2
@@ -296,7 +759,7 @@ class PEmodel(nn.Module):
 
         return log
 
-def build_model(para, weight=None):
+def build_encoder(para, weight=None):
     if para.encoder_type == 'transformer':
         encoder = TransformerEncoder(
             para.word2id,
@@ -304,7 +767,23 @@ def build_model(para, weight=None):
             para.d_model,
             para.nhead,
             para.n_layer,
-            para.dropout
+            para.dropout,
+            getattr(para, 'cls_only', False),
+            getattr(para, 'pack', False),
+            getattr(para, 'checkpoint_activations', False),
+            getattr(para, 'layer_heads', None)
+        )
+    elif para.encoder_type == 'long_transformer':
+        encoder = LongTransformerEncoder(
+            para.word2id,
+            para.emb_dim,
+            para.d_model,
+            para.nhead,
+            para.n_layer,
+            para.dropout,
+            para.max_relative_positions,
+            para.attn_q_chunk,
+            para.attn_k_chunk
         )
     elif para.encoder_type == 'LSTM':
         if para.bidirectional:
@@ -322,25 +801,39 @@ def build_model(para, weight=None):
         )
 
     encoder.wordemb.apply_weights(weight)
+    return encoder
+
+
+def build_model(para, weight=None):
+    encoder = build_encoder(para, weight)
 
     parser = Parser(
         para.d_model,
         para.dropout,
         para.score_type_parser,
         para.resolution,
-        para.hard
+        para.hard,
+        getattr(para, 'checkpoint_activations', False),
+        getattr(para, 'prefix_context', False)
     )
 
     predictor = Predic_Net(
         para.d_model,
         para.score_type_predictor,
-        para.bidirectional_compute
+        para.bidirectional_compute,
+        getattr(para, 'num_negatives', 0),
+        getattr(para, 'checkpoint_activations', False),
+        parser.gate_layer.prefix_context
     )
     if para.score_type_predictor in ['denselinear', 'linear']:
         loss_func = nn.NLLLoss()
     else:
         loss_func = None
-    return PEmodel(encoder, parser, predictor, loss_func)
+    if getattr(para, 'negatives', 'corpus') == 'memory_bank':
+        bank = MemoryBank(para.bank_size, para.d_model)
+    else:
+        bank = None
+    return PEmodel(encoder, parser, predictor, loss_func, bank, getattr(para, 'bank_momentum', 0.))
 
 def get_idx_by_lens(lens_list: List[int]) -> List[List[int]]:
     idx_list: List[List[int]] = []
@@ -8,7 +8,6 @@ import warnings
 
 import torch
 from torch import Tensor as T
-from allennlp.common.checks import ConfigurationError
 
 
 StateType = Dict[str, T]  # pylint: disable=invalid-name
@@ -19,6 +18,13 @@ class BeamSearch:
     """
     Implements the beam search algorithm for decoding the most likely sequences.
 
+    Batch rows whose beams have all emitted ``end_index`` are dropped from the
+    following steps, so the step function only sees the unfinished rows. The
+    state is not reordered after every step: the beam backpointers and the row
+    compaction are composed into one index, applied to each state tensor right
+    before the next call of the step function, and skipped when it is the
+    identity or when the search stops.
+
     Parameters
     ----------
     end_index : ``int``
@@ -73,15 +79,18 @@ class BeamSearch:
         start_state : ``StateType``
             The initial state passed to the ``step`` function. Each value of the state dict
             should be a tensor of shape ``(batch_size, *)``, where ``*`` means any other
-            number of dimensions.
+            number of dimensions, or an object with a ``reorder(index)`` method selecting
+            its batch rows in place, like ``MultiHeadedAttention.KVCache``.
         step : ``StepFunctionType``
             A function that is responsible for computing the next most likely tokens,
             given the current state and the predictions from the last time step.
             The function should accept two arguments. The first being a tensor
             of shape ``(group_size,)``, representing the index of the predicted
             tokens from the last time step, and the second being the current state.
-            The ``group_size`` will be ``batch_size * beam_size``, except in the initial
-            step, for which it will just be ``batch_size``.
+            The ``group_size`` will be ``num_active * beam_size``, where ``num_active``
+            is the number of batch rows not finished yet, except in the initial
+            step, for which it will just be ``batch_size``. A state tensor that
+            identifies the batch row of each group row is kept aligned with it.
             The function is expected to return a tuple, where the first element
             is a tensor of shape ``(group_size, target_vocab_size)`` containing
             the log probabilities of the tokens for the next step, and the second
@@ -93,9 +102,11 @@ class BeamSearch:
         Tuple[torch.Tensor, torch.Tensor]
             Tuple of ``(predictions, log_probabilities)``, where ``predictions``
             has shape ``(batch_size, beam_size, max_steps)`` and ``log_probabilities``
-            has shape ``(batch_size, beam_size)``.
+            has shape ``(batch_size, beam_size)``. Rows that finished early are
+            padded with ``end_index``.
         """
         batch_size = start_predictions.size()[0]
+        device = start_predictions.device
 
         # List of (batch_size, beam_size) tensors. One for each time step. Does not
         # include the start symbols, which are implicit.
@@ -106,12 +117,6 @@ class BeamSearch:
         # predictions[t-1][i][n], that it came from.
         backpointers: List[T] = []
 
-        # Calculate the first timestep. This is done outside the main loop
-        # because we are going from a single decoder input (the output from the
-        # encoder) to the top `beam_size` decoder outputs. On the other hand,
-        # within the main loop we are going from the `beam_size` elements of the
-        # beam to `beam_size`^2 candidates from which we will select the top
-        # `beam_size` elements for the next iteration.
         # shape: (batch_size, num_classes)
         start_class_log_probabilities, state = step(start_predictions, start_state)
 
@@ -119,9 +124,9 @@ class BeamSearch:
 
         # Make sure `per_node_beam_size` is not larger than `num_classes`.
         if self.per_node_beam_size > num_classes:
-            raise ConfigurationError(f"Target vocab size ({num_classes:d}) too small "
-                                     f"relative to per_node_beam_size ({self.per_node_beam_size:d}).\n"
-                                     f"Please decrease beam_size or per_node_beam_size.")
+            raise ValueError(f"Target vocab size ({num_classes:d}) too small "
+                             f"relative to per_node_beam_size ({self.per_node_beam_size:d}).\n"
+                             f"Please decrease beam_size or per_node_beam_size.")
 
         # shape: (batch_size, beam_size), (batch_size, beam_size)
         start_top_log_probabilities, start_predicted_classes = \
@@ -132,121 +137,94 @@ class BeamSearch:
                           RuntimeWarning)
             return start_predicted_classes.unsqueeze(-1), start_top_log_probabilities
 
-        # The log probabilities for the last time step.
+        # The log probabilities for the last time step, of every batch row.
         # shape: (batch_size, beam_size)
         last_log_probabilities = start_top_log_probabilities
 
         # shape: [(batch_size, beam_size)]
         predictions.append(start_predicted_classes)
 
-        # Log probability tensor that mandates that the end token is selected.
-        # shape: (batch_size * beam_size, num_classes)
-        log_probs_after_end = start_class_log_probabilities.new_full(
-                (batch_size * self.beam_size, num_classes),
-                float("-inf")
-        )
-        log_probs_after_end[:, self._end_index] = 0.
+        # Batch rows still decoded, and the rows of the current state that the
+        # next step needs, i.e. every batch row repeated beam_size times.
+        # shape: (num_active,), (num_active * beam_size,)
+        active = torch.arange(batch_size, device=device)
+        pending = active.repeat_interleave(self.beam_size)
+        num_state_rows = batch_size
 
-        # Set the same state for each element in the beam.
-        for key, state_tensor in state.items():
-            _, *last_dims = state_tensor.size()
-            # shape: (batch_size * beam_size, *)
-            state[key] = state_tensor.\
-                    unsqueeze(1).\
-                    expand(batch_size, self.beam_size, *last_dims).\
-                    reshape(batch_size * self.beam_size, *last_dims)
+        # Backpointers of the rows that are not decoded anymore.
+        # shape: (batch_size, beam_size)
+        identity_backpointer = torch.arange(self.beam_size, device=device).expand(batch_size, self.beam_size)
 
         for timestep in range(self.max_steps - 1):
-            # shape: (batch_size * beam_size,)
-            last_predictions = predictions[-1].reshape(batch_size * self.beam_size)
-
-            # If every predicted token from the last step is `self._end_index`,
-            # then we can stop early.
-            if (last_predictions == self._end_index).all():
-                break
+            # shape: (num_active, beam_size)
+            last_predictions = predictions[-1].index_select(0, active)
+
+            # Drop the batch rows whose beams all predicted `self._end_index`; their
+            # beams could only be extended with the end token at no cost.
+            finished = (last_predictions == self._end_index).all(dim=1)
+            if finished.any():
+                keep = (~finished).nonzero().squeeze(1)
+                if keep.numel() == 0:
+                    break
+                active = active.index_select(0, keep)
+                last_predictions = last_predictions.index_select(0, keep)
+                pending = pending.view(-1, self.beam_size).index_select(0, keep).view(-1)
+            num_active = active.size(0)
+
+            # Apply the reordering deferred from the last step, at most once per tensor.
+            state = self._reorder_state(state, pending, num_state_rows)
+            num_state_rows = pending.size(0)
 
             # Take a step. This get the predicted log probs of the next classes
             # and updates the state.
-            # shape: (batch_size * beam_size, num_classes)
+            # shape: (num_active * beam_size,), (num_active * beam_size, num_classes)
+            last_predictions = last_predictions.reshape(num_active * self.beam_size)
             class_log_probabilities, state = step(last_predictions, state)
 
-            # shape: (batch_size * beam_size, num_classes)
-            last_predictions_expanded = last_predictions.unsqueeze(-1).expand(
-                    batch_size * self.beam_size,
-                    num_classes
-            )
-
-            # Here we are finding any beams where we predicted the end token in
-            # the previous timestep and replacing the distribution with a
-            # one-hot distribution, forcing the beam to predict the end token
-            # this timestep as well.
-            # shape: (batch_size * beam_size, num_classes)
-            cleaned_log_probabilities = torch.where(
-                    last_predictions_expanded == self._end_index,
-                    log_probs_after_end,
-                    class_log_probabilities
-            )
-
-            # shape (both): (batch_size * beam_size, per_node_beam_size)
+            # Force the beams that predicted the end token in the previous timestep
+            # to predict it again, at no cost.
+            # shape: (num_active * beam_size, num_classes)
+            ended = (last_predictions == self._end_index).unsqueeze(-1)
+            cleaned_log_probabilities = class_log_probabilities.masked_fill(ended, float("-inf"))
+            cleaned_log_probabilities[:, self._end_index].masked_fill_(ended.squeeze(-1), 0.)
+
+            # shape (both): (num_active * beam_size, per_node_beam_size)
             top_log_probabilities, predicted_classes = \
                 cleaned_log_probabilities.topk(self.per_node_beam_size)
 
-            # Here we expand the last log probabilities to (batch_size * beam_size, per_node_beam_size)
-            # so that we can add them to the current log probs for this timestep.
-            # This lets us maintain the log probability of each element on the beam.
-            # shape: (batch_size * beam_size, per_node_beam_size)
-            expanded_last_log_probabilities = last_log_probabilities.\
-                    unsqueeze(2).\
-                    expand(batch_size, self.beam_size, self.per_node_beam_size).\
-                    reshape(batch_size * self.beam_size, self.per_node_beam_size)
-
-            # shape: (batch_size * beam_size, per_node_beam_size)
-            summed_top_log_probabilities = top_log_probabilities + expanded_last_log_probabilities
-
-            # shape: (batch_size, beam_size * per_node_beam_size)
-            reshaped_summed = summed_top_log_probabilities.\
-                    reshape(batch_size, self.beam_size * self.per_node_beam_size)
-
-            # shape: (batch_size, beam_size * per_node_beam_size)
-            reshaped_predicted_classes = predicted_classes.\
-                    reshape(batch_size, self.beam_size * self.per_node_beam_size)
+            # Add the log probability of each element on the beam.
+            # shape: (num_active, beam_size * per_node_beam_size)
+            reshaped_summed = (top_log_probabilities.view(num_active, self.beam_size, -1)
+                               + last_log_probabilities.index_select(0, active).unsqueeze(2)).\
+                    reshape(num_active, self.beam_size * self.per_node_beam_size)
 
             # Keep only the top `beam_size` beam indices.
-            # shape: (batch_size, beam_size), (batch_size, beam_size)
+            # shape: (num_active, beam_size), (num_active, beam_size)
             restricted_beam_log_probs, restricted_beam_indices = reshaped_summed.topk(self.beam_size)
 
             # Use the beam indices to extract the corresponding classes.
-            # shape: (batch_size, beam_size)
-            restricted_predicted_classes = reshaped_predicted_classes.gather(1, restricted_beam_indices)
-
-            predictions.append(restricted_predicted_classes)
-
-            # shape: (batch_size, beam_size)
-            last_log_probabilities = restricted_beam_log_probs
+            # shape: (num_active, beam_size)
+            restricted_predicted_classes = predicted_classes.\
+                    reshape(num_active, self.beam_size * self.per_node_beam_size).\
+                    gather(1, restricted_beam_indices)
 
             # The beam indices come from a `beam_size * per_node_beam_size` dimension where the
             # indices with a common ancestor are grouped together. Hence
-            # dividing by per_node_beam_size gives the ancestor. (Note that this is integer
-            # division as the tensor is a LongTensor.)
-            # shape: (batch_size, beam_size)
-            backpointer = restricted_beam_indices / self.per_node_beam_size
-
-            backpointers.append(backpointer)
-
-            # Keep only the pieces of the state tensors corresponding to the
-            # ancestors created this iteration.
-            for key, state_tensor in state.items():
-                _, *last_dims = state_tensor.size()
-                # shape: (batch_size, beam_size, *)
-                expanded_backpointer = backpointer.\
-                        view(batch_size, self.beam_size, *([1] * len(last_dims))).\
-                        expand(batch_size, self.beam_size, *last_dims)
-
-                # shape: (batch_size * beam_size, *)
-                state[key] = state_tensor.\
-                        reshape(batch_size, self.beam_size, *last_dims).\
-                        gather(1, expanded_backpointer).\
-                        reshape(batch_size * self.beam_size, *last_dims)
+            # dividing by per_node_beam_size gives the ancestor.
+            # shape: (num_active, beam_size)
+            backpointer = restricted_beam_indices // self.per_node_beam_size
+
+            # Scatter back into batch_size rows, finished rows keep their beams.
+            predictions.append(restricted_predicted_classes.new_full(
+                (batch_size, self.beam_size), self._end_index
+            ).index_copy_(0, active, restricted_predicted_classes))
+            backpointers.append(identity_backpointer.index_copy(0, active, backpointer))
+            last_log_probabilities = last_log_probabilities.index_copy(0, active, restricted_beam_log_probs)
+
+            # Rows of the state of the ancestors, applied before the next step.
+            # shape: (num_active * beam_size,)
+            pending = (backpointer + self.beam_size * torch.arange(
+                num_active, device=device).unsqueeze(1)).view(-1)
 
         if not torch.isfinite(last_log_probabilities).all():
             warnings.warn("Infinite log probabilities encountered. Some final sequences may not make sense. "
@@ -258,32 +236,49 @@ class BeamSearch:
         # shape: [(batch_size, beam_size, 1)]
         reconstructed_predictions = [predictions[-1].unsqueeze(2)]
 
-        # shape: (batch_size, beam_size)
-        cur_backpointers = backpointers[-1]
+        if backpointers:
+            # shape: (batch_size, beam_size)
+            cur_backpointers = backpointers[-1]
 
-        for timestep in range(len(predictions) - 2, 0, -1):
-            # shape: (batch_size, beam_size, 1)
-            cur_preds = predictions[timestep].gather(1, cur_backpointers).unsqueeze(2)
+            for timestep in range(len(predictions) - 2, 0, -1):
+                # shape: (batch_size, beam_size, 1)
+                cur_preds = predictions[timestep].gather(1, cur_backpointers).unsqueeze(2)
 
-            reconstructed_predictions.append(cur_preds)
+                reconstructed_predictions.append(cur_preds)
 
-            # shape: (batch_size, beam_size)
-            cur_backpointers = backpointers[timestep - 1].gather(1, cur_backpointers)
+                # shape: (batch_size, beam_size)
+                cur_backpointers = backpointers[timestep - 1].gather(1, cur_backpointers)
 
-        # shape: (batch_size, beam_size, 1)
-        final_preds = predictions[0].gather(1, cur_backpointers).unsqueeze(2)
+            # shape: (batch_size, beam_size, 1)
+            final_preds = predictions[0].gather(1, cur_backpointers).unsqueeze(2)
 
-        reconstructed_predictions.append(final_preds)
+            reconstructed_predictions.append(final_preds)
 
         # shape: (batch_size, beam_size, max_steps)
         all_predictions = torch.cat(list(reversed(reconstructed_predictions)), 2)
 
         return all_predictions, last_log_probabilities
 
+    @staticmethod
+    def _reorder_state(state: StateType, index: T, num_rows: int) -> StateType:
+        """
+        Select the rows ``index`` of every state value, unless it keeps all
+        ``num_rows`` rows in place.
+        """
+        if index.size(0) == num_rows and torch.equal(index, torch.arange(num_rows, device=index.device)):
+            return state
+        for key, state_tensor in state.items():
+            if hasattr(state_tensor, 'reorder'):
+                # e.g. MultiHeadedAttention.KVCache, reordered in place
+                state_tensor.reorder(index)
+            else:
+                state[key] = state_tensor.index_select(0, index)
+        return state
+
 
 def test():
     pass
 
 
 if __name__ == "__main__":
-    test()
\ No newline at end of file
+    test()
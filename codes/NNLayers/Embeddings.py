@@ -42,7 +42,8 @@ class PositionalEncoding(nn.Module):
 
     def forward(self,
                 emb: T,
-                step: Optional[int]=None) -> T:
+                step: Optional[int]=None,
+                position: Optional[T]=None) -> T:
         """Embed inputs.
 
         Args:
@@ -50,10 +51,15 @@ class PositionalEncoding(nn.Module):
                 ``(batch_size, seq_len, self.dim)``
             step (int or NoneType): If stepwise (``seq_len = 1``), use
                 the encoding for this position.
+            position (LongTensor or NoneType): position of every token
+                ``(batch_size, seq_len)``, e.g. restarting at 0 for each
+                sentence packed in a row.
         """
 
         emb = emb * math.sqrt(self.dim)
-        if step is None:
+        if position is not None:
+            emb = emb + self.pe[0, position]
+        elif step is None:
             emb = emb + self.pe[:, :emb.size(1), :]
         else:
             emb = emb + self.pe[:, step, :]
@@ -101,4 +107,33 @@ class Embedding_Net(nn.Module):
         self.positionemb = position_emb
 
     def forward(self, input: T) -> T:
-        return self.positionemb(self.wordemb(input))
\ No newline at end of file
+        return self.positionemb(self.wordemb(input))
+
+
+class SeqEmbedding(nn.Module):
+    """
+    Embedding_Net for the onmt style encoders of NNLayers/utils: takes the
+    time-major ``(src_len, batch, nfeat)`` input they expect and returns
+    ``(src_len, batch, d_model)``, projecting the embeddings when emb_dim != d_model.
+    """
+    def __init__(self, word_emb, position_emb, d_model):
+        super(SeqEmbedding, self).__init__()
+        self.wordemb = word_emb
+        self.positionemb = position_emb
+        self.word_padding_idx = word_emb.lut.padding_idx
+        if word_emb.dim != d_model:
+            self.prejector = nn.Sequential(
+                nn.Linear(word_emb.dim, d_model),
+                nn.ReLU(),
+            )
+        else:
+            self.prejector = None
+
+    def forward(self, src: T) -> T:
+        emb = self.positionemb(self.wordemb(src[:, :, 0].transpose(0, 1)))
+        if self.prejector is not None:
+            emb = self.prejector(emb)
+        return emb.transpose(0, 1)
+
+    def update_dropout(self, dropout):
+        self.positionemb.dropout.p = dropout
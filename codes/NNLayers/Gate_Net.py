@@ -3,10 +3,12 @@
 # author：Peng time:2019-08-21
 
 from typing import List, Tuple, Callable
+import bisect
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch import Tensor as T
 import numpy as np
 
@@ -65,23 +67,41 @@ class Score_Net(nn.Module):
         return score.squeeze(-1).squeeze(-1) # (B x seq)
 
     def parsing(self,
-                rep_srcs: List[T],
-                rep_tgts: List[T]):
+                rep_srcs: List[T]) -> List[List[int]]:
         """
-        :param rep_srcs:
-        :param rep_tgts:
-        :return:
+        Binary tree of every document, split top-down at the weakest link:
+        the split distance between sentences k and k + 1 is -score[k + 1].
+        :param rep_srcs: one num_sent x dim_hid tensor per document
+        :return: one parent array of 2 x num_sent - 1 nodes per document,
+            see distance_to_tree
         """
-        assert len(rep_srcs) == len(rep_tgts)
-        pass
-
+        score = self.parsing_score(
+            torch.cat(tuple(map(self.cat_h, rep_srcs)), dim=0),
+            torch.cat(tuple(map(self.cat_t, rep_srcs)), dim=0)
+        ).tolist()
+        trees: List[List[int]] = []
+        start = 0
+        for rep in rep_srcs:
+            doc_score = score[start: start + rep.size(0) + 1]
+            trees.append(distance_to_tree([-x for x in doc_score[1: -1]]))
+            start += rep.size(0) + 1
+        return trees
 
     def parsing_score(self,
                       src: T,
-                      tgt: T):
+                      tgt: T) -> T:
+        """
+        Scores of forward without dropout.
+        :param src: N x dim_hid, e.g. cat_h of the sentences of a document
+        :param tgt: N x dim_hid, e.g. cat_t of them
+        :return: (N,) score of every (src[i], tgt[i]) pair
+        """
         assert src.size(1) == tgt.size(1)
-        pass
-
+        if self.score_type == 'bilinear':
+            score = self.func(src[:, None, :], tgt[:, None, :])
+        else:
+            score = self.func(src[:, None, :], tgt[:, :, None])
+        return score.squeeze(-1).squeeze(-1)
 
     def cat_h(self, rep: T) -> T:
         """
@@ -123,17 +143,59 @@ class Score_Net(nn.Module):
             )
 
 
+def distance_to_tree(distance: List[float]) -> List[int]:
+    """
+    Binary tree of n leaves from the n - 1 split distances between them
+    (syntactic distance): the largest distance is the root split, and the two
+    sides are split recursively the same way. Built in O(n) as the max
+    Cartesian tree of the distances with a stack; of equal distances the
+    leftmost split is the highest.
+    :param distance: n - 1 distances, distance[k] between leaves k and k + 1
+    :return: parent array of the 2n - 1 nodes: leaves are 0 .. n - 1, the
+        split between leaves k and k + 1 is node n + k, the root has parent -1
+    """
+    n = len(distance) + 1
+    parent = [-1] * (2 * n - 1)
+    stack: List[int] = []
+    for k, d in enumerate(distance):
+        last = -1
+        while stack and distance[stack[-1]] < d:
+            last = stack.pop()
+        if last >= 0:
+            # the popped chain is the left subtree of split k
+            parent[n + last] = n + k
+        if stack:
+            parent[n + k] = n + stack[-1]
+        stack.append(k)
+    # a leaf hangs from the lower of its two adjacent splits, the later one on ties
+    for i in range(n):
+        left = i - 1 if i > 0 else None
+        right = i if i < n - 1 else None
+        if left is None and right is None:
+            continue
+        if right is None or (left is not None and distance[left] < distance[right]):
+            parent[i] = n + left
+        else:
+            parent[i] = n + right
+    return parent
+
+
 class Gate_Net(nn.Module):
     def __init__(self,
                  dim_in: int,
                  dropout: float,
                  resolution: float,
-                 hard: bool) -> None:
+                 hard: bool,
+                 checkpoint_activations: bool = False,
+                 prefix_context: bool = False) -> None:
         super(Gate_Net, self).__init__()
         self.dim = dim_in
         self.dropout = dropout
         self.resolution = resolution
         self.hard = hard
+        self.checkpoint_activations = checkpoint_activations
+        # at inference, hand span starts to Predic_Net instead of the N x N gates
+        self.prefix_context = prefix_context and bool(hard)
         self.Dropout = nn.Dropout(dropout)
 
     def forward(self,
@@ -149,9 +211,15 @@ class Gate_Net(nn.Module):
                                    torch.LongTensor(idx_list).to(score.device)
                 )
             )
+        if self.prefix_context and not self.training:
+            return [self.spans(score) for score in score_by_doc]
         gate_list: List[Tuple[T, T]] = []
         for score in score_by_doc:
-            gate_list.append(self.compute_gate(score))
+            if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+                # the N x N gate intermediates are recomputed during backward
+                gate_list.append(checkpoint(self.compute_gate, score, use_reentrant=False))
+            else:
+                gate_list.append(self.compute_gate(score))
         return gate_list
 
     def pad_score(self, score: T) -> T:
@@ -192,6 +260,37 @@ class Gate_Net(nn.Module):
         bwd_gate = torch.cumprod(bwd_gate, dim=0)  # seq x seq - 1
         return (fwd_gate, bwd_gate)
 
+    def spans(self, score: T) -> Tuple[T, T]:
+        """
+        Hard gates as span boundaries. The forward context of sentence c weighs
+        sentence c - r by prod_{t < r} gate(s[c - 1 - t] - s[c]), with every hard
+        gate 0 or 1 once the scores are resolution apart. The weights are then 1
+        back to the nearest k < c with gate(s[k] - s[c]) < 1/2, i.e.
+        s[k] < s[c] - resolution / 2, and 0 before it: the context is the mean of
+        sentences k + 1 .. c. The nearest such k is found for every c with a stack
+        of increasing scores, O(N log N) in all.
+        :param score: (N + 1) scores of a document, as for compute_gate
+        :return: (fwd_start, bwd_start), (N - 1) first sentences of the spans of
+            the forward contexts, and of the backward ones in flipped order
+        """
+        score = score[1: -1].tolist()
+        return (torch.LongTensor(self.span_starts(score)),
+                torch.LongTensor(self.span_starts(score[::-1])))
+
+    def span_starts(self, score: List[float]) -> List[int]:
+        starts: List[int] = []
+        stack: List[int] = []  # indices of strictly increasing scores
+        values: List[float] = []
+        for c, s in enumerate(score):
+            k = bisect.bisect_left(values, s - self.resolution / 2) - 1
+            starts.append(stack[k] + 1 if k >= 0 else 0)
+            while values and values[-1] >= s:
+                stack.pop()
+                values.pop()
+            stack.append(c)
+            values.append(s)
+        return starts
+
     def cpt_gate(self, semantic_score: T) -> Tuple[T, T]:
         assert semantic_score.size()[0] > 4
         score = semantic_score[1 : -1] # (num_score - 2)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-05
+
+import torch
+import torch.nn as nn
+from torch import Tensor as T
+
+
+class MemoryBank(nn.Module):
+    """
+    Fixed size ring buffer of sentence representations from previous batches,
+    used as a queue of negatives (MoCo style). Memory is bounded by size x dim_hid.
+    The queue and its pointers are buffers, so they go to the checkpoint with
+    the model state_dict. The pointers are mirrored as python ints, so reading
+    them never waits for the device; the buffers are only synced from them.
+    """
+    def __init__(self,
+                 size: int,
+                 dim_hid: int) -> None:
+        super(MemoryBank, self).__init__()
+        self.size = size
+        self.dim_hid = dim_hid
+        self.register_buffer('queue', torch.zeros(size, dim_hid))
+        self.register_buffer('ptr', torch.zeros((), dtype=torch.long))
+        self.register_buffer('num_filled', torch.zeros((), dtype=torch.long))
+        self._ptr = 0
+        self._num_filled = 0
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super(MemoryBank, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        self._ptr = int(self.ptr)
+        self._num_filled = int(self.num_filled)
+
+    def __len__(self) -> int:
+        return self._num_filled
+
+    def keys(self) -> T:
+        """
+        :return: num_filled x dim_hid, the filled part of the queue
+        """
+        return self.queue[: len(self)]
+
+    @torch.no_grad()
+    def enqueue(self, keys: T) -> None:
+        """
+        Overwrite the oldest entries with keys.
+        :param keys: n x dim_hid, only the last `size` rows are kept if n > size
+        """
+        keys = keys.detach()[-self.size:]
+        idx = (torch.arange(keys.size(0), device=self.queue.device) + self._ptr) % self.size
+        self.queue.index_copy_(0, idx, keys.to(self.queue.dtype))
+        self._ptr = (self._ptr + keys.size(0)) % self.size
+        self._num_filled = min(self.size, self._num_filled + keys.size(0))
+        self.ptr.fill_(self._ptr)
+        self.num_filled.fill_(self._num_filled)
+
+    def sample(self, num_anchor: int, num_neg: int) -> T:
+        """
+        :return: num_anchor x num_neg rows of keys() drawn uniformly
+        """
+        return torch.randint(len(self), (num_anchor, num_neg), device=self.queue.device)
@@ -2,17 +2,20 @@
 # -*- coding: utf-8 -*-
 # author：Peng time:2019-09-21
 
-from typing import List, Tuple, Dict, Callable, Iterator
+from typing import List, Tuple, Dict, Callable, Iterator, Optional
 import functools
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torch import Tensor as T
 
 
 import numpy as np
 
+from NNLayers.Beam_search import BeamSearch
+
 StateType = Dict[str, T]  # pylint: disable=invalid-name
 StepFunctionType = Callable[[T, StateType], Tuple[T, StateType]]  # pylint: disable=invalid-name
 
@@ -34,11 +37,21 @@ class Predic_Net(nn.Module):
     def __init__(self,
                  dim_hid: int,
                  score_type: str,
-                 bidirectional: bool = False) -> None:
+                 bidirectional: bool = False,
+                 num_negatives: int = 0,
+                 checkpoint_activations: bool = False,
+                 prefix_context: bool = False) -> None:
         super(Predic_Net, self).__init__()
         self.dim_hid = dim_hid
         self.score_type = score_type
         self.bidirectional = bidirectional
+        if num_negatives > 0 and score_type not in ['dot', 'bilinear']:
+            raise ValueError(f'num_negatives is only supported by the dot and bilinear '
+                             f'scorers, got {score_type}')
+        self.num_negatives = num_negatives
+        self.checkpoint_activations = checkpoint_activations
+        # gate is given as Gate_Net.spans in eval mode, see compute_span_h
+        self.prefix_context = prefix_context
         if score_type == 'bilinear':
             self.func: Callable[[T, T], T] = nn.Bilinear(dim_hid, dim_hid, 1)
         elif score_type == 'dot':
@@ -56,7 +69,15 @@ class Predic_Net(nn.Module):
                 gate: List[Tuple[T, T]],
                 fwd_neg: T,
                 bwd_neg: T,
-                quick_thought: bool = False) -> Tuple[StateType, List[Tuple[T, T]]]:
+                quick_thought: bool = False,
+                neg_idx: Optional[Tuple[T, T]] = None) -> Tuple[StateType, List[Tuple[T, T]]]:
+        """
+        :param fwd_neg: negatives of the forward anchors, row-aligned with them,
+            or the pool the negatives are drawn from when neg_idx is given
+        :param bwd_neg: same for the backward anchors
+        :param neg_idx: (fwd, bwd) anchors x K indices into fwd_neg/bwd_neg,
+            only used with num_negatives > 0
+        """
         if quick_thought:
             fwd_h = self.layernorm(torch.cat(
                 [rep[:-1, :] for rep in rep_sents],
@@ -68,6 +89,26 @@ class Predic_Net(nn.Module):
             ))
             mask = None
 
+        elif self.prefix_context and not self.training:
+            mask = gate
+            doc_fwd, doc_bwd = zip(*[self.compute_span_h(rep, span[0], span[1])
+                                     for rep, span in zip(rep_sents, gate)])
+
+            fwd_h = self.layernorm(torch.cat(doc_fwd, dim=0))
+            bwd_h = self.layernorm(torch.cat(doc_bwd, dim=0))
+
+        elif self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            mask: List[Tuple[T, T]] = list(map(
+                self.mask_gate,
+                gate
+                ))
+            # the N x N x dim_hid context squares are rebuilt during backward
+            doc_fwd, doc_bwd = zip(*[checkpoint(self.compute_doc_h, rep, m[0], m[1], use_reentrant=False)
+                                     for rep, m in zip(rep_sents, mask)])
+
+            fwd_h = self.layernorm(torch.cat(doc_fwd, dim=0))
+            bwd_h = self.layernorm(torch.cat(doc_bwd, dim=0))
+
         else:
             fwd: List[T] = list(map(
                 self.get_sm,
@@ -108,7 +149,22 @@ class Predic_Net(nn.Module):
         #     dim=0
         # )
         fwd_neg, bwd_neg = self.layernorm(fwd_neg), self.layernorm(bwd_neg)
-        if self.score_type in ['denselinear', 'linear']:
+        if self.num_negatives > 0:
+            if neg_idx is None:
+                neg_idx = (self.sample_negatives(fwd_h.size(0), fwd_neg.size(0), fwd_h.device),
+                           self.sample_negatives(bwd_h.size(0), bwd_neg.size(0), bwd_h.device))
+            fp_lld, fn_lld = self.cpt_nce_logit(fwd_h, fwd_pos, fwd_neg, neg_idx[0])
+            if self.bidirectional:
+                bp_lld, bn_lld = self.cpt_nce_logit(bwd_h, bwd_pos, bwd_neg, neg_idx[1])
+        elif self.score_type == 'denselinear':
+            fp_logit, fn_logit = self.cpt_dense_logit(fwd_h, (fwd_pos, fwd_neg))
+            fp_lld = F.log_softmax(fp_logit, dim=-1)
+            fn_lld = F.log_softmax(fn_logit, dim=-1)
+            if self.bidirectional:
+                bp_logit, bn_logit = self.cpt_dense_logit(bwd_h, (bwd_pos, bwd_neg))
+                bp_lld = F.log_softmax(bp_logit, dim=-1)
+                bn_lld = F.log_softmax(bn_logit, dim=-1)
+        elif self.score_type == 'linear':
             fp_lld = F.log_softmax(self.cpt_logit(fwd_h, fwd_pos), dim=-1)
             fn_lld = F.log_softmax(self.cpt_logit(fwd_h, fwd_neg), dim=-1)
             if self.bidirectional:
@@ -155,7 +211,64 @@ class Predic_Net(nn.Module):
 
         return lld
 
-
+    def cpt_dense_logit(self, h: T, targets: Tuple[T, ...]) -> Tuple[T, ...]:
+        """
+        Decomposed 'denselinear' scorer, equal to ``cpt_logit`` but without
+        building the 4d-wide [h, t, h*t, |h-t|] tensor.
+        ``func.weight`` (2 x 4d) is split into one (2 x d) block per term, so the
+        h projection (and the bias) is computed once and shared by every target.
+        :param h: N x dim_hid
+        :param targets: tensors of N x dim_hid scored against the same h
+        :return: one N x 1 x 2 logit tensor per target
+        """
+        w_h, w_t, w_prod, w_diff = self.func.weight.split(self.dim_hid, dim=1)
+        h_proj = F.linear(h, w_h, self.func.bias)
+        logits = []
+        for t in targets:
+            lld = h_proj + F.linear(t, w_t) + F.linear(h * t, w_prod) \
+                + F.linear(torch.abs(h - t), w_diff)
+            logits.append(lld[:, None, :])
+        return tuple(logits)
+
+    def cpt_nce_logit(self,
+                      h: T,
+                      pos: T,
+                      pool: T,
+                      neg_idx: T) -> Tuple[T, T]:
+        """
+        Score every anchor against its positive and K negatives drawn from pool.
+        Only the K sampled pool rows are gathered, and the positive is scored
+        in the same batched product: N x (1 + K) dot products, not N x M.
+        :param h: N x dim_hid anchors
+        :param pos: N x dim_hid positives
+        :param pool: M x dim_hid negative candidates
+        :param neg_idx: N x K rows of pool used as negatives of each anchor
+        :return: (N,) positive logits and N x K negative logits
+        """
+        if self.score_type == 'bilinear':
+            query = torch.matmul(h, self.func.weight[0])
+            bias = self.func.bias
+        else:
+            query = h
+            bias = 0.
+        candidates = torch.cat((pos[:, None, :], pool[neg_idx]), dim=1)  # N x (1 + K) x dim_hid
+        logit = torch.bmm(candidates, query[:, :, None]).squeeze(2) + bias
+        return (logit[:, 0] / self.norm_factor, logit[:, 1:] / self.norm_factor)
+
+    def sample_negatives(self,
+                         num_anchor: int,
+                         pool_size: int,
+                         device: torch.device) -> T:
+        """
+        Column 0 is the negative aligned with the anchor (row i of the pool),
+        the other K - 1 columns are uniformly drawn from the remaining rows.
+        :return: num_anchor x K LongTensor
+        """
+        num_neg = min(self.num_negatives, pool_size)
+        aligned = torch.arange(num_anchor, device=device)[:, None]
+        others = torch.randint(max(pool_size - 1, 1), (num_anchor, num_neg - 1), device=device)
+        others = others + (others >= aligned).long()
+        return torch.cat((aligned, others), dim=1)
 
     def compute_h(self,
                   fwd: List[T],
@@ -179,14 +292,54 @@ class Predic_Net(nn.Module):
 
 
 
+    def compute_doc_h(self,
+                      rep: T,
+                      fwd_mask: T,
+                      bwd_mask: T) -> Tuple[T, T]:
+        """
+        compute_h for a single document, building its context squares itself.
+        """
+        doc_fwd, doc_bwd = self.compute_h(
+            [self.get_sm(rep)],
+            [self.get_sm(rep.flip((0, )))],
+            [(fwd_mask, bwd_mask)]
+        )
+        return (doc_fwd[0], doc_bwd[0])
+
+    def compute_span_h(self,
+                       rep: T,
+                       fwd_start: T,
+                       bwd_start: T) -> Tuple[T, T]:
+        """
+        compute_h for binary gates: every context is the mean of a contiguous
+        span of sentences, taken from prefix sums of the reps in O(N x dim_hid).
+        :param rep: N x dim_hid
+        :param fwd_start: (N - 1) first sentence of the span ending at sentence c
+        :param bwd_start: same for the flipped document
+        :return: (N - 1) x dim_hid forward and backward contexts
+        """
+        end = torch.arange(1, rep.size(0), device=rep.device)
+
+        def span_mean(x: T, start: T) -> T:
+            prefix = torch.cat((x.new_zeros(1, x.size(1)), torch.cumsum(x, dim=0)), dim=0)
+            start = start.to(x.device)
+            return (prefix[end] - prefix[start]) / (end - start).to(x.dtype)[:, None]
+
+        return (span_mean(rep, fwd_start), span_mean(rep.flip((0, )), bwd_start))
+
     def get_sm(self, rep: T) -> T:
+        """
+        :param rep: N x dim_hid
+        :return: (N - 1) x (N - 1) x dim_hid, [r, c] is rep[c - r] (zeros when
+            r > c), aligned with the [r, c] gates of mask_gate
+        """
         pad_rep = torch.cat(
             [torch.zeros(rep.size(0) - 2, rep.size(1)).to(rep.device), rep[:-1, :]],
             dim=0
         )
         square = torch.stack(
             [pad_rep[i: i+rep.size(0)-1, :].flip((0,)) for i in range(0, rep.size(0)-1)],
-            dim = 0
+            dim = 1
         )
         return square #
 
@@ -210,6 +363,31 @@ class Predic_Net(nn.Module):
                                       dim=0), 
                            diagonal=0)
                )
+    def transition_scores(self, rep: T) -> T:
+        """
+        Log likelihood that sentence j directly follows sentence i, with sentence
+        i alone as the context, scored by the same head as the training objective.
+        :param rep: N x dim_hid sentence representations of one document
+        :return: N x N
+        """
+        h = self.layernorm(rep)
+        if self.score_type in ['dot', 'bilinear']:
+            if self.score_type == 'bilinear':
+                logit = torch.mm(torch.matmul(h, self.func.weight[0]), h.t()) + self.func.bias
+            else:
+                logit = torch.mm(h, h.t())
+            return F.logsigmoid(logit / self.norm_factor)
+        if self.score_type == 'denselinear':
+            w_h, w_t, w_prod, w_diff = self.func.weight.split(self.dim_hid, dim=1)
+            logit = F.linear(h, w_h, self.func.bias)[:, None, :] + F.linear(h, w_t)[None, :, :] \
+                + F.linear(h[:, None, :] * h[None, :, :], w_prod) \
+                + F.linear(torch.abs(h[:, None, :] - h[None, :, :]), w_diff)
+        else:
+            w_h, w_t = self.func.weight.split(self.dim_hid, dim=1)
+            logit = F.linear(h, w_h, self.func.bias)[:, None, :] + F.linear(h, w_t)[None, :, :]
+        # class 1 is the positive (next sentence) label of the NLL loss
+        return F.log_softmax(logit, dim=-1)[:, :, 1]
+
     def init_para(self):
         if self.score_type == 'bilinear':
             nn.init.xavier_uniform_(
@@ -220,9 +398,53 @@ class Predic_Net(nn.Module):
             )
 
 
+def decode_order(predictor: Predic_Net,
+                 reps: List[T],
+                 beam_size: int = 5) -> Tuple[List[List[int]], T]:
+    """
+    Batched sentence ordering: beam search over the permutations of the sentences
+    of every document, maximizing the sum of ``predictor.transition_scores``
+    along the order. Documents that are done leave the search early.
+    :param reps: one num_sent x dim_hid tensor per document
+    :return: the best order of every document, as indices into its rows, and
+        the num_doc x beam_size scores of the final beams
+    """
+    num_doc = len(reps)
+    max_sent = max(rep.size(0) for rep in reps)
+    device = reps[0].device
+    # Classes are the sentences and end_index = max_sent, which also serves as
+    # the start token: row max_sent of the transitions is the uniform start.
+    trans = reps[0].new_zeros(num_doc, max_sent + 1, max_sent + 1)
+    num_sent = torch.LongTensor([rep.size(0) for rep in reps]).to(device)
+    for i, rep in enumerate(reps):
+        trans[i, : rep.size(0), : rep.size(0)] = predictor.transition_scores(rep)
+    padding = torch.arange(max_sent + 1, device=device)[None, :] >= num_sent[:, None]
+    padding[:, max_sent] = False
+
+    def step(last: T, state: StateType) -> Tuple[T, StateType]:
+        doc = state['doc']
+        used = state['used'].scatter(1, last[:, None], True)
+        used[:, max_sent] = False
+        done = used.sum(dim=1) >= num_sent.index_select(0, doc)
+        log_probs = trans[doc, last].masked_fill(used | padding.index_select(0, doc), float('-inf'))
+        log_probs[:, max_sent] = 0.
+        log_probs[:, max_sent].masked_fill_(~done, float('-inf'))
+        return log_probs, {'doc': doc, 'used': used}
+
+    beam = BeamSearch(max_sent, max_steps=max_sent + 1,
+                      beam_size=min(beam_size, max_sent + 1))
+    start = torch.full((num_doc,), max_sent, dtype=torch.long, device=device)
+    start_state = {'doc': torch.arange(num_doc, device=device),
+                   'used': torch.zeros(num_doc, max_sent + 1, dtype=torch.bool, device=device)}
+    with torch.no_grad():
+        predictions, log_probs = beam.search(start, start_state, step)
+    orders = [[i for i in predictions[d, 0].tolist() if i != max_sent] for d in range(num_doc)]
+    return orders, log_probs
+
+
 def test():
     pass
 
 
 if __name__ == "__main__":
-    test()
\ No newline at end of file
+    test()
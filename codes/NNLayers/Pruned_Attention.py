@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-16
+
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor as T
+
+
+class PrunedSelfAttention(nn.Module):
+    """
+    Drop-in replacement of the nn.MultiheadAttention of nn.TransformerEncoderLayer
+    with any number of heads of head_dim, so that the heads of a layer can be
+    removed: the in projection maps embed_dim to 3 x num_heads x head_dim and
+    the out projection maps num_heads x head_dim back to embed_dim.
+    The projections are nn.Linear modules, so quantize_dynamic also applies.
+    head_mask (not saved) scales the output of every head, for ablations.
+    """
+    def __init__(self,
+                 embed_dim: int,
+                 num_heads: int,
+                 head_dim: int,
+                 dropout: float = 0.) -> None:
+        super(PrunedSelfAttention, self).__init__()
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.inner_dim = num_heads * head_dim
+        self.dropout = dropout
+        # seq_len x batch x dim, as nn.MultiheadAttention, which also keeps
+        # nn.TransformerEncoderLayer off its fused fast path
+        self.batch_first = False
+        self.in_proj = nn.Linear(embed_dim, 3 * self.inner_dim)
+        self.out_proj = nn.Linear(self.inner_dim, embed_dim)
+        self.register_buffer('head_mask', torch.ones(num_heads), persistent=False)
+
+    @classmethod
+    def from_multihead(cls, attn: nn.MultiheadAttention) -> 'PrunedSelfAttention':
+        """
+        Same function as attn, with its weights
+        """
+        pruned = cls(attn.embed_dim, attn.num_heads, attn.head_dim, attn.dropout)
+        with torch.no_grad():
+            pruned.in_proj.weight.copy_(attn.in_proj_weight)
+            pruned.in_proj.bias.copy_(attn.in_proj_bias)
+            pruned.out_proj.weight.copy_(attn.out_proj.weight)
+            pruned.out_proj.bias.copy_(attn.out_proj.bias)
+        return pruned.to(attn.in_proj_weight.device)
+
+    def prune(self, keep: List[int]) -> 'PrunedSelfAttention':
+        """
+        :param keep: heads to keep
+        :return: the attention restricted to these heads
+        """
+        pruned = PrunedSelfAttention(self.embed_dim, len(keep), self.head_dim, self.dropout)
+        cols = torch.LongTensor([h * self.head_dim + j for h in keep for j in range(self.head_dim)])
+        rows = torch.cat([cols + part * self.inner_dim for part in range(3)])
+        with torch.no_grad():
+            pruned.in_proj.weight.copy_(self.in_proj.weight[rows.to(self.in_proj.weight.device)])
+            pruned.in_proj.bias.copy_(self.in_proj.bias[rows.to(self.in_proj.bias.device)])
+            pruned.out_proj.weight.copy_(self.out_proj.weight[:, cols.to(self.out_proj.weight.device)])
+            pruned.out_proj.bias.copy_(self.out_proj.bias)
+        return pruned.to(self.out_proj.bias.device)
+
+    def forward(self,
+                query: T,
+                key: T,
+                value: T,
+                key_padding_mask: Optional[T] = None,
+                need_weights: bool = False,
+                attn_mask: Optional[T] = None,
+                **kwargs) -> Tuple[T, None]:
+        """
+        Self attention (key is value); query may be a prefix of key, e.g. CLS.
+        :param query: len_q x B x embed_dim
+        :param key: len_k x B x embed_dim
+        :param key_padding_mask: B x len_k, True at padding
+        :param attn_mask: len_q x len_k or (B x num_heads) x len_q x len_k,
+            additive (float) or True where masked (bool)
+        :return: (len_q x B x embed_dim, None)
+        """
+        len_q, batch = query.size(0), query.size(1)
+        if self.num_heads == 0:
+            return (self.out_proj.bias.expand(len_q, batch, self.embed_dim), None)
+        if query is key:
+            q, k, v = self.in_proj(query).chunk(3, dim=-1)
+        else:
+            q = self.in_proj(query)[..., :self.inner_dim]
+            k, v = self.in_proj(key)[..., self.inner_dim:].chunk(2, dim=-1)
+
+        def heads(x: T) -> T:
+            return x.contiguous().view(x.size(0), batch * self.num_heads, self.head_dim).transpose(0, 1)
+
+        q, k, v = heads(q) * self.head_dim ** -0.5, heads(k), heads(v)
+        scores = torch.bmm(q, k.transpose(1, 2))  # (B x num_heads) x len_q x len_k
+        if attn_mask is not None:
+            if attn_mask.dtype == torch.bool:
+                scores = scores.masked_fill(attn_mask, float('-inf'))
+            else:
+                scores = scores + attn_mask
+        if key_padding_mask is not None:
+            scores = scores.view(batch, self.num_heads, len_q, -1).masked_fill(
+                key_padding_mask[:, None, None, :].bool(), float('-inf')).view(batch * self.num_heads, len_q, -1)
+        attn = F.dropout(F.softmax(scores, dim=-1), p=self.dropout, training=self.training)
+        out = torch.bmm(attn, v).view(batch, self.num_heads, len_q, self.head_dim)
+        out = out * self.head_mask.to(out.dtype)[None, :, None, None]
+        out = out.permute(2, 0, 1, 3).reshape(len_q, batch, self.inner_dim)
+        return (self.out_proj(out), None)
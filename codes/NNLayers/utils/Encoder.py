@@ -2,7 +2,7 @@
 
 import torch.nn as nn
 
-from utils.misc import aeq
+from NNLayers.utils.misc import aeq
 
 
 class EncoderBase(nn.Module):
@@ -1,9 +1,12 @@
 """ Multi-Head Attention module """
+import functools
 import math
+from collections import OrderedDict
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
-from utils.misc import generate_relative_positions_matrix,\
+from NNLayers.utils.misc import cached_relative_positions_matrix,\
                             relative_matmul
 # from onmt.utils.misc import aeq
 
@@ -46,16 +49,22 @@ class MultiHeadedAttention(nn.Module):
        model_dim (int): the dimension of keys/values/queries,
            must be divisible by head_count
        dropout (float): dropout parameter
+       q_chunk (int): if > 0, queries are processed in blocks of this size
+           with an online softmax (see :func:`chunked_attention`), the full
+           attention matrix is never built and no attention is returned
+       k_chunk (int): key block size of the online softmax, 0 for all keys
     """
 
     def __init__(self, head_count, model_dim, dropout=0.1,
-                 max_relative_positions=0):
+                 max_relative_positions=0, q_chunk=0, k_chunk=0):
         assert model_dim % head_count == 0
         self.dim_per_head = model_dim // head_count
         self.model_dim = model_dim
 
         super(MultiHeadedAttention, self).__init__()
         self.head_count = head_count
+        self.q_chunk = q_chunk
+        self.k_chunk = k_chunk
 
         self.linear_keys = nn.Linear(model_dim,
                                      head_count * self.dim_per_head)
@@ -73,6 +82,9 @@ class MultiHeadedAttention(nn.Module):
             vocab_size = max_relative_positions * 2 + 1
             self.relative_positions_embeddings = nn.Embedding(
                 vocab_size, self.dim_per_head)
+            # gathered relative embeddings, reused while the weights
+            # do not change and no graph is needed (inference)
+            self._relations_cache = OrderedDict()
 
     def forward(self, key, value, query, mask=None,
                 layer_cache=None, type=None):
@@ -137,16 +149,20 @@ class MultiHeadedAttention(nn.Module):
                                     self.linear_values(query)
                 key = shape(key)
                 value = shape(value)
-                if layer_cache["self_keys"] is not None:
-                    key = torch.cat(
-                        (layer_cache["self_keys"].to(device), key),
-                        dim=2)
-                if layer_cache["self_values"] is not None:
-                    value = torch.cat(
-                        (layer_cache["self_values"].to(device), value),
-                        dim=2)
-                layer_cache["self_keys"] = key
-                layer_cache["self_values"] = value
+                if isinstance(layer_cache["self_keys"], KVCache):
+                    # written in place, holds the values as well
+                    key, value = layer_cache["self_keys"].append(key, value)
+                else:
+                    if layer_cache["self_keys"] is not None:
+                        key = torch.cat(
+                            (layer_cache["self_keys"].to(device), key),
+                            dim=2)
+                    if layer_cache["self_values"] is not None:
+                        value = torch.cat(
+                            (layer_cache["self_values"].to(device), value),
+                            dim=2)
+                    layer_cache["self_keys"] = key
+                    layer_cache["self_values"] = value
             elif type == "context":
                 query = self.linear_query(query)
                 if layer_cache["memory_keys"] is None:
@@ -168,16 +184,11 @@ class MultiHeadedAttention(nn.Module):
 
         if self.max_relative_positions > 0 and type == "self":
             key_len = key.size(2)
-            # 1 or key_len x key_len
-            relative_positions_matrix = generate_relative_positions_matrix(
-                key_len, self.max_relative_positions,
-                cache=True if layer_cache is not None else False)
-            #  1 or key_len x key_len x dim_per_head
-            relations_keys = self.relative_positions_embeddings(
-                relative_positions_matrix.to(device))
-            #  1 or key_len x key_len x dim_per_head
-            relations_values = self.relative_positions_embeddings(
-                relative_positions_matrix.to(device))
+            #  1 or key_len x key_len x dim_per_head, keys and values
+            #  share the same embedding table
+            relations_keys = self.relative_embeddings(
+                key_len, layer_cache is not None, device)
+            relations_values = relations_keys
 
         query = shape(query)
 
@@ -186,6 +197,17 @@ class MultiHeadedAttention(nn.Module):
 
         # 2) Calculate and scale scores.
         query = query / math.sqrt(dim_per_head)
+
+        if self.q_chunk > 0:
+            relative = self.max_relative_positions > 0 and type == "self"
+            context = chunked_attention(
+                query, key, value,
+                mask.unsqueeze(1) if mask is not None else None,
+                self.dropout, self.q_chunk, self.k_chunk,
+                relations_keys if relative else None,
+                relations_values if relative else None)
+            return self.final_linear(unshape(context)), None
+
         # batch x num_heads x query_len x key_len
         query_key = torch.matmul(query, key.transpose(2, 3))
 
@@ -228,5 +250,175 @@ class MultiHeadedAttention(nn.Module):
 
         return output, top_attn
 
+    def relative_embeddings(self, length, cache, device, max_size=16):
+        """Relative position embeddings ``(1 or length, length, dim)``.
+
+        The clipped distance matrix is memoized per (length, device,
+        max_relative_positions); the gathered embeddings too when no
+        graph is recorded, keyed by the version of the embedding weights
+        so an update invalidates them. Both are bounded LRUs.
+        """
+        # 1 or length x length
+        matrix = cached_relative_positions_matrix(
+            length, self.max_relative_positions, cache, device)
+        weight = self.relative_positions_embeddings.weight
+        if torch.is_grad_enabled() and weight.requires_grad:
+            return self.relative_positions_embeddings(matrix)
+        key = (length, cache, device, weight.data_ptr(), weight._version)
+        if key in self._relations_cache:
+            self._relations_cache.move_to_end(key)
+            return self._relations_cache[key]
+        relations = self.relative_positions_embeddings(matrix)
+        self._relations_cache[key] = relations
+        if len(self._relations_cache) > max_size:
+            self._relations_cache.popitem(last=False)
+        return relations
+
     def update_dropout(self, dropout):
-        self.dropout.p = dropout
\ No newline at end of file
+        self.dropout.p = dropout
+
+
+class KVCache(object):
+    """Preallocated self attention keys and values for incremental decoding.
+
+    Put it in ``layer_cache["self_keys"]`` in place of ``None``: every step
+    then writes its keys and values into buffers sized for ``max_steps``
+    instead of concatenating them to the whole history.
+
+    The buffers are time major ``(max_steps, batch, heads, dim)`` so that the
+    filled part is one contiguous slice. :meth:`reorder` gathers it along the
+    batch dim into a spare pair of buffers and swaps them, i.e. one copy of
+    the history per beam reordering and no allocation after the first.
+
+    The cache is for inference only: keys and values are written without
+    autograd, so no gradient flows back through the cached history.
+
+    Args:
+       max_steps (int): maximum number of decoded positions
+       batch_size (int): rows of the batch (``batch * beam`` for beam search)
+       head_count (int): number of heads
+       dim_per_head (int): size of each head
+    """
+
+    def __init__(self, max_steps, batch_size, head_count, dim_per_head,
+                 dtype=torch.float, device=None):
+        self.max_steps = max_steps
+        self.keys = torch.empty(max_steps, batch_size, head_count,
+                                dim_per_head, dtype=dtype, device=device)
+        self.values = torch.empty_like(self.keys)
+        self._spare = None
+        self.length = 0
+
+    def size(self, dim=None):
+        """``(batch, heads, length, dim)`` of the cached keys."""
+        size = torch.Size([self.keys.size(1), self.keys.size(2),
+                           self.length, self.keys.size(3)])
+        return size if dim is None else size[dim]
+
+    @torch.no_grad()
+    def append(self, key, value):
+        """Write ``(batch, heads, step_len, dim)`` keys and values.
+
+        Returns:
+           (FloatTensor, FloatTensor): views of all the cached keys and
+           values, ``(batch, heads, length, dim)``
+        """
+        end = self.length + key.size(2)
+        if end > self.max_steps:
+            raise ValueError(f"KVCache is full: {end} > max_steps "
+                             f"{self.max_steps}")
+        self.keys[self.length:end].copy_(key.permute(2, 0, 1, 3))
+        self.values[self.length:end].copy_(value.permute(2, 0, 1, 3))
+        self.length = end
+        return (self.keys[:end].permute(1, 2, 0, 3),
+                self.values[:end].permute(1, 2, 0, 3))
+
+    @torch.no_grad()
+    def reorder(self, index):
+        """Select the batch rows ``index`` (LongTensor), e.g. the beams that
+        survived a step, or ``batch`` rows repeated ``beam`` times."""
+        size = (self.max_steps, index.numel()) + self.keys.size()[2:]
+        if self._spare is None or self._spare[0].size() != size:
+            self._spare = (self.keys.new_empty(size),
+                           self.values.new_empty(size))
+        keys, values = self._spare
+        index = index.to(self.keys.device)
+        torch.index_select(self.keys[:self.length], 1, index,
+                           out=keys[:self.length])
+        torch.index_select(self.values[:self.length], 1, index,
+                           out=values[:self.length])
+        self._spare = (self.keys, self.values)
+        self.keys, self.values = keys, values
+        return self
+
+
+def chunked_attention(query, key, value, mask, dropout, q_chunk, k_chunk=0,
+                      relations_keys=None, relations_values=None):
+    """Memory bounded attention.
+
+    Queries are processed in blocks of ``q_chunk``; within a block the keys
+    are visited in blocks of ``k_chunk`` with an online (running max / running
+    sum) softmax, so at most ``q_chunk x k_chunk`` scores per head exist at a
+    time. When training, every query block is checkpointed so its scores are
+    recomputed during backward instead of stored.
+
+    Args:
+       query (FloatTensor): scaled queries ``(batch, heads, query_len, dim)``
+       key (FloatTensor): ``(batch, heads, key_len, dim)``
+       value (FloatTensor): ``(batch, heads, key_len, dim)``
+       mask: ``(batch, 1, 1 or query_len, key_len)``, True where masked
+       dropout (nn.Dropout): attention dropout
+       relations_keys, relations_values (FloatTensor):
+           ``(1 or query_len, key_len, dim)`` relative position embeddings
+    Returns:
+       (FloatTensor): context vectors ``(batch, heads, query_len, dim)``
+    """
+    def rows(x, start, end):
+        if x is None or x.size(-2 if x.dim() == 4 else 0) == 1:
+            return x
+        return x[..., start:end, :] if x.dim() == 4 else x[start:end]
+
+    block = functools.partial(_attention_block, dropout=dropout,
+                              k_chunk=k_chunk or key.size(2))
+    outputs = []
+    for start in range(0, query.size(2), q_chunk):
+        end = min(start + q_chunk, query.size(2))
+        args = (query[:, :, start:end], key, value, rows(mask, start, end),
+                rows(relations_keys, start, end),
+                rows(relations_values, start, end))
+        if dropout.training and torch.is_grad_enabled():
+            outputs.append(checkpoint(block, *args, use_reentrant=False))
+        else:
+            outputs.append(block(*args))
+    return torch.cat(outputs, dim=2)
+
+
+def _attention_block(query, key, value, mask, relations_keys,
+                     relations_values, dropout, k_chunk):
+    """Online softmax attention of one query block over key blocks."""
+    shape = query.size()[:-1] + (1,)
+    row_max = query.new_full(shape, float("-inf"), dtype=torch.float)
+    row_sum = query.new_zeros(shape, dtype=torch.float)
+    context = torch.zeros_like(query)
+    for start in range(0, key.size(2), k_chunk):
+        end = min(start + k_chunk, key.size(2))
+        scores = torch.matmul(query, key[:, :, start:end].transpose(2, 3))
+        if relations_keys is not None:
+            scores = scores + relative_matmul(
+                query, relations_keys[:, start:end], True)
+        scores = scores.float()
+        if mask is not None:
+            scores = scores.masked_fill(mask[..., start:end], -1e18)
+        new_max = torch.max(row_max, scores.max(dim=-1, keepdim=True)[0])
+        scale = torch.exp(row_max - new_max)
+        exp_scores = torch.exp(scores - new_max)
+        row_sum = row_sum * scale + exp_scores.sum(dim=-1, keepdim=True)
+        # dropout commutes with the final normalisation by row_sum
+        drop_scores = dropout(exp_scores).to(query.dtype)
+        block = torch.matmul(drop_scores, value[:, :, start:end])
+        if relations_values is not None:
+            block = block + relative_matmul(
+                drop_scores, relations_values[:, start:end], False)
+        context = context * scale.to(query.dtype) + block
+        row_max = new_max
+    return context / row_sum.to(query.dtype)
@@ -4,10 +4,10 @@ Implementation of "Attention is All You Need"
 import torch
 import torch.nn as nn
 
-from Encoder import EncoderBase
-from MultiHeadedAttention import MultiHeadedAttention
-from position_ffn import PositionwiseFeedForward
-from Embeddings import Embeddings
+from NNLayers.utils.Encoder import EncoderBase
+from NNLayers.utils.MultiHeadedAttention import MultiHeadedAttention
+from NNLayers.utils.position_ffn import PositionwiseFeedForward
+from NNLayers.Embeddings import SeqEmbedding, WordEmbedding, PositionalEncoding
 
 class TransformerEncoderLayer(nn.Module):
     """
@@ -20,15 +20,18 @@ class TransformerEncoderLayer(nn.Module):
         heads (int): the number of head for MultiHeadedAttention.
         d_ff (int): the second-layer of the PositionwiseFeedForward.
         dropout (float): dropout probability(0-1.0).
+        q_chunk, k_chunk (int): chunked attention block sizes,
+            see :class:`MultiHeadedAttention`.
     """
 
     def __init__(self, d_model, heads, d_ff, dropout,
-                 max_relative_positions=0):
+                 max_relative_positions=0, q_chunk=0, k_chunk=0):
         super(TransformerEncoderLayer, self).__init__()
 
         self.self_attn = MultiHeadedAttention(
             heads, d_model, dropout=dropout,
-            max_relative_positions=max_relative_positions)
+            max_relative_positions=max_relative_positions,
+            q_chunk=q_chunk, k_chunk=k_chunk)
         self.feed_forward = PositionwiseFeedForward(d_model, d_ff, dropout)
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
         self.dropout = nn.Dropout(dropout)
@@ -79,6 +82,8 @@ class TransformerEncoder(EncoderBase):
         dropout (float): dropout parameters
         embeddings (onmt.modules.Embeddings):
           embeddings to use, should have positional encodings
+        q_chunk, k_chunk (int): chunked attention block sizes,
+          see :class:`MultiHeadedAttention`.
 
     Returns:
         (torch.FloatTensor, torch.FloatTensor):
@@ -94,14 +99,17 @@ class TransformerEncoder(EncoderBase):
                  d_ff,
                  dropout,
                  embeddings,
-                 max_relative_positions):
+                 max_relative_positions,
+                 q_chunk=0,
+                 k_chunk=0):
         super(TransformerEncoder, self).__init__()
 
         self.embeddings = embeddings
         self.transformer = nn.ModuleList(
             [TransformerEncoderLayer(
                 d_model, heads, d_ff, dropout,
-                max_relative_positions=max_relative_positions)
+                max_relative_positions=max_relative_positions,
+                q_chunk=q_chunk, k_chunk=k_chunk)
              for i in range(num_layers)])
         self.layer_norm = nn.LayerNorm(d_model, eps=1e-6)
 
@@ -147,7 +155,7 @@ class TransformerEncoder(EncoderBase):
 
 
 def test():
-    emb = Embeddings(128, 1000, 0)
+    emb = SeqEmbedding(WordEmbedding(1000, 128), PositionalEncoding(0.5, 128), 128)
     model = TransformerEncoder(num_layers=2,
                                d_model=128,
                                heads=16,
@@ -3,6 +3,8 @@ import torch
 import torch.nn as nn
 import random
 import inspect
+import functools
+import contextlib
 from itertools import islice
 
 
@@ -105,21 +107,42 @@ def generate_relative_positions_matrix(length, max_relative_positions,
     return final_mat
 
 
+@functools.lru_cache(maxsize=64)
+def cached_relative_positions_matrix(length, max_relative_positions,
+                                     cache, device):
+    """Memoized :func:`generate_relative_positions_matrix` already moved
+       to ``device``, bounded LRU over (length, max_relative_positions,
+       cache, device). The returned tensor is shared, do not modify it.
+
+       It is built outside inference mode even when first requested under
+       ``torch.inference_mode``, so that later training forwards can still
+       save it for backward."""
+    with torch.inference_mode(False) if hasattr(torch, 'inference_mode') \
+            else contextlib.nullcontext():
+        return generate_relative_positions_matrix(
+            length, max_relative_positions, cache=cache).to(device)
+
+
 def relative_matmul(x, z, transpose):
-    """Helper function for relative positions attention."""
-    batch_size = x.shape[0]
-    heads = x.shape[1]
-    length = x.shape[2]
-    x_t = x.permute(2, 0, 1, 3)
-    x_t_r = x_t.reshape(length, heads * batch_size, -1)
+    """Helper function for relative positions attention.
+
+    Args:
+        x: ``(batch, heads, length, dim)`` if transpose else
+            ``(batch, heads, length, key_len)``
+        z: ``(1 or length, key_len, dim)``
+    Returns:
+        ``(batch, heads, length, key_len)`` if transpose else
+        ``(batch, heads, length, dim)``
+
+    The per-query contraction is one einsum, without the permute/reshape
+    copies of x and of the result; a single query row of z (the
+    incremental decoding case) is a plain broadcast matmul.
+    """
+    if z.size(0) == 1:
+        return torch.matmul(x, z[0].t() if transpose else z[0])
     if transpose:
-        z_t = z.transpose(1, 2)
-        x_tz_matmul = torch.matmul(x_t_r, z_t)
-    else:
-        x_tz_matmul = torch.matmul(x_t_r, z)
-    x_tz_matmul_r = x_tz_matmul.reshape(length, batch_size, heads, -1)
-    x_tz_matmul_r_t = x_tz_matmul_r.permute(1, 2, 0, 3)
-    return x_tz_matmul_r_t
+        return torch.einsum('bhqd,qkd->bhqk', x, z)
+    return torch.einsum('bhqk,qkd->bhqd', x, z)
 
 
 def fn_args(fun):
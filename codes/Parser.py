@@ -38,7 +38,47 @@ def parse_args(args=None):
                         help="Max gradient norm.")
     parser.add_argument('--score_type_parser', default='dot', type=str)
     parser.add_argument('--score_type_predictor', default='denselinear', type=str)
-    parser.add_argument('--encoder_type', default='transformer', type=str)
+    parser.add_argument('--encoder_type', default='transformer', type=str,
+                        help='transformer, LSTM or long_transformer (chunked attention, for long units)')
+    parser.add_argument('--max_relative_positions', default=0, type=int,
+                        help='long_transformer: clipping distance of relative positions, 0 to disable')
+    parser.add_argument('--attn_q_chunk', default=64, type=int,
+                        help='long_transformer: query block size of the chunked attention, 0 for full attention')
+    parser.add_argument('--attn_k_chunk', default=0, type=int,
+                        help='long_transformer: key block size of the online softmax, 0 for all keys')
+    parser.add_argument('--cls_only', action='store_true',
+                        help='transformer encoder: compute the last layer and the ffn head for CLS only')
+    parser.add_argument('--pack', action='store_true',
+                        help='transformer encoder: pack several sentences per row instead of padding')
+    parser.add_argument('--checkpoint_activations', action='store_true',
+                        help='recompute encoder layers and parser/predictor intermediates during backward')
+    parser.add_argument('--prefix_context', action='store_true',
+                        help='hard gates at inference: contexts as span means from prefix sums, '
+                             'O(N) instead of the N x N gates per document')
+    parser.add_argument('--distill_from', default=None, type=str,
+                        help='train the model as a student of this run.py save directory, '
+                             'matching the embeddings of its frozen encoder')
+    parser.add_argument('--distill_loss', default='mse', type=str, choices=['mse', 'cosine'])
+    parser.add_argument('--distill_weight', default=0.0, type=float,
+                        help='weight of the Predic_Net objective added to the distillation loss, 0 to skip it')
+    parser.add_argument('--teacher_cache', default=None, type=str,
+                        help='directory of the cached teacher embeddings, <save_path>/teacher_cache by default')
+    parser.add_argument('--distill_report_size', default=512, type=int,
+                        help='valid sentences the student/teacher speed and agreement are measured on')
+    parser.add_argument('--num_negatives', default=0, type=int,
+                        help='score K negatives per anchor with an InfoNCE loss (dot/bilinear only), '
+                             '0 keeps one negative per anchor')
+    parser.add_argument('--negatives', default='corpus', type=str, choices=['corpus', 'in_batch', 'memory_bank'],
+                        help='corpus: encode the nf/nb negatives of the dataset, '
+                             'in_batch: use the sentences of the other documents of the batch '
+                             '(expects batch_size >= 2), '
+                             'memory_bank: use a queue of sentences from previous batches')
+    parser.add_argument('--bank_size', default=4096, type=int, help='number of sentences in the memory bank')
+    parser.add_argument('--bank_momentum', default=0.0, type=float,
+                        help='fill the memory bank with a momentum encoder updated with this rate, '
+                             '0 enqueues the representations of the trained encoder')
+    parser.add_argument('--fuse_encoder', action='store_true',
+                        help='encode the unique src/nf/nb sentences of a batch in a single encoder call')
     parser.add_argument('-v', '--vocab_size', default=30000, type=int)
     parser.add_argument('-ed', '--emb_dim', default=128, type=int)
     parser.add_argument('-md', '--d_model', default=512, type=int)
@@ -72,7 +112,7 @@ def parse_args(args=None):
     parser.add_argument('--log_steps', default=100, type=int, help='train log every xx steps')
     parser.add_argument('--test_log_steps', default=1000, type=int, help='valid/test log every xx steps')
 
-    return parser.parse_args()
+    return parser.parse_args(args)
 
 
 def override_config(args):
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-10
+
+import json
+import time
+import asyncio
+import logging
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Callable, Deque, Tuple, Optional
+
+import numpy as np
+
+import Model
+from Inference import tokenize, pad_sents, load_model, load_config
+
+
+def percentiles(values, qs=(50, 90, 99)) -> Dict[str, float]:
+    if not values:
+        return {f'p{q}': 0. for q in qs}
+    return {f'p{q}': float(v) for q, v in zip(qs, np.percentile(np.asarray(values), qs))}
+
+
+class MicroBatcher(object):
+    '''
+    Coalesces single sentences submitted by concurrent requests into batches.
+    Sentences wait in buckets of similar length (len // bucket_width); a bucket
+    is sent to the encoder when it holds max_batch_size sentences or when its
+    oldest sentence waited max_wait_ms. Batches are encoded one at a time in
+    a single worker thread, while the event loop keeps collecting the next ones.
+    '''
+    def __init__(self,
+                 encode_fn: Callable[[List[List[int]]], np.ndarray],
+                 max_batch_size: int = 64,
+                 max_wait_ms: float = 5.,
+                 bucket_width: int = 8) -> None:
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_width = bucket_width
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # bucket -> (arrival time, token ids, future)
+        self.buckets: Dict[int, Deque[Tuple[float, List[int], asyncio.Future]]] = OrderedDict()
+        self.batch_sizes: Deque[int] = deque(maxlen=10000)
+        self._arrival: Optional[asyncio.Event] = None
+
+    async def submit(self, token_ids: List[int]) -> np.ndarray:
+        if self._arrival is None:
+            raise RuntimeError('MicroBatcher.run is not started')
+        future = asyncio.get_event_loop().create_future()
+        bucket = len(token_ids) // self.bucket_width
+        self.buckets.setdefault(bucket, deque()).append((time.perf_counter(), token_ids, future))
+        self._arrival.set()
+        return await future
+
+    def queued(self) -> int:
+        return sum(len(items) for items in self.buckets.values())
+
+    def next_bucket(self) -> Tuple[int, float]:
+        '''
+        A full bucket if any, else the bucket of the oldest sentence, with the
+        time its batch is due.
+        '''
+        oldest, due = None, None
+        for bucket, items in self.buckets.items():
+            if len(items) >= self.max_batch_size:
+                return bucket, 0.
+            if due is None or items[0][0] + self.max_wait < due:
+                oldest, due = bucket, items[0][0] + self.max_wait
+        return oldest, due
+
+    async def run(self) -> None:
+        self._arrival = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        while True:
+            if not self.buckets:
+                self._arrival.clear()
+                await self._arrival.wait()
+            bucket, due = self.next_bucket()
+            timeout = due - time.perf_counter()
+            if timeout > 0:
+                self._arrival.clear()
+                try:
+                    await asyncio.wait_for(self._arrival.wait(), timeout)
+                    # a new sentence may have filled a bucket
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            items = self.buckets[bucket]
+            batch = [items.popleft() for _ in range(min(len(items), self.max_batch_size))]
+            if not items:
+                del self.buckets[bucket]
+            self.batch_sizes.append(len(batch))
+            future = loop.run_in_executor(self.executor, self.encode_fn, [x[1] for x in batch])
+            future.add_done_callback(lambda f, batch=batch: self._resolve(f, batch))
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, batch) -> None:
+        if future.exception() is not None:
+            for _, _, waiter in batch:
+                if not waiter.done():
+                    waiter.set_exception(future.exception())
+            return
+        for emb, (_, _, waiter) in zip(future.result(), batch):
+            if not waiter.done():
+                waiter.set_result(emb)
+
+    def metrics(self) -> Dict[str, float]:
+        sizes = list(self.batch_sizes)
+        return {'batches': len(sizes),
+                'mean_batch_size': float(np.mean(sizes)) if sizes else 0.,
+                'mean_batch_fill': float(np.mean(sizes)) / self.max_batch_size if sizes else 0.,
+                'queued': self.queued()}
+
+
+class EmbeddingServer(object):
+    '''
+    Minimal HTTP/1.1 server (keep-alive, Content-Length bodies) on asyncio:
+      POST /embed    {"sentences": [str, ...]} or {"token_ids": [[int, ...], ...]}
+                     -> {"embeddings": [[float, ...], ...]}
+      GET  /metrics  latency percentiles (ms), batch size and fill, queue depth
+    Malformed requests, e.g. token ids outside the vocabulary, get a 400 before
+    reaching the batcher, so they never fail the batch of other clients;
+    encoder failures get a 500.
+    '''
+    def __init__(self, batcher: MicroBatcher, vocab_size: Optional[int] = None) -> None:
+        self.batcher = batcher
+        self.vocab_size = vocab_size
+        self.latencies: Deque[float] = deque(maxlen=10000)
+        self.num_requests = 0
+        self.num_sentences = 0
+        self.start_time = time.perf_counter()
+
+    def check_token_ids(self, token_ids: object) -> None:
+        if not isinstance(token_ids, list):
+            raise ValueError('token_ids must be a list of sentences')
+        for sent in token_ids:
+            if not isinstance(sent, list) or not sent:
+                raise ValueError('every sentence of token_ids must be a non empty list of token ids')
+            for x in sent:
+                if not isinstance(x, int) or isinstance(x, bool) or x < 0 or \
+                        (self.vocab_size is not None and x >= self.vocab_size):
+                    raise ValueError(f'token id {x!r} is outside the vocabulary of {self.vocab_size}')
+
+    async def embed(self, body: dict) -> dict:
+        if 'token_ids' in body:
+            token_ids = body['token_ids']
+            self.check_token_ids(token_ids)
+        else:
+            loop = asyncio.get_event_loop()
+            token_ids = await loop.run_in_executor(None, lambda: [tokenize(s) for s in body['sentences']])
+        embs = await asyncio.gather(*[self.batcher.submit(ids) for ids in token_ids])
+        self.num_sentences += len(embs)
+        return {'embeddings': [emb.tolist() for emb in embs]}
+
+    def metrics(self) -> dict:
+        elapsed = time.perf_counter() - self.start_time
+        return {'requests': self.num_requests,
+                'sentences': self.num_sentences,
+                'sentences_per_sec': self.num_sentences / max(elapsed, 1e-9),
+                'latency_ms': percentiles([x * 1000 for x in self.latencies]),
+                **self.batcher.metrics()}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                start = time.perf_counter()
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    if method == 'POST' and path == '/embed':
+                        status, payload = 200, await self.embed(json.loads(body))
+                        self.num_requests += 1
+                        self.latencies.append(time.perf_counter() - start)
+                    elif method == 'GET' and path == '/metrics':
+                        status, payload = 200, self.metrics()
+                    else:
+                        status, payload = 404, {'error': f'no route {method} {path}'}
+                except (ValueError, KeyError, TypeError) as e:
+                    status, payload = 400, {'error': repr(e)}
+                except Exception as e:
+                    # e.g. the encoder failed on the batch, answer instead of dropping the connection
+                    logging.exception(f'{method} {path} failed')
+                    status, payload = 500, {'error': repr(e)}
+                data = json.dumps(payload).encode()
+                reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+                writer.write(f'HTTP/1.1 {status} {reason}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+
+def make_encode_fn(model: Model.PEmodel, device: str = 'cpu') -> Callable[[List[List[int]]], np.ndarray]:
+    def encode(sents: List[List[int]]) -> np.ndarray:
+        src, mask, lens = pad_sents(sents)
+        reps = Model.PEmodel.encode(model, src.to(device), mask.to(device), {'src': lens})
+        return reps.float().cpu().numpy()
+    return encode
+
+
+async def serve(init_checkpoint: str,
+                host: str = '127.0.0.1',
+                port: int = 8000,
+                max_batch_size: int = 64,
+                max_wait_ms: float = 5.,
+                bucket_width: int = 8,
+                device: str = 'cpu') -> None:
+    model = load_model(init_checkpoint, device)
+    batcher = MicroBatcher(make_encode_fn(model, device), max_batch_size, max_wait_ms, bucket_width)
+    server = EmbeddingServer(batcher, load_config(init_checkpoint).word2id)
+    batching = asyncio.ensure_future(batcher.run())
+    tcp_server = await asyncio.start_server(server.handle, host, port)
+    logging.info(f'serving {init_checkpoint} on http://{host}:{port} '
+                 f'(max_batch_size={max_batch_size}, max_wait_ms={max_wait_ms})')
+    try:
+        await tcp_server.serve_forever()
+    finally:
+        batching.cancel()
+        tcp_server.close()
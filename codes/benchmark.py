@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-02
+
+import argparse
+import time
+
+import torch
+
+from NNLayers.Predict_Net import Predic_Net
+from NNLayers.utils.misc import relative_matmul
+from NNLayers.utils.MultiHeadedAttention import MultiHeadedAttention
+from Parser import parse_args as model_args
+import Model
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of the model components',
+        usage='benchmark.py <bench> [<args>] [-h | --help]'
+    )
+    parser.add_argument('bench', type=str, help='denselinear, checkpoint, relative, prefix, workers, coldstart')
+    parser.add_argument('--cuda', action='store_true', help='use GPU')
+    parser.add_argument('-md', '--d_model', default=512, type=int)
+    parser.add_argument('-n', '--num_rows', default=8 * 20, type=int,
+                        help='number of anchor sentences scored per step')
+    parser.add_argument('--repeat', default=100, type=int)
+    parser.add_argument('--warm_up', default=10, type=int)
+    parser.add_argument('--batch_sizes', default=[4, 8, 16, 32], type=int, nargs='+',
+                        help='documents per batch')
+    parser.add_argument('--num_sent', default=20, type=int, help='sentences per document')
+    parser.add_argument('--sent_len', default=50, type=int, help='tokens per sentence')
+    parser.add_argument('--model_args', default='', type=str,
+                        help='extra run.py arguments of the benchmarked model, e.g. "--n_layer 4"')
+    parser.add_argument('--lengths', default=[32, 64, 128, 256], type=int, nargs='+',
+                        help='sequence lengths of the relative attention bench, sentences per document of the prefix bench')
+    parser.add_argument('--nhead', default=8, type=int)
+    parser.add_argument('--max_relative_positions', default=16, type=int)
+    parser.add_argument('--workers', default=[1, 2, 4, 8], type=int, nargs='+',
+                        help='encoder pool sizes of the workers bench')
+    parser.add_argument('--num_sents', default=4096, type=int,
+                        help='sentences embedded per run of the workers bench')
+    parser.add_argument('-init', '--init_checkpoint', default=None, type=str,
+                        help='run.py save directory of the coldstart bench')
+    parser.add_argument('--script', default=None, type=str,
+                        help='its infer.py export file, exported to a temporary file when not given')
+    parser.add_argument('--cold_runs', default=3, type=int, help='fresh processes started per path')
+
+    return parser.parse_args(args)
+
+
+def timeit(func, args):
+    '''
+    Average wall time of func() in milliseconds
+    '''
+    for _ in range(args.warm_up):
+        func()
+    if args.cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        func()
+    if args.cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.repeat * 1000
+
+
+def bench_denselinear(args):
+    '''
+    Concatenation vs decomposed 'denselinear' scorer, forward and forward + backward,
+    on the fwd/bwd x pos/neg pattern of Predic_Net.forward.
+    '''
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    model = Predic_Net(args.d_model, 'denselinear').to(device)
+    h, pos, neg = [torch.randn(args.num_rows, args.d_model, device=device, requires_grad=True)
+                   for _ in range(3)]
+
+    def concat():
+        return [model.cpt_logit(h, pos), model.cpt_logit(h, neg)]
+
+    def decomposed():
+        return list(model.cpt_dense_logit(h, (pos, neg)))
+
+    def backward(func):
+        def run():
+            sum(x.sum() for x in func()).backward()
+        return run
+
+    for name, func in [('concat', concat), ('decomposed', decomposed)]:
+        with torch.no_grad():
+            fwd_ms = timeit(func, args)
+        bwd_ms = timeit(backward(func), args)
+        print(f'{name:>12s}: forward {fwd_ms:.3f} ms, forward+backward {bwd_ms:.3f} ms '
+              f'(d_model={args.d_model}, rows={args.num_rows})')
+
+
+def build_model(args, *extra):
+    '''
+    PEmodel built from the run.py defaults plus --model_args
+    '''
+    para = model_args(['-md', str(args.d_model)] + args.model_args.split() + list(extra))
+    para.word2id = 28996
+    return Model.build_model(para)
+
+
+def synthetic_batch(num_doc, num_sent, sent_len, device, vocab=28996):
+    '''
+    Random batch in the (Tensor_dict, idx_dict, length_dict) layout of
+    Dataset_Sub.TextDataset.collate_fn, with corpus negatives.
+    '''
+    def sents(n):
+        return (torch.randint(1, vocab, (n, sent_len), device=device),
+                torch.ones(n, sent_len, dtype=torch.long, device=device),
+                [sent_len] * n)
+
+    src, mask_src, src_lens = sents(num_doc * num_sent)
+    nf, mnf, nf_lens = sents(num_doc * (num_sent - 1))
+    nb, mnb, nb_lens = sents(num_doc * (num_sent - 1))
+    Tensor_dict = {'src': src, 'mask_src': mask_src, 'nf': nf, 'nb': nb, 'mnf': mnf, 'mnb': mnb}
+    idx_dict = {'rep_idx': Model.get_idx_by_lens([num_sent] * num_doc),
+                'score_idx': Model.get_idx_by_lens([num_sent + 1] * num_doc)}
+    length_dict = {'src': src_lens, 'nf': nf_lens, 'nb': nb_lens}
+    return Tensor_dict, idx_dict, length_dict
+
+
+def train_pass(model, data):
+    Tensor_dict, idx_dict, length_dict = data
+    pos_loss, neg_loss, _ = model(
+        Tensor_dict['src'],
+        Tensor_dict['mask_src'],
+        idx_dict['rep_idx'],
+        idx_dict['score_idx'],
+        (Tensor_dict['nf'], Tensor_dict['nb']),
+        (Tensor_dict['mnf'], Tensor_dict['mnb']),
+        length_dict,
+        False
+    )
+    ((pos_loss + neg_loss) / 2).backward()
+
+
+def saved_activations_mb(model, data) -> float:
+    '''
+    Size of the tensors a training forward saves for backward (what
+    checkpointing removes), the cpu counterpart of the cuda peak memory.
+    Tensors saved inside checkpointed regions go through the checkpoint's own
+    hooks and are not counted.
+    '''
+    saved = [0]
+
+    def pack(tensor):
+        saved[0] += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        train_pass(model, data)
+    model.zero_grad()
+    return saved[0] / 2 ** 20
+
+
+def bench_checkpoint(args):
+    '''
+    Peak memory and step time of a training forward + backward with and without
+    --checkpoint_activations at several batch sizes. Peak memory is the cuda
+    allocator peak with --cuda, else the size of the saved activations.
+    '''
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    for flag in [[], ['--checkpoint_activations']]:
+        model = build_model(args, *flag).to(device).train()
+        for batch_size in args.batch_sizes:
+            data = synthetic_batch(batch_size, args.num_sent, args.sent_len, device)
+            try:
+                if args.cuda:
+                    torch.cuda.empty_cache()
+                    torch.cuda.reset_peak_memory_stats()
+                step_ms = timeit(lambda: train_pass(model, data), args)
+            except RuntimeError as e:
+                # CUDA out of memory
+                print(f'checkpoint={bool(flag)} batch_size={batch_size}: {e}')
+                break
+            if args.cuda:
+                peak = f'peak memory {torch.cuda.max_memory_allocated() / 2 ** 20:.0f} MiB'
+            else:
+                peak = f'saved activations {saved_activations_mb(model, data):.0f} MiB'
+            print(f'checkpoint={bool(flag)} batch_size={batch_size}: {step_ms:.1f} ms/step, {peak}')
+            model.zero_grad()
+
+
+def legacy_relative_matmul(x, z, transpose):
+    '''
+    relative_matmul before the einsum rewrite, as the reference of bench_relative
+    '''
+    batch_size, heads, length = x.shape[0], x.shape[1], x.shape[2]
+    x_t_r = x.permute(2, 0, 1, 3).reshape(length, heads * batch_size, -1)
+    x_tz_matmul = torch.matmul(x_t_r, z.transpose(1, 2) if transpose else z)
+    return x_tz_matmul.reshape(length, batch_size, heads, -1).permute(1, 2, 0, 3)
+
+
+def bench_relative(args):
+    '''
+    Relative position attention across --lengths: the permute/reshape vs einsum
+    relative_matmul, and a full no-grad self attention forward whose relative
+    tables are memoized after the first call.
+    '''
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    dim = args.d_model // args.nhead
+    attn = MultiHeadedAttention(args.nhead, args.d_model, 0.0,
+                                max_relative_positions=args.max_relative_positions).to(device).eval()
+    for length in args.lengths:
+        q = torch.randn(args.num_sent, args.nhead, length, dim, device=device)
+        scores = torch.randn(args.num_sent, args.nhead, length, length, device=device)
+        z = torch.randn(length, length, dim, device=device)
+        x = torch.randn(args.num_sent, length, args.d_model, device=device)
+        assert torch.allclose(relative_matmul(q, z, True), legacy_relative_matmul(q, z, True), atol=1e-4)
+        assert torch.allclose(relative_matmul(scores, z, False),
+                              legacy_relative_matmul(scores, z, False), atol=1e-4)
+        with torch.no_grad():
+            ms = {name: timeit(lambda: (func(q, z, True), func(scores, z, False)), args)
+                  for name, func in [('legacy', legacy_relative_matmul), ('einsum', relative_matmul)]}
+            attn_ms = timeit(lambda: attn(x, x, x, type="self"), args)
+        print(f'length={length}: relative_matmul legacy {ms["legacy"]:.3f} ms, '
+              f'einsum {ms["einsum"]:.3f} ms, self attention {attn_ms:.3f} ms '
+              f'(batch={args.num_sent}, heads={args.nhead}, d_model={args.d_model})')
+
+
+def bench_prefix(args):
+    '''
+    Forward and backward contexts of one document of every --lengths sentences
+    with hard gates: N x N gates and context squares vs span means from prefix sums.
+    '''
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    parser = Model.Parser(args.d_model, 0.0, 'dot', 0.1, True, prefix_context=True).to(device).eval()
+    predictor = Predic_Net(args.d_model, 'dot').to(device).eval()
+    for length in args.lengths:
+        rep = torch.randn(length, args.d_model, device=device)
+
+        def dense():
+            gate = parser.gate_layer.compute_gate(score)
+            return predictor.compute_h([predictor.get_sm(rep)], [predictor.get_sm(rep.flip((0,)))],
+                                       [predictor.mask_gate(gate)])
+
+        def prefix():
+            return predictor.compute_span_h(rep, *parser.gate_layer.spans(score))
+
+        with torch.no_grad():
+            score = parser.score_layer([rep])
+            ms = {name: timeit(func, args) for name, func in [('dense', dense), ('prefix', prefix)]}
+            (fwd, bwd), (doc_fwd, doc_bwd) = prefix(), dense()
+            err = max((fwd - doc_fwd[0]).abs().max().item(), (bwd - doc_bwd[0]).abs().max().item())
+        print(f'length={length}: dense {ms["dense"]:.3f} ms, prefix {ms["prefix"]:.3f} ms, '
+              f'max abs diff {err:.2e} (d_model={args.d_model})')
+
+
+def bench_workers(args):
+    '''
+    Embedding throughput of Encoder_Pool.EncoderPool against its number of
+    workers, on random sentences of 5 to --sent_len tokens. CPU only.
+    '''
+    from Encoder_Pool import EncoderPool, core_sets
+
+    gen = torch.Generator().manual_seed(1101)
+    sents = [torch.randint(1, 28996, (int(n),), generator=gen).tolist()
+             for n in torch.randint(5, args.sent_len + 1, (args.num_sents,), generator=gen)]
+    base = None
+    for num_workers in args.workers:
+        try:
+            cores = core_sets(num_workers)
+        except ValueError as e:
+            print(e)
+            break
+        # a fresh model per pool, never run in the parent before the fork
+        with EncoderPool(build_model(args), num_workers, cores) as pool:
+            pool.encode(sents[: 64])
+            start = time.perf_counter()
+            pool.encode(sents)
+            rate = len(sents) / (time.perf_counter() - start)
+        base = base or rate
+        print(f'workers={num_workers} (cores per worker {len(cores[0])}): {rate:.1f} sent/s, '
+              f'speedup {rate / base:.2f}x')
+
+
+COLD_START = '''
+import sys, time
+start = time.perf_counter()
+import json
+import torch
+sents = json.loads(sys.argv[2])
+if sys.argv[1] == 'eager':
+    sys.path.insert(0, sys.argv[4])
+    import Inference, Model
+    model = Inference.load_model(sys.argv[3])
+    src, mask, lens = Inference.pad_sents(sents)
+    Model.PEmodel.encode(model, src, mask, {'src': lens})
+else:
+    model = torch.jit.load(sys.argv[3]).eval()
+    src = torch.LongTensor([s + [0] * (max(map(len, sents)) - len(s)) for s in sents])
+    with torch.no_grad():
+        model(src, src.ne(0).long())
+print(time.perf_counter() - start)
+'''
+
+
+def bench_coldstart(args):
+    '''
+    Time to the first embedding of a fresh process (imports, model loading and
+    one batch of 8 sentences), loading the -init save directory with
+    build_model/load_state_dict or its TorchScript export, then the steady-state
+    throughput of both on --num_sents random sentences of 5 to --sent_len tokens.
+    '''
+    import json
+    import os
+    import subprocess
+    import sys
+    import tempfile
+
+    import Inference
+
+    if args.init_checkpoint is None:
+        raise ValueError('the coldstart bench needs -init')
+    gen = torch.Generator().manual_seed(1101)
+    sents = [[101] + torch.randint(1000, 28000, (int(n),), generator=gen).tolist()
+             for n in torch.randint(5, args.sent_len + 1, (args.num_sents,), generator=gen)]
+    with tempfile.TemporaryDirectory() as tmp:
+        script = args.script or os.path.join(tmp, 'encoder.pt')
+        if args.script is None:
+            Inference.export_script(args.init_checkpoint, script)
+        codes = os.path.dirname(os.path.abspath(__file__))
+        for name, path in [('eager', args.init_checkpoint), ('script', script)]:
+            wall, first = [], []
+            for _ in range(args.cold_runs):
+                start = time.perf_counter()
+                out = subprocess.run([sys.executable, '-c', COLD_START, name, json.dumps(sents[:8]), path, codes],
+                                     check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+                wall.append(time.perf_counter() - start)
+                first.append(float(out.split()[-1]))
+            print(f'{name}: cold start {min(wall) * 1000:.0f} ms to first embedding '
+                  f'({min(first) * 1000:.0f} ms after interpreter start), best of {args.cold_runs}')
+
+        model, scripted = Inference.load_model(args.init_checkpoint), Inference.load_scripted(script)
+        batches = [Inference.pad_sents(sents[i: i + 64]) for i in range(0, len(sents), 64)]
+
+        def eager():
+            for src, mask, lens in batches:
+                Model.PEmodel.encode(model, src, mask, {'src': lens})
+
+        def script_encode():
+            with torch.no_grad():
+                for src, mask, _ in batches:
+                    scripted(src, mask)
+
+        for name, func in [('eager', eager), ('script', script_encode)]:
+            ms = timeit(func, args)
+            print(f'{name}: {len(sents) / ms * 1000:.1f} sent/s steady state')
+
+
+BENCHES = {
+    'denselinear': bench_denselinear,
+    'checkpoint': bench_checkpoint,
+    'relative': bench_relative,
+    'prefix': bench_prefix,
+    'workers': bench_workers,
+    'coldstart': bench_coldstart,
+}
+
+
+def main(args):
+    if args.bench not in BENCHES:
+        raise ValueError(f'Unknown bench {args.bench}, choose from {sorted(BENCHES)}')
+    BENCHES[args.bench](args)
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-08
+
+import argparse
+import logging
+
+import Inference
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Inference with a trained Discourse Sentence Representations Model',
+        usage='infer.py <command> [<args>] [-h | --help]'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+
+    embed = subparsers.add_parser('embed', help='embed the sentences of a corpus')
+    embed.add_argument('-init', '--init_checkpoint', required=True, type=str,
+                       help='run.py save directory with config.json and checkpoint')
+    embed.add_argument('--corpus', required=True, type=str,
+                       help='text file with one sentence per line, or a dataset split directory of <i>.json')
+    embed.add_argument('-o', '--output', required=True, type=str,
+                       help='<output>.npy gets the embeddings, <output>.ids the sentence ids')
+    embed.add_argument('--max_tokens', default=8192, type=int, help='token budget of a padded batch')
+    embed.add_argument('--num_workers', default=4, type=int, help='tokenization processes')
+    embed.add_argument('--num_procs', default=1, type=int, help='encoding processes (CPU)')
+    embed.add_argument('--cuda', action='store_true', help='use GPU')
+    embed.add_argument('--cache_dir', default=None, type=str,
+                       help='reuse the embeddings of previous runs with the same checkpoint stored there')
+
+    serve = subparsers.add_parser('serve', help='HTTP embedding server on localhost with micro-batching')
+    serve.add_argument('-init', '--init_checkpoint', required=True, type=str,
+                       help='run.py save directory with config.json and checkpoint')
+    serve.add_argument('--host', default='127.0.0.1', type=str)
+    serve.add_argument('--port', default=8000, type=int)
+    serve.add_argument('--max_batch_size', default=64, type=int, help='sentences per encoder call')
+    serve.add_argument('--max_wait_ms', default=5., type=float,
+                       help='longest time a sentence waits for its batch to fill')
+    serve.add_argument('--bucket_width', default=8, type=int,
+                       help='sentences are batched with others of the same length // bucket_width')
+    serve.add_argument('--num_threads', default=0, type=int, help='torch threads, 0 keeps the default')
+    serve.add_argument('--cuda', action='store_true', help='use GPU')
+
+    parse = subparsers.add_parser('parse-corpus', help='discourse trees of every document of a dataset split')
+    parse.add_argument('-init', '--init_checkpoint', required=True, type=str,
+                       help='run.py save directory with config.json and checkpoint')
+    parse.add_argument('--split_dir', required=True, type=str, help='dataset split directory of <i>.json')
+    parse.add_argument('-o', '--output_dir', required=True, type=str,
+                       help='gets shard-<r>.<format> trees and shard-<r>.progress resume markers')
+    parse.add_argument('--num_shards', default=1, type=int, help='parsing processes, one shard each')
+    parse.add_argument('--format', default='jsonl', choices=['jsonl', 'bin'], type=str,
+                       help='jsonl lines {"doc", "parent"}, or bin records of int64 doc, uint32 size, int32 parents')
+    parse.add_argument('--batch_docs', default=32, type=int, help='documents per encoder call')
+    parse.add_argument('--prefetch', default=4, type=int, help='batches read ahead of the parser')
+
+    quantize = subparsers.add_parser('quantize', help='int8 dynamic quantization of the encoder for CPU inference')
+    quantize.add_argument('-init', '--init_checkpoint', required=True, type=str,
+                          help='run.py save directory with config.json and checkpoint')
+    quantize.add_argument('-o', '--output', required=True, type=str,
+                          help='save directory of the quantized model, usable as -init of the other commands')
+    quantize.add_argument('--corpus', required=True, type=str,
+                          help='held-out text file or dataset split directory the two encoders are compared on')
+    quantize.add_argument('--num_sample', default=1000, type=int, help='sentences of the corpus compared')
+    quantize.add_argument('--max_tokens', default=8192, type=int, help='token budget of a padded batch')
+    quantize.add_argument('--min_cosine', default=0.99, type=float,
+                          help='lowest mean cosine similarity to the fp32 embeddings to pass the check')
+    quantize.add_argument('--num_threads', default=0, type=int, help='torch threads, 0 keeps the default')
+
+    export = subparsers.add_parser('export', help='TorchScript file of the encoder for fast-start inference')
+    export.add_argument('-init', '--init_checkpoint', required=True, type=str,
+                        help='run.py save directory with config.json and checkpoint')
+    export.add_argument('-o', '--output', required=True, type=str,
+                        help='TorchScript file, torch.jit.load(output)(src, mask) -> embeddings')
+
+    weights = subparsers.add_parser('export-weights',
+                                    help='encoder-only, memory-mappable inference checkpoint')
+    weights.add_argument('-init', '--init_checkpoint', required=True, type=str,
+                         help='run.py save directory with config.json and checkpoint')
+    weights.add_argument('-o', '--output', required=True, type=str,
+                         help='directory usable as -init of embed and serve')
+    weights.add_argument('--dtype', default='float32', choices=['float32', 'float16', 'bfloat16'], type=str)
+
+    prune = subparsers.add_parser('prune-heads', help='remove the least important attention heads of a transformer')
+    prune.add_argument('-init', '--init_checkpoint', required=True, type=str,
+                       help='run.py save directory with config.json and checkpoint')
+    prune.add_argument('-o', '--output', required=True, type=str,
+                       help='save directory of the pruned model, usable as -init of the other commands')
+    prune.add_argument('--corpus', required=True, type=str,
+                       help='held-out text file or dataset split directory the heads are scored on')
+    prune.add_argument('--ratio', default=0.5, type=float, help='fraction of all the heads removed')
+    prune.add_argument('--curve_ratios', default=[0., 0.25, 0.5, 0.75], nargs='+', type=float,
+                       help='ratios of the throughput / quality curve')
+    prune.add_argument('--num_sample', default=1000, type=int, help='sentences of the corpus scored on')
+    prune.add_argument('--max_tokens', default=8192, type=int, help='token budget of a padded batch')
+
+    return parser.parse_args(args)
+
+
+def embed(args):
+    stats = Inference.embed_corpus(
+        args.init_checkpoint,
+        args.corpus,
+        args.output,
+        args.max_tokens,
+        args.num_workers,
+        args.num_procs,
+        'cuda' if args.cuda else 'cpu',
+        args.cache_dir
+    )
+    logging.info(f"embedded {stats['sentences']} sentences: "
+                 f"tokenization {stats['tokenize_sent_per_sec']:.1f} sent/s, "
+                 f"encoding {stats['encode_sent_per_sec']:.1f} sent/s, "
+                 f"peak RSS {stats['peak_rss_mb']:.0f} MiB")
+    if 'cache_hit_rate' in stats:
+        logging.info(f"embedding cache: hit rate {stats['cache_hit_rate']:.3f}, "
+                     f"{stats['cache_disk_bytes'] / 2 ** 20:.1f} MiB on disk")
+
+
+def serve(args):
+    import asyncio
+    import torch
+    import Serving
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    asyncio.run(Serving.serve(
+        args.init_checkpoint,
+        args.host,
+        args.port,
+        args.max_batch_size,
+        args.max_wait_ms,
+        args.bucket_width,
+        'cuda' if args.cuda else 'cpu'
+    ))
+
+
+def parse_corpus(args):
+    stats = Inference.parse_corpus(
+        args.init_checkpoint,
+        args.split_dir,
+        args.output_dir,
+        args.num_shards,
+        args.format,
+        args.batch_docs,
+        args.prefetch
+    )
+    logging.info(f"parsed {stats['documents']} documents in {stats['shards']} shards: "
+                 f"{stats['docs_per_sec']:.1f} doc/s, peak RSS {stats['peak_rss_mb']:.0f} MiB")
+
+
+def quantize(args):
+    if args.num_threads > 0:
+        import torch
+        torch.set_num_threads(args.num_threads)
+    stats = Inference.quantize_checkpoint(
+        args.init_checkpoint,
+        args.output,
+        args.corpus,
+        args.num_sample,
+        args.max_tokens,
+        args.min_cosine
+    )
+    for name in ['fp32', 'int8']:
+        logging.info(f"{name}: encoder {stats[f'{name}_encoder_mb']:.1f} MiB, "
+                     f"{stats[f'{name}_sent_per_sec']:.1f} sent/s, "
+                     f"{stats[f'{name}_ms_per_batch']:.2f} ms per batch")
+    logging.info(f"cosine to fp32 over {stats['sentences']} sentences: mean {stats['cosine_mean']:.4f}, "
+                 f"min {stats['cosine_min']:.4f}")
+    if stats['passed']:
+        logging.info(f'check passed, quantized model saved to {args.output}')
+    else:
+        logging.warning(f'mean cosine below {args.min_cosine}, '
+                        f'keep the fp32 model ({args.output} was saved for inspection)')
+
+
+def export(args):
+    stats = Inference.export_script(args.init_checkpoint, args.output)
+    logging.info(f"exported the encoder to {args.output} ({stats['size_mb']:.1f} MiB), "
+                 f"max abs difference to the eager encoder {stats['max_abs_diff']:.2e}")
+
+
+def export_weights(args):
+    import Flat_Checkpoint
+
+    stats = Flat_Checkpoint.export_encoder(args.init_checkpoint, args.output, args.dtype)
+    logging.info(f"exported {args.dtype} encoder weights to {args.output}: {stats['weights_mb']:.1f} MiB "
+                 f"(training checkpoint {stats['checkpoint_mb']:.1f} MiB)")
+
+
+def prune_heads(args):
+    import Head_Pruning
+
+    stats = Head_Pruning.prune_checkpoint(
+        args.init_checkpoint,
+        args.output,
+        args.corpus,
+        args.ratio,
+        tuple(args.curve_ratios),
+        args.num_sample,
+        args.max_tokens
+    )
+    for point in stats['curve']:
+        logging.info(f"ratio {point['ratio']:.2f}: {point['heads']} heads, {point['sent_per_sec']:.1f} sent/s, "
+                     f"cosine to the full model {point['cosine']:.4f}")
+    logging.info(f"heads per layer {stats['layer_heads']}, pruned model saved to {args.output}")
+
+
+COMMANDS = {
+    'embed': embed,
+    'serve': serve,
+    'parse-corpus': parse_corpus,
+    'quantize': quantize,
+    'export': export,
+    'export-weights': export_weights,
+    'prune-heads': prune_heads,
+}
+
+
+def main(args):
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(message)s', level=logging.INFO)
+    if args.command not in COMMANDS:
+        raise ValueError(f'Unknown command {args.command}, choose from {sorted(COMMANDS)}')
+    COMMANDS[args.command](args)
+
+
+if __name__ == "__main__":
+    main(parse_args())
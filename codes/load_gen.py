@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-10
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Load generator of the infer.py serve embedding server',
+        usage='load_gen.py [<args>] [-h | --help]'
+    )
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--concurrency', default=[1, 4, 16, 64], type=int, nargs='+',
+                        help='numbers of concurrent clients, one run each')
+    parser.add_argument('--duration', default=10., type=float, help='seconds per run')
+    parser.add_argument('--sents_per_request', default=1, type=int)
+    parser.add_argument('--corpus', default=None, type=str,
+                        help='text file with one sentence per line, random token ids otherwise')
+    parser.add_argument('--min_len', default=5, type=int, help='length range of random sentences')
+    parser.add_argument('--max_len', default=50, type=int)
+
+    return parser.parse_args(args)
+
+
+async def request(reader, writer, host, method, path, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: {host}\r\n'
+                 f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    data = json.loads(await reader.readexactly(length))
+    if status != 200:
+        raise RuntimeError(f'{method} {path}: {status} {data}')
+    return data
+
+
+def make_payload(args, sentences):
+    if sentences:
+        return {'sentences': random.sample(sentences, args.sents_per_request)}
+    return {'token_ids': [[101] + [random.randint(1000, 28000) for _ in range(random.randint(args.min_len, args.max_len))]
+                          + [102] for _ in range(args.sents_per_request)]}
+
+
+async def client(args, sentences, deadline, latencies):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    try:
+        while time.perf_counter() < deadline:
+            payload = make_payload(args, sentences)
+            start = time.perf_counter()
+            await request(reader, writer, args.host, 'POST', '/embed', payload)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run(args, concurrency, sentences):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, sentences, start + args.duration, latencies)
+                           for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    metrics = await request(reader, writer, args.host, 'GET', '/metrics')
+    writer.close()
+    p50, p90, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 90, 99])
+    print(f'concurrency={concurrency}: {len(latencies) * args.sents_per_request / elapsed:.1f} sent/s, '
+          f'latency p50 {p50:.1f} ms p90 {p90:.1f} ms p99 {p99:.1f} ms, '
+          f"server mean batch fill {metrics['mean_batch_fill']:.2f} "
+          f"(mean batch size {metrics['mean_batch_size']:.1f} over {metrics['batches']} batches)")
+
+
+def main(args):
+    random.seed(1101)
+    sentences = None
+    if args.corpus:
+        with open(args.corpus) as f:
+            sentences = [line.rstrip('\n') for line in f if line.strip()]
+    for concurrency in args.concurrency:
+        asyncio.run(run(args, concurrency, sentences))
+
+
+if __name__ == "__main__":
+    main(parse_args())
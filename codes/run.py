@@ -19,6 +19,7 @@ from torch.utils.tensorboard import SummaryWriter
 
 from NNLayers.utils.optimization import WarmupLinearSchedule
 import Model
+import Distill
 #from Dataset import CnnDmDataset, make_vocab
 from Parser import *
 from Dataset_Sub import TextDataset, DataPrefetcher
@@ -91,9 +92,9 @@ def main(args):
     if args.dataset not in name2data:
         raise ValueError('You should use dataset <cnndm>, <wiki> or <book>')
 
-    train_dataset = TextDataset('train', args.data_path)
-    val_dataset = TextDataset('valid', args.data_path)
-    test_dataset = TextDataset('test', args.data_path)
+    train_dataset = TextDataset('train', args.data_path, args.negatives, args.fuse_encoder)
+    val_dataset = TextDataset('valid', args.data_path, args.negatives, args.fuse_encoder)
+    test_dataset = TextDataset('test', args.data_path, args.negatives, args.fuse_encoder)
     args.word2id = 28996 ########3super ugly!!!!!!!!!!!!!!!!
 
 
@@ -129,6 +130,23 @@ def main(args):
         else:
             logging.info('Ramdomly Initializing {args.model} Model...')
             init_step = 0
+        distiller = None
+        if getattr(args, 'distill_from', None):
+            logging.info(f'Distilling {args.distill_from} into the model')
+            distiller = Distill.Distiller(args.distill_from,
+                                          args.d_model,
+                                          args.distill_loss,
+                                          args.teacher_cache or os.path.join(args.save_path, 'teacher_cache'),
+                                          'cuda' if torch.cuda.is_available() else 'cpu')
+            if torch.cuda.is_available():
+                distiller = distiller.cuda()
+            if args.init_checkpoint:
+                # the optimizer state restored below holds the moments of the projection
+                if 'distiller_state_dict' not in checkpoint:
+                    raise ValueError(f'{args.init_checkpoint} was saved without its distillation projection')
+                distiller.load_state_dict(checkpoint['distiller_state_dict'])
+        # the distillation projection is trained with the model and saved next to it
+        trainable = pe_model if distiller is None else torch.nn.ModuleList([pe_model, distiller])
         # Set training dataloader iterator
         train_loader = torch.utils.data.DataLoader(dataset=train_dataset,
                                                    batch_size=args.batch_size,
@@ -141,23 +159,23 @@ def main(args):
         current_learning_rate = args.learning_rate
         if args.optim == 'sgd':
             optimizer = torch.optim.SGD(
-                filter(lambda p: p.requires_grad, pe_model.parameters()),
+                filter(lambda p: p.requires_grad, trainable.parameters()),
                 lr=current_learning_rate,
                 weight_decay=args.L2,
                 momentum=args.momentum
             )
         elif args.optim == 'adam':
             optimizer = torch.optim.Adam(
-                filter(lambda p: p.requires_grad, pe_model.parameters()),
+                filter(lambda p: p.requires_grad, trainable.parameters()),
                 lr=current_learning_rate,
                 weight_decay=args.L2,
             )
         elif args.optim == 'adamw':
             no_decay = ['bias', 'LayerNorm.weight']
             optimizer_grouped_parameters = [
-                {'params': [p for n, p in pe_model.named_parameters() if not any(nd in n for nd in no_decay)],
+                {'params': [p for n, p in trainable.named_parameters() if not any(nd in n for nd in no_decay)],
                  'weight_decay': args.L2},
-                {'params': [p for n, p in pe_model.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+                {'params': [p for n, p in trainable.named_parameters() if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
             ]
             optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=current_learning_rate)
 
@@ -208,6 +226,9 @@ def main(args):
         # Training Loop
         #train_iter = iter(train_loader)
         prefetcher = DataPrefetcher(train_loader)
+        if distiller is not None:
+            report_sents = Distill.sample_sents(valid_loader if args.do_valid else train_loader,
+                                                args.distill_report_size)
 
         for step in tqdm(range(init_step, args.max_steps)):
             try:
@@ -219,7 +240,10 @@ def main(args):
                 prefetcher = DataPrefetcher(train_loader)
                 data = prefetcher.next()
             #for step, data in enumerate(BackgroundGenerator(train_loader)):
-            log = pe_model.train_step(pe_model, optimizer, scheduler, data, args, step)
+            if distiller is not None:
+                log = Distill.distill_step(pe_model, distiller, optimizer, scheduler, data, args, step)
+            else:
+                log = pe_model.train_step(pe_model, optimizer, scheduler, data, args, step)
             training_logs.append(log)
 
             # if step >= warm_up_steps:
@@ -239,6 +263,8 @@ def main(args):
                     'current_learning_rate': current_learning_rate,
                     'warm_up_steps': warm_up_steps
                 }
+                if distiller is not None:
+                    save_variable_list['distiller_state_dict'] = distiller.state_dict()
                 save_model(pe_model, optimizer, save_variable_list, args)
 
             if step % args.log_steps == 0:
@@ -264,12 +290,19 @@ def main(args):
                 log_metrics('Valid average', step, metrics)
                 for metric in metrics:
                     writer.add_scalar("Valid/" + metric, metrics[metric], step)
+                if distiller is not None:
+                    metrics = distiller.report(pe_model, report_sents)
+                    log_metrics('Distillation', step, metrics)
+                    for metric in metrics:
+                        writer.add_scalar("Distill/" + metric, metrics[metric], step)
 
         save_variable_list = {
             'step': step,
             'current_learning_rate': current_learning_rate,
             'warm_up_steps': warm_up_steps
         }
+        if distiller is not None:
+            save_variable_list['distiller_state_dict'] = distiller.state_dict()
         save_model(pe_model, optimizer, save_variable_list, args)
 
         if args.do_valid:
@@ -283,6 +316,9 @@ def main(args):
                 metrics[metric] = sum([log[metric] for log in val_logs]) / len(val_logs)
             log_metrics('Valid average', step, metrics)
 
+        if distiller is not None:
+            log_metrics('Distillation', step, distiller.report(pe_model, report_sents))
+
         if args.do_test:
             test_logs = []
             logging.info('Evaluating on Valid Dataset...')
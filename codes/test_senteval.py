@@ -18,7 +18,9 @@ PATH_TO_DATA = '/u/lupeng/Project/code/SentEval/data/'
 
 sys.path.insert(0, PATH_TO_SENTEVAL)
 import senteval
-from Model import PEmodel, build_model
+from Model import PEmodel
+from Embedding_Cache import EmbeddingCache
+from Inference import load_model
 
 from transformers import BertTokenizer
 tokenizer = BertTokenizer.from_pretrained("bert-base-cased", do_lower_case=True)
@@ -72,6 +74,9 @@ def collate_fn(data):
 def batcher(params, batch):
     sentences = [tokenizer.convert_tokens_to_ids(
             tokenizer.tokenize("[CLS] " + " ".join(s) + " [SEP]")) for s in batch]
+    if 'cache' in params:
+        # the tasks share many sentences
+        return params['cache'].encode(sentences)
     Tensor_dict, length_dict = collate_fn(sentences)
 
     embeddings = PEmodel.encode(
@@ -104,14 +109,12 @@ class Bunch(object):
 if __name__ == "__main__":
     logging.basicConfig(format='%(asctime)s : %(message)s', level=logging.DEBUG)
 
+    # a run.py save directory, or its infer.py export-weights directory to map the
+    # encoder weights only instead of loading the optimizer state as well
     init_checkpoint = '/u/lupeng/Project/code/Discourse_summ/saved/octal14/transformer_cnndm_01'
-    with open(os.path.join(init_checkpoint, 'config.json'), 'r') as fjson:
-        argparse_dict = json.load(fjson)
-        checkpoint = torch.load(os.path.join(init_checkpoint, 'checkpoint'))
-    args = Bunch(argparse_dict)
-    model = build_model(args, None)
-    model.load_state_dict(checkpoint['model_state_dict'])
+    model = load_model(init_checkpoint)
     params_senteval['encoder'] = model
+    params_senteval['cache'] = EmbeddingCache(model)
 
     logging.info('start evaluating...')
     se = senteval.engine.SE(params_senteval, batcher)
@@ -132,3 +135,4 @@ if __name__ == "__main__":
             logging.info(result)
         except:
             logging.info(f'{task} failed to be evalatated.')
+    logging.info(f"embedding cache: {params_senteval['cache'].info()}")
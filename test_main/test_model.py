@@ -0,0 +1,758 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# author：Peng time:2019-12-06
+import os
+import sys
+import tempfile
+import copy
+import json
+import asyncio
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'codes'))
+from Model import TransformerEncoder, LSTMEncoder, ExportEncoder, Parser, IncrementalContext, PEmodel, build_model
+from Inference import quantize_encoder, pad_sents, token_budget_batches, read_ahead, TreeShardWriter, read_tree_shard
+from Embedding_Cache import EmbeddingCache, state_fingerprint
+from Parser import parse_args
+from Dataset_Sub import fuse_sents
+from Distill import Distiller, distill_step, batch_sents, rank_correlation, pairwise_cosine
+from Flat_Checkpoint import WEIGHTS, ALIGN, save_tensors, map_tensors, assign_tensors
+from Serving import MicroBatcher, EmbeddingServer
+from Encoder_Pool import EncoderPool, core_sets
+from Head_Pruning import convert_heads, prune_heads
+from NNLayers.Predict_Net import Predic_Net, decode_order
+from NNLayers.Beam_search import BeamSearch
+from NNLayers.Memory_Bank import MemoryBank
+from NNLayers.Pruned_Attention import PrunedSelfAttention
+from NNLayers.Gate_Net import distance_to_tree
+from NNLayers.utils.MultiHeadedAttention import MultiHeadedAttention, KVCache
+from NNLayers.utils.Transformer import TransformerEncoder as ChunkedTransformer
+from NNLayers.Embeddings import SeqEmbedding, WordEmbedding, PositionalEncoding
+from NNLayers.utils.misc import cached_relative_positions_matrix, generate_relative_positions_matrix, relative_matmul
+
+
+def small_args(*args):
+    # run.py arguments of a PEmodel sized for tests
+    para = parse_args(['-md', '16', '-ed', '16', '--nhead', '2', *args])
+    para.word2id = 100
+    return para
+
+
+def small_model(*args):
+    return build_model(small_args(*args))
+
+
+def get_batch(lens, vocab=100):
+    src = torch.zeros(len(lens), max(lens)).long()
+    mask = torch.zeros(len(lens), max(lens)).long()
+    for i, n in enumerate(lens):
+        src[i, :n] = torch.randint(1, vocab, (n,))
+        mask[i, :n] = 1
+    return src, mask
+
+
+def test_cls_only():
+    torch.manual_seed(1101)
+    encoder = TransformerEncoder(100, 16, 32, 4, 2, 0.0).eval()
+    src, mask = get_batch([5, 9, 3, 12])
+    full = encoder(src, mask, None, None)
+    encoder.cls_only = True
+    assert torch.allclose(encoder(src, mask, None, None), full, atol=1e-5)
+
+
+def test_pack():
+    torch.manual_seed(1101)
+    encoder = TransformerEncoder(100, 16, 32, 4, 2, 0.0).eval()
+    src, mask = get_batch([5, 50, 12, 3, 17, 50, 8, 20])
+    padded = encoder(src, mask, None, None)
+    encoder.pack = True
+    assert torch.allclose(encoder(src, mask, None, None), padded, atol=1e-4)
+
+
+def test_dense_logit():
+    # the decomposed denselinear scorer agrees with the concatenation one
+    torch.manual_seed(1101)
+    predictor = Predic_Net(16, 'denselinear')
+    h, pos, neg = torch.randn(7, 16), torch.randn(7, 16), torch.randn(7, 16)
+    fp_logit, fn_logit = predictor.cpt_dense_logit(h, (pos, neg))
+    assert torch.allclose(fp_logit, predictor.cpt_logit(h, pos), atol=1e-5)
+    assert torch.allclose(fn_logit, predictor.cpt_logit(h, neg), atol=1e-5)
+
+
+def test_nce_logit():
+    torch.manual_seed(1101)
+    h, pos, pool = torch.randn(5, 16), torch.randn(5, 16), torch.randn(12, 16)
+    neg_idx = torch.randint(12, (5, 3))
+    for score_type in ['dot', 'bilinear']:
+        predictor = Predic_Net(16, score_type, num_negatives=3)
+
+        def naive(x, y):
+            if score_type == 'bilinear':
+                return predictor.func(x[None], y[None])[0, 0] / 4.
+            return torch.dot(x, y) / 4.
+
+        pos_logit, neg_logit = predictor.cpt_nce_logit(h, pos, pool, neg_idx)
+        assert torch.allclose(pos_logit, torch.stack([naive(h[i], pos[i]) for i in range(5)]), atol=1e-5)
+        expected = torch.stack([torch.stack([naive(h[i], pool[j]) for j in neg_idx[i]]) for i in range(5)])
+        assert torch.allclose(neg_logit, expected, atol=1e-5)
+        # the split InfoNCE loss is the cross entropy with the positive as class 0
+        loss_pos, loss_neg = PEmodel.info_nce(pos_logit, neg_logit)
+        logits = torch.cat((pos_logit[:, None], neg_logit), dim=1)
+        assert torch.allclose(loss_pos + loss_neg, torch.nn.functional.cross_entropy(logits, torch.zeros(5).long()))
+
+
+def test_in_batch_negatives():
+    torch.manual_seed(1101)
+    lens = [3, 1, 5, 2]
+    # row r of the batch holds the value r, so negatives give back their row
+    reps = [torch.arange(sum(lens[:i]), sum(lens[:i + 1])).float()[:, None].repeat(1, 16) for i in range(4)]
+    own = [range(sum(lens[:i]), sum(lens[:i + 1])) for i, n in enumerate(lens) for _ in range(n - 1)]
+    for num_negatives in [0, 4]:
+        model = PEmodel(None, None, Predic_Net(16, 'dot', True, num_negatives))
+        for _ in range(20):
+            neg_fwd, neg_bwd, neg_idx = model.in_batch_negatives(reps)
+            if num_negatives > 0:
+                rows = [neg_idx[0], neg_idx[1]]
+            else:
+                rows = [neg_fwd[:, :1].long(), neg_bwd[:, :1].long()]
+            for idx in rows:
+                assert idx.size(0) == len(own)
+                assert all(r not in own[i] and 0 <= r < sum(lens) for i, row in enumerate(idx.tolist()) for r in row)
+    # a single document falls back to its own sentences but the positive
+    reps = [torch.arange(5).float()[:, None].repeat(1, 16)]
+    model = PEmodel(None, None, Predic_Net(16, 'dot', True, 4))
+    seen = set()
+    for _ in range(20):
+        _, _, (fwd_idx, bwd_idx) = model.in_batch_negatives(reps)
+        for idx, pos in [(fwd_idx, [1, 2, 3, 4]), (bwd_idx, [3, 2, 1, 0])]:
+            assert all(r != pos[i] and 0 <= r < 5 for i, row in enumerate(idx.tolist()) for r in row)
+            seen.update(idx.view(-1).tolist())
+    assert seen == set(range(5))
+
+
+def test_fuse_encoder():
+    torch.manual_seed(1101)
+    model = small_model().eval()
+    src = [torch.randint(1, 100, (n,)).tolist() for n in [4, 6, 3, 5, 7, 2, 4]]
+    # negatives repeating src sentences and each other, as in a corpus batch
+    nf = [src[3], src[0], torch.randint(1, 100, (5,)).tolist(), src[6], src[1]]
+    nb = [nf[2], src[2], src[0], src[5], torch.randint(1, 100, (3,)).tolist()]
+    rep_idx, score_idx = [[0, 1, 2], [3, 4, 5, 6]], [[0, 1, 2, 3], [4, 5, 6, 7, 8]]
+    with torch.no_grad():
+        (s, ms, ls), (f, mf, lf), (b, mb, lb) = pad_sents(src), pad_sents(nf), pad_sents(nb)
+        expected = model(s, ms, rep_idx, score_idx, (f, b), (mf, mb), {'src': ls, 'nf': lf, 'nb': lb}, False)
+        # the documents of the batch as TextDataset.collate_fn gets them
+        data = [{'src_idx': src[:3], 'neg_idx_fwd': nf[:2], 'neg_idx_bwd': nb[:2]},
+                {'src_idx': src[3:], 'neg_idx_fwd': nf[2:], 'neg_idx_bwd': nb[2:]}]
+        unique, sent_map = fuse_sents(data)
+        assert len(unique) == 9 and sorted(sent_map) == ['nb_map', 'nf_map', 'src_map']
+        for key, sents in [('src', src), ('nf', nf), ('nb', nb)]:
+            assert [unique[row] for row in sent_map[f'{key}_map'].tolist()] == sents
+        sent_map = PEmodel.get_sent_map(sent_map, 'cpu')
+        u, mu, lu = pad_sents(unique)
+        fused = model(u, mu, rep_idx, score_idx, None, None, {'src': lu}, False, sent_map)
+    assert torch.allclose(fused[0], expected[0], atol=1e-5)
+    assert torch.allclose(fused[1], expected[1], atol=1e-5)
+
+
+def test_checkpoint_activations():
+    # recomputing the encoder layers, gates and context squares during backward
+    # gives the losses and gradients of storing them
+    torch.manual_seed(1101)
+    plain = small_model().train()
+    recomputed = small_model('--checkpoint_activations').train()
+    recomputed.load_state_dict(plain.state_dict())
+    src = [torch.randint(1, 100, (n,)).tolist() for n in [4, 6, 3, 5, 7, 2, 4]]
+    nf = [torch.randint(1, 100, (n,)).tolist() for n in [5, 2, 6, 3, 4]]
+    nb = [torch.randint(1, 100, (n,)).tolist() for n in [3, 7, 4, 2, 5]]
+    rep_idx, score_idx = [[0, 1, 2], [3, 4, 5, 6]], [[0, 1, 2, 3], [4, 5, 6, 7, 8]]
+    (s, ms, ls), (f, mf, lf), (b, mb, lb) = pad_sents(src), pad_sents(nf), pad_sents(nb)
+    losses, grads = [], []
+    for model in [plain, recomputed]:
+        torch.manual_seed(1101)
+        pos_loss, neg_loss, _ = model(s, ms, rep_idx, score_idx, (f, b), (mf, mb),
+                                      {'src': ls, 'nf': lf, 'nb': lb}, False)
+        loss = (pos_loss + neg_loss) / 2
+        loss.backward()
+        losses.append(loss.item())
+        grads.append({name: p.grad for name, p in model.named_parameters() if p.grad is not None})
+    assert abs(losses[0] - losses[1]) < 1e-6
+    assert grads[0] and grads[0].keys() == grads[1].keys()
+    assert all(torch.allclose(grads[0][name], grads[1][name], atol=1e-6) for name in grads[0])
+
+
+def test_memory_bank():
+    bank = MemoryBank(5, 2)
+    bank.enqueue(torch.ones(3, 2))
+    bank.enqueue(2 * torch.ones(4, 2))
+    assert len(bank) == 5 and bank._ptr == 2 and int(bank.ptr) == 2
+    assert bank.keys()[:2].eq(2).all() and bank.keys()[2].eq(1).all()
+    assert bank.sample(4, 3).size() == (4, 3)
+    # the python pointers follow the buffers of a loaded checkpoint
+    loaded = MemoryBank(5, 2)
+    loaded.load_state_dict(bank.state_dict())
+    assert len(loaded) == 5 and loaded._ptr == 2
+    loaded.enqueue(3 * torch.ones(1, 2))
+    assert loaded.keys()[2].eq(3).all() and int(loaded.ptr) == 3
+
+
+def test_memory_bank_negatives():
+    torch.manual_seed(1101)
+    model = small_model('--negatives', 'memory_bank', '--bank_momentum', '0.9').train()
+    calls = []
+
+    def spy(name):
+        method = getattr(model, name)
+
+        def call(*args):
+            # which negatives were drawn, and how full the bank was then
+            calls.append((name, len(model.bank)))
+            return method(*args)
+        return call
+
+    model.in_batch_negatives = spy('in_batch_negatives')
+    model.bank_negatives = spy('bank_negatives')
+    rep_idx, score_idx = [[0, 1, 2], [3, 4, 5, 6]], [[0, 1, 2, 3], [4, 5, 6, 7, 8]]
+    for _ in range(2):
+        s, ms, ls = pad_sents([torch.randint(1, 100, (n,)).tolist() for n in [4, 6, 3, 5, 7, 2, 4]])
+        model(s, ms, rep_idx, score_idx, None, None, {'src': ls}, False)
+    # the empty bank falls back to in-batch negatives, and the second batch
+    # draws from the first one only: it is enqueued after its negatives
+    assert calls == [('in_batch_negatives', 0), ('bank_negatives', 7)]
+    assert len(model.bank) == 14
+    # the key encoder follows the encoder by momentum
+    keys = [p.clone() for p in model.key_encoder.parameters()]
+    with torch.no_grad():
+        for p in model.encoder.parameters():
+            p.add_(torch.randn_like(p))
+    model.momentum_update()
+    for p_k, old, p_q in zip(model.key_encoder.parameters(), keys, model.encoder.parameters()):
+        assert not p_k.requires_grad
+        assert torch.allclose(p_k, 0.9 * old + 0.1 * p_q, atol=1e-6)
+
+
+def test_chunked_attention():
+    # query/key chunked attention gives the outputs of the full one
+    torch.manual_seed(1101)
+    emb = SeqEmbedding(WordEmbedding(100, 32), PositionalEncoding(0.0, 32), 32)
+    model = ChunkedTransformer(num_layers=2, d_model=32, heads=4, d_ff=8, dropout=0.0,
+                               embeddings=emb, max_relative_positions=8).eval()
+    src = torch.randint(1, 100, (10, 3, 1))
+    src[7:, 1] = 0
+    with torch.no_grad():
+        _, full, _ = model(src)
+        for layer in model.transformer:
+            layer.self_attn.q_chunk, layer.self_attn.k_chunk = 3, 4
+        _, chunked, _ = model(src)
+    assert torch.allclose(chunked, full, atol=1e-4)
+
+
+def test_kv_cache():
+    torch.manual_seed(1101)
+    attn = MultiHeadedAttention(4, 32, 0.0).eval()
+    x = torch.randn(6, 7, 32)
+    concat = {'self_keys': None, 'self_values': None}
+    prealloc = {'self_keys': KVCache(7, 3, 4, 8), 'self_values': None}
+    index = torch.LongTensor([2, 0, 0, 1, 2, 1])
+    for step in range(7):
+        if step == 0:
+            inp = x[:3, :1]
+        else:
+            inp = x[:, step:step + 1]
+        expected, _ = attn(inp, inp, inp, layer_cache=concat, type="self")
+        output, _ = attn(inp, inp, inp, layer_cache=prealloc, type="self")
+        assert torch.allclose(output, expected, atol=1e-5)
+        # beam reordering, from 3 rows to 6 after the first step
+        concat['self_keys'] = concat['self_keys'].index_select(0, index)
+        concat['self_values'] = concat['self_values'].index_select(0, index)
+        prealloc['self_keys'].reorder(index)
+        index = torch.randint(6, (6,))
+    assert prealloc['self_keys'].size() == (6, 4, 7, 8)
+    # written without autograd, so the out= gather of reorder is allowed
+    assert not prealloc['self_keys'].keys.requires_grad
+
+
+def test_relative_matmul():
+    torch.manual_seed(1101)
+    x, scores = torch.randn(2, 3, 5, 4), torch.randn(2, 3, 5, 5)
+    for z in [torch.randn(5, 5, 4), torch.randn(1, 5, 4)]:
+        # row q of x against the query row q of z (or its single row)
+        rows = [z[q if z.size(0) > 1 else 0] for q in range(5)]
+        expected = torch.stack([x[:, :, q] @ rows[q].t() for q in range(5)], dim=2)
+        assert torch.allclose(relative_matmul(x, z, True), expected, atol=1e-5)
+        expected = torch.stack([scores[:, :, q] @ rows[q] for q in range(5)], dim=2)
+        assert torch.allclose(relative_matmul(scores, z, False), expected, atol=1e-5)
+    table = cached_relative_positions_matrix(6, 3, False, torch.device('cpu'))
+    assert table is cached_relative_positions_matrix(6, 3, False, torch.device('cpu'))
+    assert torch.equal(table, generate_relative_positions_matrix(6, 3))
+
+
+def test_train_after_encode():
+    # the relative position table memoized by an inference forward is reused
+    # by the training forwards that follow, e.g. Distiller.report mid-training
+    torch.manual_seed(1101)
+    cached_relative_positions_matrix.cache_clear()
+    attn = MultiHeadedAttention(4, 32, 0.0, max_relative_positions=8)
+    x = torch.randn(2, 7, 32)
+    attn.eval()
+    with getattr(torch, 'inference_mode', torch.no_grad)():
+        attn(x, x, x, type="self")
+    attn.train()
+    output, _ = attn(x, x, x, type="self")
+    output.sum().backward()
+    assert attn.relative_positions_embeddings.weight.grad is not None
+
+
+def test_beam_search():
+    # first order model over 5 classes, the start token is num_classes
+    torch.manual_seed(1101)
+    num_classes, end_index, length = 5, 4, 5
+    trans = torch.randn(3, num_classes + 1, num_classes).log_softmax(-1)
+    # the last batch row has to end after at most one token
+    trans[2, :num_classes] = torch.Tensor([-1e4, -1e4, -1e4, -1e4, 0.])
+    group_sizes = []
+
+    def step(last, state):
+        group_sizes.append(last.size(0))
+        return trans[state['row'], last], state
+
+    def score(row, seq):
+        total, last = 0., num_classes
+        for token in seq:
+            if last == end_index:
+                assert token == end_index
+                continue
+            total += trans[row, last, token].item()
+            last = token
+        return total
+
+    start = torch.full((3,), num_classes, dtype=torch.long)
+    predictions, log_probs = BeamSearch(end_index, length, beam_size=2).search(
+        start, {'row': torch.arange(3)}, step)
+    greedy, _ = BeamSearch(end_index, length, beam_size=1).search(
+        start, {'row': torch.arange(3)}, step)
+
+    assert predictions.size() == (3, 2, length)
+    for row in range(3):
+        for k in range(2):
+            assert abs(score(row, predictions[row, k].tolist()) - log_probs[row, k].item()) < 1e-4
+        assert log_probs[row, 0] >= log_probs[row, 1]
+        assert log_probs[row, 0] >= score(row, greedy[row, 0].tolist()) - 1e-4
+    # every beam of the last row ended after two steps, it was not decoded anymore
+    assert predictions[2, :, 2:].eq(end_index).all()
+    assert group_sizes[:2] == [3, 6] and max(group_sizes[2:], default=0) <= 4
+
+
+def test_decode_order():
+    # transitions agree with the training scorer, and the decoded orders are
+    # permutations scored by the sum of their transitions
+    torch.manual_seed(1101)
+    for score_type in ['dot', 'bilinear', 'denselinear', 'linear']:
+        predictor = Predic_Net(16, score_type).eval()
+        reps = [torch.randn(6, 16), torch.randn(2, 16), torch.randn(4, 16)]
+        h = predictor.layernorm(reps[0])
+        logit = predictor.cpt_logit(h[:1].expand(6, 16), h)
+        if score_type in ['dot', 'bilinear']:
+            expected = torch.nn.functional.logsigmoid(logit).view(-1)
+        else:
+            expected = torch.nn.functional.log_softmax(logit, dim=-1)[:, 0, 1]
+        assert torch.allclose(predictor.transition_scores(reps[0])[0], expected, atol=1e-5)
+        orders, log_probs = decode_order(predictor, reps, beam_size=4)
+        for i, rep in enumerate(reps):
+            trans = predictor.transition_scores(rep)
+            score = sum(trans[a, b].item() for a, b in zip(orders[i], orders[i][1:]))
+            assert sorted(orders[i]) == list(range(rep.size(0)))
+            assert abs(score - log_probs[i, 0].item()) < 1e-4
+
+
+def naive_tree(distance, lo, hi, n, parent, up=-1):
+    # leaves lo..hi, split recursively at the first largest distance
+    if lo == hi:
+        parent[lo] = up
+        return
+    k = max(range(lo, hi), key=lambda x: (distance[x], -x))
+    parent[n + k] = up
+    naive_tree(distance, lo, k, n, parent, n + k)
+    naive_tree(distance, k + 1, hi, n, parent, n + k)
+
+
+def test_distance_to_tree():
+    torch.manual_seed(1101)
+    assert distance_to_tree([]) == [-1]
+    for n in [2, 3, 7, 30]:
+        for distance in [torch.randn(n - 1).tolist(), torch.randint(3, (n - 1,)).float().tolist()]:
+            parent = [None] * (2 * n - 1)
+            naive_tree(distance, 0, n - 1, n, parent)
+            assert distance_to_tree(distance) == parent
+
+
+def test_get_sm():
+    # [r, c] is the context sentence c - r of column c: a square stacked along
+    # the wrong dim made every context of the objective rep[0]
+    torch.manual_seed(1101)
+    predictor = Predic_Net(16, 'dot')
+    for n in [2, 3, 9]:
+        rep = torch.randn(n, 16)
+        square = predictor.get_sm(rep)
+        expected = torch.zeros(n - 1, n - 1, 16)
+        for c in range(n - 1):
+            for r in range(c + 1):
+                expected[r, c] = rep[c - r]
+        assert torch.equal(square, expected)
+
+
+def test_incremental_context():
+    torch.manual_seed(1101)
+    predictor = Predic_Net(16, 'dot').eval()
+    rep = torch.randn(40, 16)
+    for hard in [True, False]:
+        parser = Parser(16, 0.0, 'dot', 1., hard).eval()
+        with torch.no_grad():
+            score = parser.score_layer([rep])
+            gate = parser.gate_layer(score, [rep], [list(range(40))], [list(range(41))])
+            full = predictor.mask_gate(gate[0])
+            for window in [None, 1, 5]:
+                mask = (full[0].clone(), full[1])
+                if window is not None:
+                    mask[0][window:] = 0
+                fwd, _ = predictor.compute_h([predictor.get_sm(rep)], [predictor.get_sm(rep.flip((0,)))], [mask])
+                stream = IncrementalContext(parser, window, capacity=8)
+                contexts = [stream.push(x) for x in rep]
+                assert contexts[0] is None
+                assert torch.allclose(torch.stack(contexts[1:]), fwd[0], atol=1e-5)
+
+
+def test_prefix_context():
+    torch.manual_seed(1101)
+    predictor = Predic_Net(16, 'dot').eval()
+    rep = torch.randn(30, 16)
+    # a small resolution makes the hard gates binary but for near ties
+    for resolution in [1e-4, 1e-2]:
+        parser = Parser(16, 0.0, 'dot', resolution, True, prefix_context=True).eval()
+        with torch.no_grad():
+            score = parser.score_layer([rep])
+            gate = parser.gate_layer.compute_gate(score)
+            dense = predictor.compute_h([predictor.get_sm(rep)], [predictor.get_sm(rep.flip((0,)))],
+                                        [predictor.mask_gate(gate)])
+            spans = parser.gate_layer(score, [rep], [list(range(30))], [list(range(31))])[0]
+            fwd, bwd = predictor.compute_span_h(rep, spans[0], spans[1])
+        assert torch.allclose(fwd, dense[0][0], atol=1e-4)
+        assert torch.allclose(bwd, dense[1][0], atol=1e-4)
+
+
+def test_quantize_encoder():
+    torch.manual_seed(1101)
+    src, mask = get_batch([5, 9, 3, 12])
+    for encoder in [TransformerEncoder(100, 16, 32, 4, 2, 0.0), LSTMEncoder(100, 16, 16, 1, 0.0, True)]:
+        encoder.eval()
+        with torch.no_grad():
+            full = encoder(src, mask, None, [5, 9, 3, 12])
+            quantized = quantize_encoder(encoder)(src, mask, None, [5, 9, 3, 12])
+        assert torch.nn.functional.cosine_similarity(full, quantized).min() > 0.95
+
+
+def test_token_budget_batches():
+    lens = [5, 50, 12, 3, 17, 50, 8, 20]
+    batches = token_budget_batches(lens, 40)
+    assert sorted(i for batch in batches for i in batch) == list(range(len(lens)))
+    assert all(len(batch) == 1 or max(lens[i] for i in batch) * len(batch) <= 40 for batch in batches)
+    assert [lens[batch[0]] for batch in batches] == sorted(lens[batch[0]] for batch in batches)
+    src, mask, src_lens = pad_sents([[1, 2, 3], [4]])
+    assert src.tolist() == [[1, 2, 3], [4, 0, 0]] and mask.sum().item() == 4 and src_lens == [3, 1]
+
+
+def test_encoder_pool():
+    sets = core_sets(min(2, os.cpu_count() or 1))
+    cores = [core for cores in sets for core in cores]
+    assert all(sets) and len(cores) == len(set(cores))
+    torch.manual_seed(1101)
+    model = small_model()
+    sents = [[1] + torch.randint(2, 100, (n,)).tolist() for n in [3, 9, 1, 4, 12, 7]]
+    with EncoderPool(model, len(sets)) as pool:
+        pooled = pool.encode(sents, max_tokens=16)
+    src, mask, lens = pad_sents(sents)
+    expected = PEmodel.encode(model, src, mask, {'src': lens})
+    assert torch.allclose(torch.from_numpy(pooled), expected, atol=1e-5)
+
+
+def test_embedding_cache():
+    torch.manual_seed(1101)
+    model = small_model().eval()
+    sents = [[1, 5, 7], [1, 9], [1, 5, 7], [1, 3, 3, 3]]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = EmbeddingCache(model, max_bytes=2 * 16 * 4, cache_dir=cache_dir)
+        first = cache.encode(sents)
+        assert cache.stats['misses'] == 3 and torch.allclose(torch.from_numpy(first[0]), torch.from_numpy(first[2]))
+        # the memory tier holds two embeddings, the third one comes from disk
+        second = cache.encode(sents)
+        assert torch.allclose(torch.from_numpy(second), torch.from_numpy(first), atol=1e-6)
+        assert cache.stats['memory_bytes'] <= cache.max_bytes and cache.stats['disk_hits'] >= 1
+        # an in place update of the weights invalidates every entry
+        with torch.no_grad():
+            model.encoder.ffn[0].bias.add_(1.)
+        cache.encode(sents)
+        assert cache.stats['misses'] == 6
+
+
+def test_tree_shard_writer():
+    assert list(read_ahead(iter(range(10)), 2)) == list(range(10))
+    trees = {3: [2, 2, -1], 4: [-1], 5: []}
+    for fmt in ['jsonl', 'bin']:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'shard-00000')
+            writer = TreeShardWriter(path, fmt, 3)
+            writer.write(3, trees[3])
+            writer.commit(4)
+            # killed after writing doc 4 but before its progress marker
+            writer.write(4, trees[4])
+            writer.close()
+            writer = TreeShardWriter(path, fmt, 3)
+            assert writer.next_doc == 4 and not writer.done
+            for doc in [4, 5]:
+                writer.write(doc, trees[doc])
+            writer.commit(6, done=True)
+            writer.close()
+            assert dict(read_tree_shard(f'{path}.{fmt}')) == trees
+
+
+def test_embedding_cache_quantized():
+    torch.manual_seed(1101)
+    model = small_model().eval()
+    fp32 = state_fingerprint(model.encoder)
+    model.encoder = quantize_encoder(model.encoder)
+    # packed int8 weights are hashed too, identically on every call
+    assert state_fingerprint(model.encoder) == state_fingerprint(model.encoder) != fp32
+    cache = EmbeddingCache(model)
+    sents = [[1, 5, 7], [1, 9], [1, 5, 7]]
+    first = cache.encode(sents)
+    assert torch.allclose(torch.from_numpy(cache.encode(sents)), torch.from_numpy(first))
+    assert cache.stats['misses'] == 2 and cache.stats['memory_hits'] == 2
+
+
+def test_fingerprint_bfloat16():
+    # e.g. the encoder of an export-weights --dtype bfloat16 directory
+    torch.manual_seed(1101)
+    encoder = TransformerEncoder(100, 16, 32, 4, 2, 0.0)
+    fp32 = state_fingerprint(encoder)
+    encoder = encoder.to(torch.bfloat16)
+    assert state_fingerprint(encoder) == state_fingerprint(encoder) != fp32
+
+
+def test_flat_checkpoint():
+    torch.manual_seed(1101)
+    encoder = TransformerEncoder(100, 16, 32, 4, 2, 0.0).eval()
+    src = torch.randint(1, 100, (3, 7))
+    mask = torch.ones(3, 7).long()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, WEIGHTS)
+        for dtype, atol in [(None, 1e-6), ('float16', 1e-2), ('bfloat16', 1e-1)]:
+            save_tensors(encoder.state_dict(), path, dtype)
+            tensors = map_tensors(path)
+            assert all(t.data_ptr() % ALIGN == 0 for t in tensors.values())
+            loaded = TransformerEncoder(100, 16, 32, 4, 2, 0.0).eval()
+            assign_tensors(loaded, tensors)
+            # the weights are the mapped tensors themselves
+            assert loaded.ffn[0].weight.data_ptr() == tensors['ffn.0.weight'].data_ptr()
+            with torch.no_grad():
+                out = loaded.float()(src, mask) if dtype else loaded(src, mask)
+                assert torch.allclose(out, encoder(src, mask), atol=atol)
+
+
+def test_distill_helpers():
+    sents = [[1, 5, 9, 3], [1, 7, 2], [1, 4, 4, 8, 6]]
+    Tensor_dict = {'src': pad_sents(sents)[0]}
+    assert batch_sents(Tensor_dict, {'src': [4, 3, 5]}) == sents
+    torch.manual_seed(1101)
+    x = torch.randn(50, dtype=torch.float64).numpy()
+    assert abs(rank_correlation(x, 2 * x + 1) - 1) < 1e-9
+    assert abs(rank_correlation(x, -x) + 1) < 1e-9
+    embs = torch.randn(6, 8, dtype=torch.float64)
+    sims = pairwise_cosine(embs.numpy())
+    assert sims.shape == (15,)
+    assert abs(sims[0] - torch.cosine_similarity(embs[0], embs[1], dim=0).item()) < 1e-9
+
+
+def test_distill_step():
+    # a student equal to its teacher has a zero loss only if the captured rows
+    # line up with the sentences sent to the teacher
+    torch.manual_seed(1101)
+    args = small_args('--negatives', 'in_batch', '--distill_weight', '1')
+    student = build_model(args)
+    sents = [torch.randint(1, 100, (n,)).tolist() for n in [4, 6, 3, 5, 7]]
+    sents[3] = sents[0]
+    # documents whose rows are out of batch order
+    idx_dict = {'rep_idx': [[4, 0, 2], [3, 1]], 'score_idx': [[0, 1, 2, 3], [4, 5, 6]]}
+    src, mask, lens = pad_sents(sents)
+    unique, sent_map = fuse_sents([{'src_idx': sents[:3]}, {'src_idx': sents[3:]}])
+    u, mu, lu = pad_sents(unique)
+    batches = [({'src': src, 'mask_src': mask}, idx_dict, {'src': lens}),
+               ({'src': u, 'mask_src': mu, **sent_map}, idx_dict, {'src': lu})]
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'config.json'), 'w') as fjson:
+            json.dump(vars(args), fjson)
+        torch.save({'model_state_dict': student.state_dict()}, os.path.join(tmp, 'checkpoint'))
+        for loss_type in ['mse', 'cosine']:
+            distiller = Distiller(tmp, 16, loss_type)
+            # the teacher width comes from its config, not from encoding a sentence
+            assert isinstance(distiller.projection, nn.Identity) and not distiller.cache.memory
+            optimizer = torch.optim.SGD(student.parameters(), lr=0.)
+            scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lambda step: 1.)
+            for data in batches:
+                log = distill_step(student, distiller, optimizer, scheduler, data, args, 0)
+                assert log['distill_loss'] < 1e-5
+
+
+def test_micro_batcher():
+    # sentences of concurrent submissions are coalesced by length bucket
+    calls = []
+
+    def encode_fn(sents):
+        calls.append([len(s) for s in sents])
+        return torch.Tensor([[float(len(s))] for s in sents]).numpy()
+
+    async def run():
+        batcher = MicroBatcher(encode_fn, max_batch_size=4, max_wait_ms=20, bucket_width=4)
+        task = asyncio.ensure_future(batcher.run())
+        await asyncio.sleep(0)
+        sents = [[1] * n for n in [2, 3, 9, 2, 10, 1, 3]]
+        embs = await asyncio.gather(*[batcher.submit(s) for s in sents])
+        task.cancel()
+        return embs
+
+    embs = asyncio.run(run())
+    assert [emb[0] for emb in embs] == [2, 3, 9, 2, 10, 1, 3]
+    # the full bucket goes first, then the bucket of the oldest sentence once due
+    assert calls == [[2, 3, 2, 1], [9, 10], [3]]
+
+
+def post_embed(port, token_ids):
+    async def run():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        body = json.dumps({'token_ids': token_ids}).encode()
+        writer.write(f'POST /embed HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode()
+                     + body)
+        response = await reader.read()
+        writer.close()
+        return int(response.split(b' ', 2)[1])
+    return run()
+
+
+def test_server_errors():
+    table = torch.randn(100, 4)
+
+    def encode_fn(sents):
+        if any(99 in sent for sent in sents):
+            raise RuntimeError('encoder failure')
+        return torch.stack([table[torch.LongTensor(sent)].mean(0) for sent in sents]).numpy()
+
+    async def run():
+        batcher = MicroBatcher(encode_fn, max_batch_size=4, max_wait_ms=20)
+        batching = asyncio.ensure_future(batcher.run())
+        server = await asyncio.start_server(EmbeddingServer(batcher, vocab_size=100).handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        # an out of vocabulary request is rejected alone, the concurrent valid one is embedded
+        statuses = await asyncio.gather(post_embed(port, [[1, 2, 3]]), post_embed(port, [[1, 5000, 3]]))
+        failed = await post_embed(port, [[1, 99, 3]])
+        batching.cancel()
+        server.close()
+        return statuses, failed
+
+    statuses, failed = asyncio.run(run())
+    assert statuses == [200, 400]
+    assert failed == 500
+
+
+def test_export_encoder():
+    torch.manual_seed(1101)
+    for encoder in [TransformerEncoder(100, 16, 32, 4, 2, 0.0, cls_only=True), LSTMEncoder(100, 16, 16, 1, 0.0, True)]:
+        export = ExportEncoder(encoder).eval()
+        with torch.no_grad():
+            scripted = torch.jit.trace(export, get_batch([5, 9, 3, 12]))
+            # traced once, run on batches of other shapes
+            for lens in [[7, 2], [20, 11, 4, 6, 1]]:
+                src, mask = get_batch(lens)
+                assert torch.allclose(scripted(src, mask), encoder(src, mask, None, lens), atol=1e-5)
+
+
+def test_pruned_attention():
+    torch.manual_seed(1101)
+    mha = nn.MultiheadAttention(32, 4).eval()
+    attn = PrunedSelfAttention.from_multihead(mha).eval()
+    x = torch.randn(7, 3, 32)
+    padding = torch.zeros(3, 7, dtype=torch.bool)
+    padding[1, 5:] = True
+    with torch.no_grad():
+        expected = mha(x, x, x, key_padding_mask=padding, need_weights=False)[0]
+        assert torch.allclose(attn(x, x, x, key_padding_mask=padding)[0], expected, atol=1e-5)
+        assert torch.allclose(attn(x[:1], x, x, key_padding_mask=padding)[0], expected[:1], atol=1e-5)
+        # removing heads equals masking them
+        attn.head_mask[torch.LongTensor([0, 2])] = 0
+        assert torch.allclose(attn.prune([1, 3])(x, x, x)[0], attn(x, x, x)[0], atol=1e-5)
+
+
+def test_prune_heads():
+    torch.manual_seed(1101)
+    src, mask = get_batch([5, 9, 3, 12])
+    removed = [(0, 0), (1, 2), (1, 3)]
+    importance = [[0. if (l, h) in removed else 1. for h in range(4)] for l in range(2)]
+    for pack in [False, True]:
+        encoder = TransformerEncoder(100, 16, 32, 4, 2, 0.0, pack=pack).eval()
+        with torch.no_grad():
+            expected = encoder(src, mask, None, None)
+            convert_heads(encoder)
+            assert torch.allclose(encoder(src, mask, None, None), expected, atol=1e-5)
+            for l, h in removed:
+                encoder.enc_layer.layers[l].self_attn.head_mask[h] = 0
+            masked = encoder(src, mask, None, None)
+            pruned = copy.deepcopy(encoder)
+            assert prune_heads(pruned, importance, 0.375) == [3, 2]
+            assert torch.allclose(pruned(src, mask, None, None), masked, atol=1e-5)
+            # the pruned encoder is rebuilt from its layer_heads
+            rebuilt = TransformerEncoder(100, 16, 32, 4, 2, 0.0, pack=pack, layer_heads=pruned.layer_heads).eval()
+            rebuilt.load_state_dict(pruned.state_dict())
+            assert torch.allclose(rebuilt(src, mask, None, None), masked, atol=1e-5)
+    # every layer keeps a head
+    assert prune_heads(convert_heads(TransformerEncoder(100, 16, 32, 4, 2, 0.0)), importance, 1.) == [1, 1]
+
+
+def test():
+    test_cls_only()
+    test_pack()
+    test_dense_logit()
+    test_nce_logit()
+    test_in_batch_negatives()
+    test_fuse_encoder()
+    test_checkpoint_activations()
+    test_memory_bank()
+    test_memory_bank_negatives()
+    test_chunked_attention()
+    test_kv_cache()
+    test_relative_matmul()
+    test_train_after_encode()
+    test_beam_search()
+    test_decode_order()
+    test_distance_to_tree()
+    test_get_sm()
+    test_incremental_context()
+    test_prefix_context()
+    test_quantize_encoder()
+    test_token_budget_batches()
+    test_tree_shard_writer()
+    test_encoder_pool()
+    test_embedding_cache()
+    test_embedding_cache_quantized()
+    test_fingerprint_bfloat16()
+    test_export_encoder()
+    test_flat_checkpoint()
+    test_distill_helpers()
+    test_distill_step()
+    test_micro_batcher()
+    test_server_errors()
+    test_pruned_attention()
+    test_prune_heads()
+
+
+if __name__ == "__main__":
+    test()